@@ -0,0 +1,239 @@
+from __future__ import annotations
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence
+
+import numpy as np
+
+from app.metrics import CACHE_EVENTS, CACHE_HIT_RATIO, CACHE_SIZE
+from app.settings import settings
+
+"""
+Cachés en memoria para /chat: vectores de pregunta, resultados de
+retrieve_context y respuestas del LLM. LRU acotada + TTL, segura entre hilos.
+"""
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = max(0, maxsize)
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # sube con cada invalidación; evita guardar resultados calculados antes de ella
+        self.generation = 0
+
+    def _event(self, event: str, n: int = 1) -> None:
+        CACHE_EVENTS.labels(self.name, event).inc(n)
+        if event in ("hit", "miss"):
+            CACHE_HIT_RATIO.labels(self.name).set(self.hits / max(1, self.hits + self.misses))
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl > 0 and time.monotonic() - item[0] > self.ttl:
+                # caducado: cuenta como fallo
+                del self._data[key]
+                self._event("expired")
+                item = None
+            if item is None:
+                self.misses += 1
+                self._event("miss")
+                CACHE_SIZE.labels(self.name).set(len(self._data))
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            self._event("hit")
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+                self._event("eviction")
+            CACHE_SIZE.labels(self.name).set(len(self._data))
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        with self._lock:
+            self.generation += 1
+            stale = [k for k in self._data if predicate(k)]
+            for k in stale:
+                del self._data[k]
+            if stale:
+                self._event("invalidated", len(stale))
+            CACHE_SIZE.labels(self.name).set(len(self._data))
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            CACHE_SIZE.labels(self.name).set(0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SemanticCache(LRUCache):
+    """
+    Caché de respuestas por similitud: las entradas se agrupan por una
+    clave de contexto (modelo, fuente, IDs recuperados, historial) y dentro
+    del grupo basta con que el vector de la pregunta supere threshold de
+    similitud coseno. Así una paráfrasis que recupera los mismos chunks
+    reutiliza la respuesta sin llamar al LLM.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, threshold: float):
+        super().__init__(name, maxsize, ttl)
+        self.threshold = threshold
+        self._next = 0
+        # clave de contexto -> IDs de entrada en _data
+        self._groups: Dict[Hashable, set] = {}
+
+    @staticmethod
+    def _unit(vec: Sequence[float]) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    def lookup(self, qvec: Sequence[float], ctx_key: Hashable) -> tuple[Any, float]:
+        """
+        Devuelve (valor, similitud) de la entrada más parecida del grupo, o
+        (MISSING, mejor similitud vista) si ninguna llega al umbral.
+        """
+        q = self._unit(qvec)
+        now = time.monotonic()
+        with self._lock:
+            best, best_sim = None, -1.0
+            for eid in list(self._groups.get(ctx_key, ())):
+                ts, vec, _, _, _ = self._data[eid]
+                if self.ttl > 0 and now - ts > self.ttl:
+                    self._drop(eid)
+                    self._event("expired")
+                    continue
+                sim = float(vec @ q)
+                if sim > best_sim:
+                    best, best_sim = eid, sim
+            if best is None or best_sim < self.threshold:
+                self.misses += 1
+                self._event("miss")
+                CACHE_SIZE.labels(self.name).set(len(self._data))
+                return MISSING, best_sim
+            self._data.move_to_end(best)
+            self.hits += 1
+            self._event("hit")
+            return self._data[best][4], best_sim
+
+    def store(
+        self,
+        qvec: Sequence[float],
+        ctx_key: Hashable,
+        sources: frozenset,
+        value: Any,
+        generation: Optional[int] = None,
+    ) -> None:
+        # sources: fuentes de los chunks usados, para invalidar por fuente
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            eid = self._next
+            self._next += 1
+            self._data[eid] = (time.monotonic(), self._unit(qvec), ctx_key, sources, value)
+            self._groups.setdefault(ctx_key, set()).add(eid)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+                self._event("eviction")
+            CACHE_SIZE.labels(self.name).set(len(self._data))
+
+    def _drop(self, eid: int) -> None:
+        _, _, ctx_key, _, _ = self._data.pop(eid)
+        group = self._groups.get(ctx_key)
+        if group is not None:
+            group.discard(eid)
+            if not group:
+                del self._groups[ctx_key]
+
+    def invalidate_sources(self, source: Optional[str]) -> int:
+        # entradas sin filtro de fuente o que usaron chunks de esa fuente
+        with self._lock:
+            self.generation += 1
+            stale = [
+                eid for eid, (_, _, ctx_key, sources, _) in self._data.items()
+                if ctx_key[1] is None or ctx_key[1] == source or source in sources
+            ]
+            for eid in stale:
+                self._drop(eid)
+            if stale:
+                self._event("invalidated", len(stale))
+            CACHE_SIZE.labels(self.name).set(len(self._data))
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._groups.clear()
+        super().clear()
+
+
+_WS = re.compile(r"\s+")
+
+def normalize_question(text: str) -> str:
+    # misma pregunta con distinto espaciado o mayúsculas -> misma clave
+    return _WS.sub(" ", (text or "").strip()).casefold()
+
+
+def vector_key(vec: Sequence[float]) -> str:
+    # huella compacta del vector para usarla dentro de otras claves
+    return hashlib.sha1(np.asarray(vec, dtype=np.float32).tobytes()).hexdigest()
+
+
+# (modelo de embeddings, pregunta normalizada) -> vector
+query_vector_cache = LRUCache("query_vector", settings.query_cache_size, settings.query_cache_ttl)
+
+# (huella del vector, top_k, source, mmr) -> resultado de retrieve_context
+retrieval_cache = LRUCache("retrieval", settings.retrieval_cache_size, settings.retrieval_cache_ttl)
+
+# (modelo, source, IDs recuperados, historial) + vector de la pregunta -> respuesta de /chat
+answer_cache = SemanticCache(
+    "answer", settings.answer_cache_size, settings.answer_cache_ttl, settings.answer_cache_threshold
+)
+
+
+def answer_context_key(source: Optional[str], ids: Sequence[str], history: Sequence[Dict[str, str]]) -> tuple:
+    # la respuesta depende del modelo, de los chunks recuperados y del historial
+    hist = hashlib.sha1(
+        "\x1e".join(f"{m.get('role')}\x1f{normalize_question(m.get('content', ''))}" for m in history).encode("utf-8")
+    ).hexdigest() if history else None
+    return (settings.ollama_model, source or None, tuple(sorted(ids)), hist)
+
+
+def invalidate_source(source: Optional[str]) -> int:
+    """
+    Tras ingestar/borrar chunks de una fuente, tira los resultados filtrados
+    por esa fuente y también los de búsquedas sin filtro (source=None), y
+    las respuestas cacheadas que dependían de ella.
+    """
+    answer_cache.invalidate_sources(source)
+    return retrieval_cache.invalidate(lambda k: k[2] is None or k[2] == source)
@@ -0,0 +1,379 @@
+from __future__ import annotations
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.logging_config import configure_logging
+from app.uploads import UPLOADS_DIR
+
+"""
+Línea de comandos para cargar y mantener la base sin pasar por la API
+(con la API parada: Chroma no admite dos procesos escribiendo la misma base):
+  python -m app.cli ingest DIR [--workers N] [--checkpoint F] [--source-name relpath]
+      ingesta en paralelo de los PDFs de DIR (recursivo); se salta lo ya
+      ingestado (file_hash) y, con el checkpoint, lo terminado en una
+      ejecución anterior sin volver a leerlo
+  python -m app.cli rebuild [--dir data/uploads] [--allow-ollama]
+      rehace la base de Chroma (p. ej. tras borrar data/chroma) con los PDFs
+      de --dir (cada uno con el nombre con que se subió) y los embeddings de la caché persistente, sin llamar a Ollama
+  python -m app.cli stats [--json] [--top 20]
+  python -m app.cli compact [--reindex] [--no-vacuum]
+  python -m app.cli embed-cache {stats,evict,clear} [--model M]
+Usa la misma configuración (.env / variables de entorno) que la app.
+"""
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def _pdfs(directory: Path) -> List[Path]:
+    # los temporales de subida (.upload-*.part) no terminan en .pdf
+    return sorted(p for p in directory.rglob("*") if p.is_file() and p.suffix.lower() == ".pdf")
+
+
+class Checkpoint:
+    """
+    Archivo JSONL con una línea por PDF terminado (o fallido). Al reanudar
+    se saltan los terminados cuya ruta, fuente, tamaño y mtime no cambiaron; los
+    fallidos se reintentan. Una última línea a medias (corte) se ignora.
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self.done: Dict[str, Dict[str, Any]] = {}
+        self._fh = None
+        if path is None:
+            return
+        if path.exists():
+            for line in path.read_text(encoding="utf-8").splitlines():
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get("status") in (DONE, SKIPPED):
+                    self.done[rec["path"]] = rec
+                else:
+                    self.done.pop(rec.get("path"), None)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def is_done(self, path: Path, source: str) -> bool:
+        rec = self.done.get(str(path))
+        if rec is None or rec.get("source") != source:
+            return False
+        st = path.stat()
+        return rec.get("size") == st.st_size and rec.get("mtime") == st.st_mtime
+
+    def record(self, rec: Dict[str, Any]) -> None:
+        if self._fh is not None:
+            self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._fh.flush()
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class Progress:
+    # totales acumulados y ritmo desde el principio
+    def __init__(self, total: int):
+        self.total = total
+        self.seen = 0
+        self.pages = 0
+        self.chunks = 0
+        self.counts = {DONE: 0, SKIPPED: 0, FAILED: 0}
+        self.t0 = time.perf_counter()
+
+    def add(self, rec: Dict[str, Any]) -> str:
+        self.seen += 1
+        self.counts[rec["status"]] = self.counts.get(rec["status"], 0) + 1
+        self.pages += rec.get("pages") or 0
+        self.chunks += rec.get("chunks") or 0
+        if rec["status"] == DONE:
+            state = f"{rec['pages']} págs, {rec['added']} chunks nuevos, {rec['kept']} conservados"
+        elif rec["status"] == SKIPPED:
+            state = f"igual que '{rec['duplicate_of']}'" if rec.get("duplicate_of") else "sin cambios"
+        else:
+            state = f"error: {rec.get('error')}"
+        return f"[{self.seen}/{self.total}] {rec['source']}: {state} | {self.rate()}"
+
+    def rate(self) -> str:
+        dt = max(1e-9, time.perf_counter() - self.t0)
+        return f"{self.pages / dt:.1f} págs/s, {self.chunks / dt:.1f} chunks/s"
+
+    def summary(self) -> str:
+        dt = time.perf_counter() - self.t0
+        return (f"{self.counts[DONE]} ingestados, {self.counts[SKIPPED]} saltados, {self.counts[FAILED]} con error "
+                f"en {dt:.1f}s: {self.pages} págs, {self.chunks} chunks ({self.rate()})")
+
+
+class _Claims:
+    # file_hash -> primera fuente que lo ingesta en esta ejecución (las copias en vuelo no se ven en Chroma)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_hash: Dict[str, str] = {}
+
+    def claim(self, file_hash: str, source: str) -> Optional[str]:
+        with self._lock:
+            owner = self._by_hash.setdefault(file_hash, source)
+        return None if owner == source else owner
+
+
+def _ingest_one(path: Path, source: str, force: bool, stop: threading.Event, claims: _Claims) -> Dict[str, Any]:
+    from app.embed_cache import EmbedCacheMiss
+    from app.ingest import IngestCancelled, find_ingested, ingest_pdf
+    from app.uploads import hash_file
+
+    st = path.stat()
+    rec: Dict[str, Any] = {"path": str(path), "source": source, "size": st.st_size, "mtime": st.st_mtime}
+    t0 = time.perf_counter()
+    try:
+        rec["file_hash"] = hash_file(path)
+        if not force:
+            # mismo archivo ya ingestado completo, con este nombre u otro, o en curso con otro nombre
+            owner = claims.claim(rec["file_hash"], source)
+            if owner:
+                # no va al checkpoint: si la ingesta de owner falla, al reanudar se vuelve a mirar
+                return {**rec, "status": SKIPPED, "duplicate_of": owner, "claimed": True}
+            dup = find_ingested(rec["file_hash"], source)
+            if dup:
+                return {**rec, "status": SKIPPED, "duplicate_of": dup if dup != source else None}
+        res = ingest_pdf(path, source, stop=stop, file_hash=rec["file_hash"])
+    except IngestCancelled:
+        return {**rec, "status": CANCELLED}
+    except EmbedCacheMiss as e:
+        return {**rec, "status": FAILED, "error": f"{e} (reintenta con --allow-ollama)"}
+    except Exception as e:
+        return {**rec, "status": FAILED, "error": str(e)}
+    if res.get("skipped"):
+        return {**rec, "status": SKIPPED}
+    added, kept = res["added_chunks"], res.get("kept_chunks", 0)
+    return {**rec, "status": DONE, "pages": res.get("pages", 0), "chunks": added + kept,
+            "added": added, "kept": kept, "s": round(time.perf_counter() - t0, 2)}
+
+
+def _close_store() -> None:
+    from app.lexical import lexical_index
+    from app.pdf_extract import shutdown_pool
+    from app.retriever import collection_handle
+    from app.shards import shutdown_pool as shutdown_shard_pool
+
+    collection_handle.close()
+    lexical_index.close()
+    shutdown_pool()
+    shutdown_shard_pool()
+
+
+def run_ingest(files: List[Tuple[Path, str]], workers: int, force: bool, checkpoint: Checkpoint) -> int:
+    """
+    Ingesta files ((ruta, fuente)) con workers hilos; cada PDF por
+    ingest_pdf, como los trabajos de /ingest. Ctrl+C cancela lo que está
+    en curso (se deshace) y lo terminado queda en el checkpoint.
+    """
+    todo = [(p, s) for p, s in files if not checkpoint.is_done(p, s)]
+    if len(todo) < len(files):
+        print(f"checkpoint: {len(files) - len(todo)} archivos ya terminados en una ejecución anterior")
+    progress = Progress(len(todo))
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="cli-ingest")
+    try:
+        claims = _Claims()
+        futures = [pool.submit(_ingest_one, p, s, force, stop, claims) for p, s in todo]
+        for fut in as_completed(futures):
+            rec = fut.result()
+            if rec["status"] == CANCELLED:
+                continue
+            if not rec.get("claimed"):
+                checkpoint.record(rec)
+            print(progress.add(rec), flush=True)
+    except KeyboardInterrupt:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        print(f"\ninterrumpido; se retoma con el mismo comando. {progress.summary()}")
+        return 130
+    finally:
+        pool.shutdown(wait=True)
+        checkpoint.close()
+        _close_store()
+    print(progress.summary())
+    return 1 if progress.counts[FAILED] else 0
+
+
+def _sources(files: List[Path], root: Path, naming: str) -> List[Tuple[Path, str]]:
+    # nombre de la fuente: el del archivo (como /ingest) o la ruta relativa a root
+    if naming == "relpath":
+        return [(p, p.relative_to(root).as_posix()) for p in files]
+    return [(p, p.name) for p in files]
+
+
+def cmd_ingest(args: argparse.Namespace) -> int:
+    root = Path(args.dir).resolve()
+    files = _pdfs(root)
+    if not files:
+        print(f"No hay PDFs en {root}", file=sys.stderr)
+        return 1
+    pairs = _sources(files, root, args.source_name)
+    seen: Dict[str, Path] = {}
+    clashes = [(s, seen[s], p) for p, s in pairs if seen.setdefault(s, p) != p]
+    if clashes:
+        for s, a, b in clashes[:10]:
+            print(f"nombre repetido '{s}': {a} y {b}", file=sys.stderr)
+        print("Usa --source-name relpath para que cada archivo sea una fuente distinta", file=sys.stderr)
+        return 2
+    print(f"{len(files)} PDFs en {root}, {args.workers} en paralelo")
+    checkpoint = Checkpoint(None if args.no_checkpoint else Path(args.checkpoint))
+    return run_ingest(pairs, args.workers, args.force, checkpoint)
+
+
+def _upload_sources(directory: Path) -> Tuple[List[Tuple[Path, str]], int]:
+    """
+    (PDF, fuente) de una carpeta de subidas: los <file_hash>.pdf con el
+    nombre con que se subieron (names.sqlite3) y los de antes, con el suyo.
+    Devuelve también cuántos <file_hash>.pdf no tienen nombre (se saltan).
+    """
+    from app.uploads import NAMES_FILE, UploadNames, content_path, is_content_path
+
+    names = UploadNames(directory / NAMES_FILE)
+    try:
+        mapped = names.items()
+    finally:
+        names.close()
+    pairs = [(content_path(h, directory), name) for name, h in mapped if content_path(h, directory).exists()]
+    known = {name for _, name in pairs}
+    used = {p.name for p, _ in pairs}
+    unnamed = 0
+    for p in _pdfs(directory):
+        if not is_content_path(p):
+            if p.name not in known:
+                pairs.append((p, p.name))
+        elif p.name not in used:
+            unnamed += 1
+    return pairs, unnamed
+
+
+def cmd_rebuild(args: argparse.Namespace) -> int:
+    from app.retriever import collection_handle
+
+    embedder = collection_handle.embedder
+    if getattr(embedder, "cache", None) is None:
+        print("EMBED_CACHE está desactivada: no hay de dónde sacar los embeddings", file=sys.stderr)
+        return 2
+    embedder.cache_only = not args.allow_ollama
+    pairs, unnamed = _upload_sources(Path(args.dir))
+    if unnamed:
+        print(f"{unnamed} PDFs sin nombre en {args.dir}/names.sqlite3: se saltan", file=sys.stderr)
+    if not pairs:
+        print(f"No hay PDFs en {args.dir}", file=sys.stderr)
+        return 1
+    print(f"rehaciendo {args.chroma} con {len(pairs)} PDFs de {args.dir}")
+    return run_ingest(pairs, args.workers, False, Checkpoint(None))
+
+
+def _mb(n: int) -> str:
+    return f"{n / 1e6:.1f} MB"
+
+
+def cmd_stats(args: argparse.Namespace) -> int:
+    from app.maintenance import store_stats
+
+    stats = store_stats(args.top)
+    _close_store()
+    if args.json:
+        print(json.dumps(stats, indent=2, ensure_ascii=False))
+        return 0
+    disk = stats["disk"]
+    print(f"{stats['path']} (SHARD_MODE={stats['shard_mode'] or '-'}): {stats['collections']} colecciones")
+    print(f"  {stats['chunks']} chunks, {stats['sources']} fuentes, {stats['pages']} páginas con texto")
+    print(f"  disco: {_mb(disk['total_bytes'])} (SQLite {_mb(disk['sqlite_bytes'])}, HNSW {_mb(disk['segment_bytes'])})")
+    print(f"  BM25: {stats['bm25_chunks']} chunks" + ("" if stats["bm25_chunks"] == stats["chunks"] else " (desfasado: compact lo sincroniza)"))
+    if stats["incomplete_sources"]:
+        print(f"  ingestas a medias: {', '.join(stats['incomplete_sources'][:10])}")
+    for row in stats["top_sources"]:
+        print(f"  {row['chunks']:8d} chunks {row['pages']:6d} págs  {row['source']}")
+    return 0
+
+
+def cmd_compact(args: argparse.Namespace) -> int:
+    from app.maintenance import compact_store
+
+    res = compact_store(reindex=args.reindex, vacuum=not args.no_vacuum)
+    _close_store()
+    if res["orphan_shards"]:
+        print(f"colecciones huérfanas borradas: {', '.join(res['orphan_shards'])}")
+    if res["orphan_segment_dirs"]:
+        print(f"carpetas de segmentos huérfanas borradas: {len(res['orphan_segment_dirs'])}")
+    for name, n in (res.get("reindexed") or {}).items():
+        print(f"rehecha {name}: {n} chunks")
+    print(f"BM25: +{res['bm25']['added']} -{res['bm25']['removed']}")
+    if "compact" in res:
+        print(f"índice compacto: +{res['compact']['added']} -{res['compact']['removed']}")
+    print(f"disco: {_mb(res['disk_before']['total_bytes'])} -> {_mb(res['disk_after']['total_bytes'])}")
+    return 0
+
+
+def cmd_embed_cache(args: argparse.Namespace) -> int:
+    from app.embed_cache import embed_cache
+
+    if args.action == "evict":
+        print(f"{embed_cache.evict()} entradas borradas")
+    elif args.action == "clear":
+        print(f"{embed_cache.clear(args.model)} entradas borradas")
+    print(json.dumps(embed_cache.stats(), indent=2, ensure_ascii=False))
+    embed_cache.close()
+    return 0
+
+
+def main(argv: List[str] | None = None) -> int:
+    from app.settings import settings
+
+    ap = argparse.ArgumentParser(prog="python -m app.cli")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("ingest", help="ingesta en paralelo de un árbol de carpetas con PDFs")
+    p.add_argument("dir")
+    p.add_argument("--workers", type=int, default=settings.ingest_concurrency)
+    p.add_argument("--checkpoint", default=str(Path(settings.chroma_path).parent / "ingest_checkpoint.jsonl"))
+    p.add_argument("--no-checkpoint", action="store_true")
+    p.add_argument("--source-name", choices=["name", "relpath"], default="name",
+                   help="fuente = nombre del archivo (como /ingest) o ruta relativa a DIR")
+    p.add_argument("--force", action="store_true", help="ingesta también los que ya están con otro nombre")
+    p.set_defaults(func=cmd_ingest)
+
+    p = sub.add_parser("rebuild", help="rehace Chroma con los PDFs subidos y la caché de embeddings")
+    p.add_argument("--dir", default=str(UPLOADS_DIR), help="carpeta con los PDFs (por defecto, los subidos)")
+    p.add_argument("--allow-ollama", action="store_true", help="embebe con Ollama lo que no esté en la caché")
+    p.add_argument("--workers", type=int, default=settings.ingest_concurrency)
+    p.set_defaults(func=cmd_rebuild, chroma=settings.chroma_path)
+
+    p = sub.add_parser("stats", help="colecciones, fuentes, páginas y tamaño en disco de CHROMA_PATH")
+    p.add_argument("--json", action="store_true")
+    p.add_argument("--top", type=int, default=20, help="fuentes con más chunks a listar")
+    p.set_defaults(func=cmd_stats)
+
+    p = sub.add_parser("compact", help="sincroniza índices, borra huérfanos y compacta CHROMA_PATH")
+    p.add_argument("--reindex", action="store_true", help="rehace cada colección (HNSW sin los borrados)")
+    p.add_argument("--no-vacuum", action="store_true")
+    p.set_defaults(func=cmd_compact)
+
+    p = sub.add_parser("embed-cache", help="tamaño, recorte o borrado de la caché de embeddings")
+    p.add_argument("action", choices=["stats", "evict", "clear"])
+    p.add_argument("--model", default=None, help="con clear: sólo este modelo")
+    p.set_defaults(func=cmd_embed_cache)
+
+    args = ap.parse_args(argv)
+    # los eventos de la ingesta (INFO) taparían el progreso
+    configure_logging(logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
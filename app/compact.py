@@ -0,0 +1,375 @@
+from __future__ import annotations
+import fcntl
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.settings import settings
+
+"""
+Índice vectorial compacto, opcional, junto a data/chroma: los embeddings
+cuantizados en un array en disco (np.memmap) indexado por fila, y en SQLite
+qué chunk de Chroma ocupa cada fila. Sirve para un primer barrido rápido
+(coarse scan) sobre todo el corpus; los mejores candidatos se re-ordenan
+después con los vectores float de Chroma (ver rag._compact_candidates).
+- int8: cada vector normalizado, escalado a [-127, 127] con su propia
+  escala (dim + 4 bytes por chunk, 4x menos que float32);
+- binary: sólo el signo de cada componente (dim / 8 bytes, 32x menos);
+  la similitud es 1 - 2 * hamming / dim.
+"""
+
+_GROW = 2.0
+_MIN_CAPACITY = 1024
+# bytes (en float32) por bloque al barrer: bloques pequeños caben en caché y la
+# conversión int8 -> float32 + producto sale ~2x más rápida que de una vez
+_SCAN_BLOCK_BYTES = 1 << 20
+
+# bits a 1 de cada byte, para el hamming del modo binary
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def default_compact_path() -> Path:
+    return Path(settings.compact_path or Path(settings.chroma_path).parent / "compact")
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+
+class CompactIndex:
+    """
+    Ficheros en path/:
+    - index.sqlite3: meta(dim, quant), sources y rows(row, id, src);
+    - codes.bin: memmap (capacidad, ancho) con los vectores cuantizados;
+    - scales.bin: memmap (capacidad,) float32 con la escala de cada fila (int8).
+    En memoria sólo va la fuente de cada fila (-1 = libre), para filtrar
+    por source sin tocar SQLite. Las filas borradas se reutilizan.
+    Un solo escritor a la vez: add/delete toman un flock sobre
+    path/write.lock (la API y app.cli pueden coincidir) y, como el resto de
+    operaciones, recargan el estado en memoria si otra conexión escribió
+    desde la última vez (PRAGMA data_version).
+    """
+
+    def __init__(self, path: Path, quant: str = "int8"):
+        if quant not in ("int8", "binary"):
+            raise ValueError(f"COMPACT_QUANT debe ser 'int8' o 'binary', no '{quant}'")
+        self.path = Path(path)
+        self.quant = quant
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.dim: Optional[int] = None
+        self._codes: Optional[np.memmap] = None
+        self._scales: Optional[np.memmap] = None
+        self._src_of_row = np.empty(0, dtype=np.int32)
+        self._rows: int = 0           # filas usadas alguna vez (marca de agua)
+        self._free: List[int] = []
+        self._sources: Dict[str, int] = {}
+        self._version: Optional[int] = None
+
+    # -- apertura y almacenamiento
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path / "index.sqlite3"), timeout=10, check_same_thread=False)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS sources (src INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rows ("
+                    " row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, src INTEGER NOT NULL)"
+                )
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+            if meta.get("quant", self.quant) != self.quant:
+                conn.close()
+                raise ValueError(
+                    f"El índice compacto de {self.path} es '{meta['quant']}' y COMPACT_QUANT='{self.quant}': "
+                    "bórralo para reconstruirlo"
+                )
+            # la versión antes de leer: si alguien escribe entre medias, se relee otra vez
+            self._version = conn.execute("PRAGMA data_version").fetchone()[0]
+            self._sources = dict(conn.execute("SELECT name, src FROM sources").fetchall())
+            rows = conn.execute("SELECT row, src FROM rows").fetchall()
+            self._conn = conn
+            if "dim" in meta:
+                self.dim = int(meta["dim"])
+                capacity = max(_MIN_CAPACITY, max((r for r, _ in rows), default=-1) + 1)
+                self._map(capacity)
+            self._rows = max((r for r, _ in rows), default=-1) + 1
+            src_of_row = np.full(max(self._rows, _MIN_CAPACITY), -1, dtype=np.int32)
+            for row, src in rows:
+                src_of_row[row] = src
+            self._src_of_row = src_of_row
+            self._free = [int(r) for r in np.flatnonzero(src_of_row[:self._rows] < 0)]
+        return self._conn
+
+    def _fresh(self) -> sqlite3.Connection:
+        # data_version sólo cambia con escrituras de otras conexiones
+        conn = self._db()
+        if conn.execute("PRAGMA data_version").fetchone()[0] != self._version:
+            self._forget()
+            conn = self._db()
+        return conn
+
+    @contextmanager
+    def _writer(self) -> Iterator[sqlite3.Connection]:
+        # las filas libres y la marca de agua están en memoria: otro proceso
+        # escribiendo a la vez repartiría las mismas filas
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / "write.lock", "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield self._fresh()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _width(self) -> int:
+        return self.dim if self.quant == "int8" else (self.dim + 7) // 8
+
+    def _map(self, capacity: int) -> None:
+        # (re)abre los memmap con la capacidad pedida; el fichero crece si hace falta
+        dtype = np.int8 if self.quant == "int8" else np.uint8
+        files = [("codes.bin", dtype, (capacity, self._width()))]
+        if self.quant == "int8":
+            files.append(("scales.bin", np.float32, (capacity,)))
+        maps = []
+        for name, dt, shape in files:
+            f = self.path / name
+            size = int(np.prod(shape)) * np.dtype(dt).itemsize
+            with open(f, "ab") as fh:
+                if fh.tell() < size:
+                    fh.truncate(size)
+            maps.append(np.memmap(f, dtype=dt, mode="r+", shape=shape))
+        self._codes = maps[0]
+        self._scales = maps[1] if len(maps) > 1 else None
+
+    def _ensure_capacity(self, rows: int) -> None:
+        if self._codes is not None and rows <= self._codes.shape[0]:
+            return
+        capacity = max(_MIN_CAPACITY, rows, int((self._codes.shape[0] if self._codes is not None else 0) * _GROW))
+        if self._codes is not None:
+            self._codes.flush()
+            if self._scales is not None:
+                self._scales.flush()
+        self._map(capacity)
+        if len(self._src_of_row) < capacity:
+            grown = np.full(capacity, -1, dtype=np.int32)
+            grown[:len(self._src_of_row)] = self._src_of_row
+            self._src_of_row = grown
+
+    def _src(self, conn: sqlite3.Connection, name: str) -> int:
+        src = self._sources.get(name)
+        if src is None:
+            conn.execute("INSERT OR IGNORE INTO sources (name) VALUES (?)", (name,))
+            src = conn.execute("SELECT src FROM sources WHERE name = ?", (name,)).fetchone()[0]
+            self._sources[name] = src
+        return src
+
+    # -- cuantización
+
+    def _encode(self, vecs: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        vecs = _normalize(np.asarray(vecs, dtype=np.float32))
+        if self.quant == "binary":
+            return np.packbits(vecs > 0, axis=1), None
+        scales = np.abs(vecs).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vecs / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    # -- escritura
+
+    def add(self, ids: Sequence[str], vectors: Sequence[Sequence[float]], sources: Sequence[str]) -> int:
+        """
+        Añade (o reemplaza) chunks con su vector float y su fuente. La
+        dimensión queda fijada con el primer vector.
+        """
+        if not ids:
+            return 0
+        arr = np.asarray(vectors, dtype=np.float32)
+        if arr.ndim != 2 or arr.shape[0] != len(ids):
+            raise ValueError("ids y vectores no cuadran")
+        with self._lock, self._writer() as conn:
+            if self.dim is None:
+                self.dim = int(arr.shape[1])
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                     [("dim", str(self.dim)), ("quant", self.quant)])
+                self._map(_MIN_CAPACITY)
+            elif arr.shape[1] != self.dim:
+                raise ValueError(f"Dimensión {arr.shape[1]} distinta de la del índice compacto ({self.dim})")
+
+            codes, scales = self._encode(arr)
+            try:
+                with conn:
+                    self._delete_ids(conn, ids)
+                    rows: List[int] = []
+                    for _ in ids:
+                        if self._free:
+                            rows.append(self._free.pop())
+                        else:
+                            rows.append(self._rows)
+                            self._rows += 1
+                    self._ensure_capacity(self._rows)
+                    srcs = [self._src(conn, s) for s in sources]
+                    idx = np.asarray(rows)
+                    # primero el vector y luego la fila: si algo falla a medias, la fila sigue libre
+                    self._codes[idx] = codes
+                    if scales is not None:
+                        self._scales[idx] = scales
+                    conn.executemany("INSERT INTO rows (row, id, src) VALUES (?, ?, ?)", zip(rows, ids, srcs))
+                self._src_of_row[idx] = srcs
+            except Exception:
+                # la transacción se deshizo: el estado en memoria se recarga de SQLite
+                self._forget()
+                raise
+        return len(ids)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        if not ids:
+            return
+        with self._lock, self._writer() as conn:
+            try:
+                with conn:
+                    self._delete_ids(conn, ids)
+            except Exception:
+                self._forget()
+                raise
+
+    def _delete_ids(self, conn: sqlite3.Connection, ids: Sequence[str]) -> None:
+        for start in range(0, len(ids), 500):
+            part = list(ids[start:start + 500])
+            marks = ",".join("?" * len(part))
+            rows = [r[0] for r in conn.execute(f"SELECT row FROM rows WHERE id IN ({marks})", part)]
+            if not rows:
+                continue
+            conn.execute(f"DELETE FROM rows WHERE id IN ({marks})", part)
+            self._src_of_row[rows] = -1
+            self._free.extend(rows)
+
+    # -- búsqueda
+
+    def search(
+        self, qvecs: Sequence[Sequence[float]], k: int, source: Optional[str] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Barrido aproximado: por cada vector de consulta, los k (id, similitud
+        estimada) mejores, de mayor a menor. source filtra por fuente.
+        """
+        with self._lock:
+            conn = self._fresh()
+            n = self._rows
+            if self.dim is None or n == 0 or k <= 0:
+                return [[] for _ in qvecs]
+            live = self._src_of_row[:n] >= 0
+            if source:
+                src = self._sources.get(source)
+                if src is None:
+                    return [[] for _ in qvecs]
+                live &= self._src_of_row[:n] == src
+            q = _normalize(np.asarray(qvecs, dtype=np.float32))
+            scores = np.empty((n, len(q)), dtype=np.float32)
+            if self.quant == "binary":
+                qbits = np.packbits(q > 0, axis=1)
+            step = max(64, _SCAN_BLOCK_BYTES // (4 * self.dim))
+            buf = np.empty((step, self.dim), dtype=np.float32) if self.quant == "int8" else None
+            for start in range(0, n, step):
+                end = min(n, start + step)
+                block = self._codes[start:end]
+                if self.quant == "int8":
+                    fb = buf[:end - start]
+                    np.copyto(fb, block, casting="unsafe")
+                    np.matmul(fb, q.T, out=scores[start:end])
+                    scores[start:end] *= self._scales[start:end, None]
+                else:
+                    for j, bits in enumerate(qbits):
+                        ham = _POPCOUNT[np.bitwise_xor(block, bits)].sum(axis=1, dtype=np.int32)
+                        scores[start:end, j] = 1.0 - 2.0 * ham / self.dim
+            scores[~live] = -np.inf
+
+            k = min(k, int(live.sum()))
+            if k == 0:
+                return [[] for _ in qvecs]
+            picked: List[np.ndarray] = []
+            for j in range(len(q)):
+                col = scores[:, j]
+                top = np.argpartition(-col, k - 1)[:k] if k < n else np.arange(n)
+                top = top[np.argsort(-col[top])]
+                picked.append(top[np.isfinite(col[top])])
+            wanted = sorted({int(r) for top in picked for r in top})
+            names: Dict[int, str] = {}
+            for start in range(0, len(wanted), 500):
+                part = wanted[start:start + 500]
+                marks = ",".join("?" * len(part))
+                names.update(conn.execute(f"SELECT row, id FROM rows WHERE row IN ({marks})", part).fetchall())
+        return [[(names[int(r)], float(scores[r, j])) for r in top if int(r) in names]
+                for j, top in enumerate(picked)]
+
+    # -- mantenimiento
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            return {r[0] for r in self._fresh().execute("SELECT id FROM rows")}
+
+    def count(self) -> int:
+        with self._lock:
+            self._fresh()
+            return int((self._src_of_row[:self._rows] >= 0).sum())
+
+    def stats(self) -> Dict[str, int | str | None]:
+        # tamaño en disco (vectores + escalas + SQLite) y bytes por chunk
+        with self._lock:
+            self._fresh()
+            files = [p for p in self.path.iterdir() if p.is_file()]
+            disk = sum(p.stat().st_size for p in files)
+            vector_bytes = self._width() + (4 if self.quant == "int8" else 0) if self.dim else 0
+            count = int((self._src_of_row[:self._rows] >= 0).sum())
+        return {"quant": self.quant, "dim": self.dim, "count": count,
+                "vector_bytes_per_chunk": vector_bytes, "disk_bytes": disk}
+
+    def sync_with_collection(self, col, batch_size: int = 1000) -> Dict[str, int]:
+        """
+        Pone el índice al día con Chroma (corpus anterior a activar
+        COMPACT_INDEX, ingestas con el índice apagado): añade lo que falta
+        con los vectores que ya guarda Chroma y quita lo que ya no está.
+        """
+        chroma_ids = set(col.get(include=[]).get("ids") or [])
+        have = self.ids()
+        missing = [cid for cid in chroma_ids if cid not in have]
+        stale = [cid for cid in have if cid not in chroma_ids]
+        for start in range(0, len(missing), batch_size):
+            res = col.get(ids=missing[start:start + batch_size], include=["embeddings", "metadatas"])
+            self.add(res["ids"], res["embeddings"],
+                     [str((meta or {}).get("source", "")) for meta in res["metadatas"]])
+        self.delete(stale)
+        return {"added": len(missing), "removed": len(stale)}
+
+    def _forget(self) -> None:
+        # suelta ficheros y estado en memoria; el próximo _db() lo relee todo
+        for m in (self._codes, self._scales):
+            if m is not None:
+                m.flush()
+        self._codes = self._scales = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self.dim = None
+        self._src_of_row = np.empty(0, dtype=np.int32)
+        self._rows = 0
+        self._free = []
+        self._sources = {}
+        self._version = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._forget()
+
+
+compact_index = CompactIndex(default_compact_path(), settings.compact_quant)
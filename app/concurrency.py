@@ -0,0 +1,73 @@
+from __future__ import annotations
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+import httpx
+
+from app.settings import settings
+
+"""
+Piezas compartidas para no bloquear el event loop de FastAPI:
+- un pool de hilos acotado para Chroma, pypdf y demás trabajo bloqueante
+- un cliente httpx asíncrono con pool de conexiones para hablar con Ollama
+"""
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.blocking_workers),
+                thread_name_prefix="rag-blocking",
+            )
+        return _executor
+
+
+async def run_blocking(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Ejecuta fn en el pool acotado y espera el resultado sin bloquear el loop.
+    Copia el contexto (contextvars) para que el hilo vea, p. ej., el plazo de la petición.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Cliente httpx compartido (keep-alive) para todas las llamadas a Ollama.
+    Cada llamada pasa su propio timeout.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.ollama_max_connections,
+                max_keepalive_connections=settings.ollama_max_connections,
+            ),
+            timeout=httpx.Timeout(settings.llm_timeout, connect=settings.ollama_connect_timeout),
+        )
+    return _client
+
+
+async def aclose() -> None:
+    # Se llama al apagar la app (lifespan)
+    global _client, _executor
+    client, _client = _client, None
+    if client is not None:
+        await client.aclose()
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,165 @@
+from __future__ import annotations
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.settings import settings
+
+"""
+Caché persistente de embeddings: (modelo, SHA-256 del texto normalizado) ->
+vector float32 en SQLite junto a data/chroma. OllamaEmbeddings.embed la
+consulta antes de llamar a Ollama, así que las cabeceras y párrafos legales
+repetidos entre PDFs, las reingestas y una base de Chroma rehecha desde cero
+no vuelven a embeber lo ya visto. La API y app.cli comparten el archivo (WAL);
+al pasar de EMBED_CACHE_MAX_MB se borran los menos usados.
+"""
+
+# el último uso sólo se reescribe si es más viejo que esto (evita escribir en cada acierto)
+_TOUCH_EVERY_S = 3600.0
+# al pasarse del máximo se recorta hasta esta fracción
+_EVICT_TO = 0.9
+# filas escritas entre comprobaciones del tamaño
+_CHECK_EVERY = 512
+
+
+class EmbedCacheMiss(RuntimeError):
+    pass
+
+
+def default_embed_cache_path() -> Path:
+    return Path(settings.embed_cache_path or Path(settings.chroma_path).parent / "embed_cache.sqlite3")
+
+
+def text_key(text: str) -> bytes:
+    # mismo texto salvo espacios -> misma clave
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).digest()[:16]
+
+
+class EmbedCache:
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # timeout: otro proceso (la API o app.cli) puede estar escribiendo
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS vectors ("
+                    " model TEXT NOT NULL, key BLOB NOT NULL, dim INTEGER NOT NULL, vec BLOB NOT NULL,"
+                    " used REAL NOT NULL, UNIQUE (model, key))"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS vectors_by_used ON vectors(used)")
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, model: str, texts: Sequence[str]) -> Dict[int, List[float]]:
+        """
+        {posición en texts: vector} de los que están en la caché.
+        """
+        if not texts:
+            return {}
+        keys = [text_key(t) for t in texts]
+        found: Dict[bytes, bytes] = {}
+        stale: List[bytes] = []
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            uniq = list(dict.fromkeys(keys))
+            for s in range(0, len(uniq), 500):
+                part = uniq[s:s + 500]
+                rows = conn.execute(
+                    f"SELECT key, vec, used FROM vectors WHERE model = ? AND key IN ({','.join('?' * len(part))})",
+                    (model, *part),
+                ).fetchall()
+                for key, vec, used in rows:
+                    found[key] = vec
+                    if used < now - _TOUCH_EVERY_S:
+                        stale.append(key)
+            if stale:
+                with conn:
+                    conn.executemany("UPDATE vectors SET used = ? WHERE model = ? AND key = ?",
+                                     [(now, model, k) for k in stale])
+        return {i: np.frombuffer(found[k], dtype=np.float32).tolist() for i, k in enumerate(keys) if k in found}
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        if not texts:
+            return
+        now = time.time()
+        rows = []
+        for t, v in zip(texts, vectors):
+            arr = np.asarray(v, dtype=np.float32)
+            rows.append((model, text_key(t), arr.shape[0], arr.tobytes(), now))
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO vectors (model, key, dim, vec, used) VALUES (?, ?, ?, ?, ?)", rows
+                )
+            self._writes += len(rows)
+            if self._writes >= _CHECK_EVERY:
+                self._writes = 0
+                self._evict(conn)
+
+    def _used_bytes(self, conn: sqlite3.Connection) -> int:
+        # páginas ocupadas (las libres se reutilizan, el archivo no encoge)
+        pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * conn.execute("PRAGMA page_size").fetchone()[0]
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        # borra los de uso más antiguo hasta bajar del máximo
+        if self.max_bytes <= 0:
+            return 0
+        removed = 0
+        while (used := self._used_bytes(conn)) > self.max_bytes:
+            total = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+            if not total:
+                break
+            n = max(1, int(total * (1 - _EVICT_TO * self.max_bytes / used)))
+            with conn:
+                conn.execute(
+                    "DELETE FROM vectors WHERE rowid IN (SELECT rowid FROM vectors ORDER BY used LIMIT ?)", (n,)
+                )
+            removed += n
+        return removed
+
+    def evict(self) -> int:
+        with self._lock:
+            return self._evict(self._db())
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            conn = self._db()
+            models = dict(conn.execute("SELECT model, COUNT(*) FROM vectors GROUP BY model").fetchall())
+            used = self._used_bytes(conn)
+        return {"path": str(self.path), "entries": sum(models.values()), "models": models,
+                "bytes": used, "max_bytes": self.max_bytes}
+
+    def clear(self, model: Optional[str] = None) -> int:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                if model:
+                    return conn.execute("DELETE FROM vectors WHERE model = ?", (model,)).rowcount
+                return conn.execute("DELETE FROM vectors").rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+embed_cache = EmbedCache(default_embed_cache_path(), int(settings.embed_cache_max_mb * 1024 * 1024))
@@ -1,26 +1,68 @@
 from __future__ import annotations
+import asyncio
 import math
+import sqlite3
+import threading
+import httpx
 import requests
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import List, Dict, Any, Tuple
+import structlog
+from app.concurrency import get_async_client, run_blocking
+from app.embed_cache import EmbedCache, EmbedCacheMiss, embed_cache
+from app.metrics import EMBED_CACHE_EVENTS, EMBEDDED_TEXTS, timed
+from app.resilience import get_upstream, request_key
 from app.settings import settings
 
 """
 Convierte textos en vectores numericos (embeddings) usando Ollama
 """
 
+logger = structlog.get_logger()
+
 # Clase base, como una "interfaz" para los embeddings
 class EmbeddingsProvider:
-    def embed(self, texts: List[str]) -> List[List[float]]:
+    # use_cache=False: siempre al modelo (p. ej. el warm-up, que debe cargarlo)
+    def embed(self, texts: List[str], use_cache: bool = True) -> List[List[float]]:
         raise NotImplementedError
 
+    async def aembed(self, texts: List[str], use_cache: bool = True) -> List[List[float]]:
+        # por defecto: la versión síncrona en el pool de hilos
+        return await run_blocking(self.embed, texts, use_cache)
+
 # Clase que usa Ollama para generar embeddings
 class OllamaEmbeddings(EmbeddingsProvider):
-    def __init__(self, host: str, model: str, timeout: int = 180):
+    def __init__(
+        self,
+        host: str,
+        model: str,
+        timeout: float = 180,
+        batch_size: int | None = None,
+        concurrency: int | None = None,
+        cache: EmbedCache | None = None,
+    ):
         # Guardamos los datos de conexión
         self.host = host.rstrip("/")
         self.model = model
         self.timeout = timeout
+        self.batch_size = max(1, batch_size or settings.ingest_batch_size)
+        self.concurrency = max(1, concurrency or settings.embed_concurrency)
         self.session = requests.Session()
+        # el pool de conexiones debe aguantar las peticiones concurrentes del fallback
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.upstream = get_upstream("embeddings")
+        # caché persistente (app.embed_cache); con cache_only, un texto que no
+        # esté en ella es un error en vez de una llamada a Ollama
+        self.cache = cache
+        self.cache_only = False
+
+        # Lo que aprendemos del servidor: None = aún no se sabe
+        self._batch_supported: bool | None = None
+        self._payload_key: str | None = None   # "prompt" o "input" en /api/embeddings
+        self._lock = threading.Lock()
 
     def _parse_embedding_response(self, data: Dict[str, Any]) -> List[float] | None:
         # Esta función busca el embedding dentro de la respuesta de Ollama
@@ -37,36 +79,213 @@ class OllamaEmbeddings(EmbeddingsProvider):
                     return first
         return None
 
+    def _body(self, **fields: Any) -> Dict[str, Any]:
+        # cuerpo de la petición; con OLLAMA_KEEP_ALIVE el modelo no se descarga entre llamadas
+        body: Dict[str, Any] = {"model": self.model, **fields}
+        if settings.ollama_keep_alive:
+            body["keep_alive"] = settings.ollama_keep_alive
+        return body
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> requests.Response:
+        # POST con reintentos y breaker; textos idénticos en vuelo comparten la petición
+        url = f"{self.host}{path}"
+        return self.upstream.call(lambda t: self.session.post(url, json=payload, timeout=t),
+                                  self.timeout, key=request_key(url, payload))
+
     def _call_ollama(self, payload: Dict[str, Any]) -> List[float] | None:
         # Hacemos la llamada POST al servidor de Ollama
-        r = self.session.post(f"{self.host}/api/embeddings", json=payload, timeout=self.timeout)
+        r = self._post("/api/embeddings", payload)
         r.raise_for_status()
         data = r.json()
         return self._parse_embedding_response(data)
 
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        # Generamos embeddings para cada texto de la lista
-        outs: List[List[float]] = []
-        for t in texts:
-            t_norm = (t or "").strip()   # quitamos espacios
-            if not t_norm:
-                outs.append([])   #lista vacia
-                continue
-
-            # se intenta 'prompt'
-            vec = self._call_ollama({"model": self.model, "prompt": t_norm})
-
-            # se reintento con 'input'
-            if not vec:
-                vec = self._call_ollama({"model": self.model, "input": t_norm})
-
-            if not vec:
-                # si sigue sin devolver nada, error
-                raise RuntimeError(
-                    f"Ollama no devolvió embedding válido (modelo='{self.model}', len(text)={len(t_norm)})."
-                )
-            outs.append(vec)
+    def _call_ollama_batch(self, texts: List[str]) -> List[List[float]] | None:
+        # /api/embed acepta una lista en 'input' y devuelve {"embeddings": [[...], ...]}
+        r = self._post("/api/embed", self._body(input=texts))
+        if r.status_code in (404, 405, 501):
+            # servidor antiguo sin /api/embed
+            return None
+        r.raise_for_status()
+        return self._parse_batch_response(r.json(), len(texts))
+
+    @staticmethod
+    def _parse_batch_response(data: Any, n: int) -> List[List[float]] | None:
+        # {"embeddings": [[...], ...]} con n vectores no vacíos; cualquier otra cosa
+        # (una lista, un {"error": ...}) es None y se cae a /api/embeddings
+        vecs = data.get("embeddings") if isinstance(data, dict) else None
+        if not isinstance(vecs, list) or len(vecs) != n:
+            return None
+        if any(not isinstance(v, list) or not v for v in vecs):
+            return None
+        return vecs
+
+    def _embed_one(self, text: str) -> List[float]:
+        # Usamos la forma de payload que ya sabemos que funciona; si no, probamos ambas
+        keys = [self._payload_key] if self._payload_key else ["prompt", "input"]
+        for key in keys:
+            vec = self._call_ollama(self._body(**{key: text}))
+            if vec:
+                if self._payload_key is None:
+                    with self._lock:
+                        self._payload_key = key
+                return vec
+        raise RuntimeError(
+            f"Ollama no devolvió embedding válido (modelo='{self.model}', len(text)={len(text)})."
+        )
+
+    def _embed_single_requests(self, texts: List[str]) -> List[List[float]]:
+        # Fallback: una petición por texto, con concurrencia acotada
+        if len(texts) == 1 or self.concurrency == 1:
+            return [self._embed_one(t) for t in texts]
+        if self._payload_key is None:
+            # el primero descubre la forma del payload, el resto ya no repite el intento
+            first = self._embed_one(texts[0])
+            rest = texts[1:]
+        else:
+            first = None
+            rest = texts
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(rest))) as pool:
+            outs = list(pool.map(self._embed_one, rest))
+        return [first, *outs] if first is not None else outs
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self._batch_supported is not False:
+            vecs = self._call_ollama_batch(texts)
+            if vecs is not None:
+                self._batch_supported = True
+                return vecs
+            if self._batch_supported is None:
+                self._batch_supported = False
+        return self._embed_single_requests(texts)
+
+    def _plan(self, texts: List[str], use_cache: bool = True) -> Tuple[List[List[float]], Dict[str, List[int]]]:
+        """
+        Común a embed y aembed: normaliza, rellena con la caché persistente
+        lo que ya tenga y agrupa los textos que faltan (los repetidos dentro
+        de la llamada, una vez cada uno). Devuelve (outs, texto -> posiciones).
+        Con cache_only, lo que falte es EmbedCacheMiss. Bloqueante (SQLite).
+        """
+        # Normalizamos y apartamos los textos vacíos
+        norm = [(t or "").strip() for t in texts]
+        outs: List[List[float]] = [[] for _ in norm]
+        pending = [i for i, t in enumerate(norm) if t]
+        if self.cache is not None and use_cache and pending:
+            try:
+                hits = self.cache.get_many(self.model, [norm[i] for i in pending])
+            except sqlite3.Error as e:
+                logger.warning("embed_cache.error", extra={"err": str(e)})
+                hits = {}
+            EMBED_CACHE_EVENTS.labels(outcome="hit").inc(len(hits))
+            EMBED_CACHE_EVENTS.labels(outcome="miss").inc(len(pending) - len(hits))
+            for j, vec in hits.items():
+                outs[pending[j]] = vec
+            pending = [i for j, i in enumerate(pending) if j not in hits]
+        if pending and self.cache_only:
+            raise EmbedCacheMiss(f"{len(pending)} textos sin embedding en la caché (modelo='{self.model}')")
+
+        # textos repetidos dentro de la llamada (cabeceras, avisos legales): una vez cada uno
+        todo: Dict[str, List[int]] = {}
+        for i in pending:
+            todo.setdefault(norm[i], []).append(i)
+        EMBEDDED_TEXTS.inc(len(todo))
+        return outs, todo
+
+    @staticmethod
+    def _assign(todo: Dict[str, List[int]], outs: List[List[float]], batch: List[str], vecs: List[List[float]]) -> None:
+        for t, v in zip(batch, vecs):
+            for i in todo[t]:
+                outs[i] = v
+
+    def _remember(self, texts: List[str], vecs: List[List[float]]) -> None:
+        good = [(t, v) for t, v in zip(texts, vecs) if v]
+        try:
+            self.cache.put_many(self.model, [t for t, _ in good], [v for _, v in good])
+        except sqlite3.Error as e:
+            # la caché es sólo un atajo: si falla, el embedding sigue siendo válido
+            logger.warning("embed_cache.error", extra={"err": str(e)})
+
+    def embed(self, texts: List[str], use_cache: bool = True) -> List[List[float]]:
+        outs, todo = self._plan(texts, use_cache)
+        uniq = list(todo)
+
+        # Generamos embeddings por lotes de batch_size
+        with timed("embed"):
+            for start in range(0, len(uniq), self.batch_size):
+                batch = uniq[start:start + self.batch_size]
+                vecs = self._embed_batch(batch)
+                self._assign(todo, outs, batch, vecs)
+                if self.cache is not None and use_cache:
+                    self._remember(batch, vecs)
+
+        return self._validate(outs)
+
+    # Versión asíncrona: mismo protocolo, cliente httpx compartido
+
+    async def _apost(self, path: str, payload: Dict[str, Any]) -> httpx.Response:
+        client = get_async_client()
+        url = f"{self.host}{path}"
+        return await self.upstream.acall(
+            lambda t: client.post(url, json=payload,
+                                  timeout=httpx.Timeout(t, connect=min(settings.ollama_connect_timeout, t))),
+            self.timeout,
+            key=request_key(url, payload),
+        )
+
+    async def _aembed_one(self, text: str) -> List[float]:
+        keys = [self._payload_key] if self._payload_key else ["prompt", "input"]
+        for key in keys:
+            r = await self._apost("/api/embeddings", self._body(**{key: text}))
+            r.raise_for_status()
+            vec = self._parse_embedding_response(r.json())
+            if vec:
+                self._payload_key = self._payload_key or key
+                return vec
+        raise RuntimeError(
+            f"Ollama no devolvió embedding válido (modelo='{self.model}', len(text)={len(text)})."
+        )
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self._batch_supported is not False:
+            r = await self._apost("/api/embed", self._body(input=texts))
+            if r.status_code not in (404, 405, 501):
+                r.raise_for_status()
+                vecs = self._parse_batch_response(r.json(), len(texts))
+                if vecs is not None:
+                    self._batch_supported = True
+                    return vecs
+            if self._batch_supported is None:
+                self._batch_supported = False
+
+        # Fallback con concurrencia acotada
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(t: str) -> List[float]:
+            async with sem:
+                return await self._aembed_one(t)
+
+        if self._payload_key is None:
+            first = await self._aembed_one(texts[0])
+            return [first, *await asyncio.gather(*(one(t) for t in texts[1:]))]
+        return list(await asyncio.gather(*(one(t) for t in texts)))
+
+    async def aembed(self, texts: List[str], use_cache: bool = True) -> List[List[float]]:
+        # la caché es SQLite: sus lecturas y escrituras van al pool de hilos
+        if self.cache is not None and use_cache:
+            outs, todo = await run_blocking(self._plan, texts, use_cache)
+        else:
+            outs, todo = self._plan(texts, use_cache)
+        uniq = list(todo)
+        with timed("embed"):
+            for start in range(0, len(uniq), self.batch_size):
+                batch = uniq[start:start + self.batch_size]
+                vecs = await self._aembed_batch(batch)
+                self._assign(todo, outs, batch, vecs)
+                if self.cache is not None and use_cache:
+                    await run_blocking(self._remember, batch, vecs)
+        return self._validate(outs)
 
+    @staticmethod
+    def _validate(outs: List[List[float]]) -> List[List[float]]:
         # Validamos que no haya embeddings vacíos
 
         if not outs or any((not v) for v in outs):
@@ -82,7 +301,8 @@ class OllamaEmbeddings(EmbeddingsProvider):
 
 def get_embeddings() -> EmbeddingsProvider:
     if settings.embeddings_provider.lower() == "ollama":
-        return OllamaEmbeddings(settings.ollama_host, settings.ollama_embed_model)
+        return OllamaEmbeddings(settings.ollama_host, settings.ollama_embed_model, timeout=settings.embed_timeout,
+                                cache=embed_cache if settings.embed_cache else None)
     raise NotImplementedError(f"Embeddings provider '{settings.embeddings_provider}' no implementado")
 
 
@@ -97,4 +317,4 @@ def cosine_sim(a: List[float], b: List[float]) -> float:
     na = math.sqrt(sum(x * x for x in a))
     nb = math.sqrt(sum(y * y for y in b))
     # si alguno es 0 devolvemos 0, sino hacemos la división
-    return 0.0 if na == 0 or nb == 0 else dot / (na * nb)
\ No newline at end of file
+    return 0.0 if na == 0 or nb == 0 else dot / (na * nb)
@@ -1,14 +1,25 @@
 from __future__ import annotations
 from pathlib import Path
-from typing import List, Dict, Any
-import re
-import unicodedata
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Dict, Any, Optional
 
-from pypdf import PdfReader
+import structlog
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from app.settings import settings
-from app.retriever import get_collection
+from app.retriever import collection_handle, get_collection
+from app.cache import invalidate_source
+from app.compact import compact_index
+from app.lexical import lexical_index
+from app.metrics import CHUNKS, observe, timed
+from app.pdf_extract import iter_pdf_texts, sanitize_text
+from app.pipeline import PipelineAborted, run_pipeline
+from app.rerank import chunk_features
+from app.shards import SOURCE
+from app.uploads import hash_file
+
+logger = structlog.get_logger()
 
 """
 ingesta de documentos PDF en el sistema RAG.
@@ -18,86 +29,356 @@ def _hash_bytes(b: bytes) -> str:
     import hashlib
     return hashlib.sha256(b).hexdigest()[:16]
 
-# Limpia el texto para evitar caracteres raros
-def _sanitize_text(s: str) -> str:
-    if not s:
-        return ""
-    # Normaliza caracteres a forma estándar
-    s = unicodedata.normalize("NFKC", s)
-    # Elimina surrogates no emparejados y NULs
-    s = re.sub(r"[\ud800-\udfff]", "", s)
-    s = s.replace("\x00", "")
-    # Quita la mayoría de control chars pero mantiene saltos y tabs
-    s = "".join(c for c in s if c.isprintable() or c in "\n\t ")
-    return s.strip()
+# Limpia el texto para evitar caracteres raros (ver app.pdf_extract)
+_sanitize_text = sanitize_text
+
+def page_count(pdf_path: Path) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(str(pdf_path)).pages)
 
 # Lee un PDF y devuelve lista de páginas con su número y texto
 def load_pdf_texts(pdf_path: Path) -> List[dict]:
-    reader = PdfReader(str(pdf_path))
-    pages: List[dict] = []
-    for i, page in enumerate(reader.pages, start=1):
-        # texto crudo de la página
-        raw = page.extract_text() or ""
-        # limpiamos el texto
-        text = _sanitize_text(raw)
-        pages.append({"page": i, "text": text})
-    return pages
-
-
-def chunk_pages(pages: List[dict]) -> List[dict]:
+    return list(iter_pdf_texts(pdf_path))
+
+
+def iter_chunks(pages: Iterable[dict]) -> Iterator[dict]:
+    """
+    Trocea las páginas según llegan, sin acumular el documento entero.
+    """
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=settings.chunk_size,
         chunk_overlap=settings.chunk_overlap,
         separators=["\n\n", "\n", ". ", ".", " "],
     )
-    chunks: List[dict] = []
     for p in pages:
         if not p["text"]:
             continue
         parts = splitter.split_text(p["text"])
         for idx, c in enumerate(parts):
-            c = _sanitize_text(c)
+            # las páginas ya vienen limpias: basta con recortar espacios
+            c = c.strip()
             if c:
-                chunks.append({"page": p["page"], "text": c, "chunk": idx})
-    return chunks
+                yield {"page": p["page"], "text": c, "chunk": idx}
 
 
-def ingest_pdf(pdf_path: Path, source_name: str | None = None) -> Dict[str, Any]:
-    source_name = source_name or pdf_path.name
-    raw = pdf_path.read_bytes()
-    file_hash = _hash_bytes(raw)
+def chunk_pages(pages: Iterable[dict]) -> List[dict]:
+    return list(iter_chunks(pages))
+
+
+def _existing_chunks(col, source_name: str) -> Dict[str, Any]:
+    # IDs y metadatos de lo que ya hay guardado para esta fuente (sin documentos ni vectores)
+    where = collection_handle.source_filter(source_name)
+    res = col.get(where=where, include=["metadatas"]) if where else col.get(include=["metadatas"])
+    return {"ids": res.get("ids") or [], "metas": res.get("metadatas") or []}
+
+
+def _is_unchanged(existing: Dict[str, Any], file_hash: str) -> bool:
+    # mismo archivo y la última ingesta terminó (marca count_hash con el total de chunks)
+    metas = [m or {} for m in existing["metas"]]
+    if not metas or any(m.get("file_hash") != file_hash for m in metas):
+        return False
+    return any(m.get("count_hash") == file_hash and m.get("chunk_count") == len(metas) for m in metas)
+
+
+def find_ingested(file_hash: str, source_name: str) -> Optional[str]:
+    """
+    Fuente que ya tiene este archivo ingerido por completo: source_name si
+    no cambió, u otra fuente con el mismo contenido; None si no hay.
+    Sólo lee metadatos, sin abrir el PDF.
+    """
+    if _is_unchanged(_existing_chunks(collection_handle.view(source_name), source_name), file_hash):
+        return source_name
+    if collection_handle.sharded:
+        others = collection_handle.sources_with_hash(file_hash)
+    else:
+        # la marca count_hash está en un solo chunk por fuente terminada
+        res = get_collection().get(where={"count_hash": {"$eq": file_hash}}, include=["metadatas"], limit=5)
+        others = [(meta or {}).get("source") for meta in res.get("metadatas") or []]
+    for other in others:
+        if not other or other == source_name:
+            continue
+        if _is_unchanged(_existing_chunks(collection_handle.view(other), other), file_hash):
+            return other
+    return None
+
+
+def delete_source(source_name: str) -> Dict[str, Any]:
+    """
+    Quita una fuente de Chroma y de los índices BM25 y compacto. Con
+    SHARD_MODE=source se borra su colección entera.
+    """
+    ids = _existing_chunks(collection_handle.view(source_name), source_name)["ids"]
+    collection_handle.delete_source(source_name, ids)
+    lexical_index.delete(ids)
+    if settings.compact_index:
+        compact_index.delete(ids)
+    invalidate_source(source_name)
+    CHUNKS.labels(event="ingest_removed").inc(len(ids))
+    return {"source": source_name, "removed_chunks": len(ids), "collection_count": collection_handle.count()}
+
 
-    pages = load_pdf_texts(pdf_path)
-    chunks = chunk_pages(pages)
+class _IngestPlan:
+    """
+    Estado de la comparación por hash de contenido mientras los chunks
+    pasan por el pipeline: decide qué se reutiliza y qué hay que embeber.
+    """
 
-    col = get_collection()
+    def __init__(self, existing: Dict[str, Any], source_name: str, file_hash: str, batch_size: int):
+        self.source_name = source_name
+        self.file_hash = file_hash
+        # prefijo de los IDs nuevos: el mismo PDF con otro nombre (force) no pisa los chunks del primero
+        self.id_prefix = _hash_bytes(f"{source_name}\0{file_hash}".encode("utf-8"))
+        self.batch_size = max(1, batch_size)
+        self.existing_ids = existing["ids"]
+        self.by_id = set(existing["ids"])
+        # chunk_hash -> IDs guardados con ese contenido (puede repetirse en el documento)
+        self.by_hash: Dict[str, List[str]] = {}
+        for cid, m in zip(existing["ids"], existing["metas"]):
+            h = (m or {}).get("chunk_hash")
+            if h:
+                self.by_hash.setdefault(h, []).append(cid)
+        self.kept: set[str] = set()
+        # metadatos nuevos de los reutilizados: se aplican al confirmar la ingesta
+        self.kept_metas: List[tuple[str, Dict[str, Any]]] = []
+        self.added_ids: List[str] = []
+        self.pages = 0
+        self.chunks = 0
+        self.extract_s = 0.0
+        self.first_id: str | None = None
 
-    if not chunks:
-        # si no hay texto, puede ser PDF escaneado sin OCR
+    def count_pages(self, pages: Iterable[dict]) -> Iterator[dict]:
+        # cuenta las páginas y el tiempo que se pasa esperando al extractor
+        it = iter(pages)
+        while True:
+            t0 = time.perf_counter()
+            p = next(it, None)
+            self.extract_s += time.perf_counter() - t0
+            if p is None:
+                return
+            self.pages += 1
+            yield p
+
+    def batches(self, chunks: Iterable[dict]) -> Iterator[Dict[str, list]]:
+        # agrupa en lotes de batch_size: "new" hay que embeberlos, "keep" sólo actualizar metadatos
+        batch: Dict[str, list] = {"new": [], "keep": []}
+        for c in chunks:
+            self.chunks += 1
+            h = _hash_bytes(c["text"].encode("utf-8"))
+            meta = {
+                "source": self.source_name,
+                "page": c["page"],
+                "chunk": c["chunk"],
+                "file_hash": self.file_hash,
+                "chunk_hash": h,
+                # rasgos para el re-ranking (app.rerank), calculados una sola vez
+                **chunk_features(c["text"]),
+            }
+            reuse = self.by_hash.get(h)
+            if reuse:
+                # mismo contenido: sólo actualizamos página/posición, sin re-embeber
+                cid = reuse.pop()
+                self.kept.add(cid)
+                batch["keep"].append((cid, meta))
+            else:
+                cid = f"{self.id_prefix}:{c['page']}:{c['chunk']}"
+                if cid in self.by_id:
+                    cid = f"{cid}:{h}"
+                batch["new"].append((cid, c["text"], meta))
+            if self.first_id is None:
+                self.first_id = cid
+            if len(batch["new"]) >= self.batch_size or len(batch["keep"]) >= self.batch_size:
+                yield batch
+                batch = {"new": [], "keep": []}
+        if batch["new"] or batch["keep"]:
+            yield batch
+
+    def stale_ids(self) -> List[str]:
+        return [cid for cid in self.existing_ids if cid not in self.kept]
+
+
+class IngestCancelled(Exception):
+    pass
+
+
+def ingest_pdf(
+    pdf_path: Path,
+    source_name: str | None = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    stop: Optional[threading.Event] = None,
+    file_hash: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Ingesta incremental y en streaming:
+    - si el archivo (file_hash) no cambió, no se hace nada;
+    - si cambió, páginas -> chunks -> lotes de embeddings -> escrituras en
+      Chroma fluyen por un pipeline con colas acotadas; sólo se embeben los
+      chunks nuevos (comparando por hash de contenido) y al final se borran
+      los que ya no están.
+    progress recibe {"pages_total", "pages", "chunks", "embedded"} tras cada
+    lote escrito. Si falla o se cancela (stop -> IngestCancelled) antes de
+    publicarse, se deshace lo añadido y la versión anterior queda intacta. file_hash es el calculado al subir el archivo; sin él
+    se calcula leyendo el archivo por trozos.
+    """
+    t_start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    source_name = source_name or pdf_path.name
+    with timed("ingest_hash", timings):
+        file_hash = file_hash or hash_file(pdf_path)
+
+    current = collection_handle.view(source_name)
+    with timed("ingest_lookup", timings):
+        existing = _existing_chunks(current, source_name)
+
+    if _is_unchanged(existing, file_hash):
+        observe("ingest_total", time.perf_counter() - t_start, timings)
         return {
             "file_hash": file_hash,
             "source": source_name,
+            "skipped": True,
             "added_chunks": 0,
-            "collection_count": col.count(),
-            "note": "El PDF no tiene texto extraíble (¿escaneado sin OCR?) o todo quedó vacío tras limpieza.",
+            "kept_chunks": len(existing["ids"]),
+            "removed_chunks": 0,
+            "collection_count": collection_handle.count(),
+            "timings": timings,
         }
 
-    # Borra lo anterior de esta misma fuente para evitar duplicados
-    col.delete(where={"source": {"$eq": source_name}})
+    plan = _IngestPlan(existing, source_name, file_hash, settings.ingest_batch_size)
+    embedder = collection_handle.embedder
+    pages_total = page_count(pdf_path) if progress else None
+    # con SHARD_MODE=source se escribe en una colección nueva que sustituye a la actual al terminar
+    col = collection_handle.writable(source_name)
+    in_place = collection_handle.shard_mode != SOURCE
+    published = False
+
+    def report() -> None:
+        if progress:
+            progress({
+                "pages_total": pages_total,
+                "pages": plan.pages,
+                "chunks": plan.chunks,
+                "embedded": len(plan.added_ids),
+            })
+
+    def embed(batch: Dict[str, list]) -> Dict[str, list]:
+        if batch["new"]:
+            batch["vectors"] = embedder.embed([t for _, t, _ in batch["new"]])
+        return batch
+
+    def write(batch: Dict[str, list]) -> None:
+        if batch["new"]:
+            col.upsert(
+                ids=[cid for cid, _, _ in batch["new"]],
+                documents=[t for _, t, _ in batch["new"]],
+                metadatas=[m for _, _, m in batch["new"]],
+                embeddings=batch["vectors"],
+            )
+            plan.added_ids.extend(cid for cid, _, _ in batch["new"])
+            # índice BM25 para la búsqueda híbrida, a la par que Chroma
+            lexical_index.add((cid, t, source_name) for cid, t, _ in batch["new"])
+            if settings.compact_index:
+                compact_index.add([cid for cid, _, _ in batch["new"]], batch["vectors"],
+                                  [source_name] * len(batch["new"]))
+        if batch["keep"]:
+            ids = [cid for cid, _ in batch["keep"]]
+            metas = [m for _, m in batch["keep"]]
+            if in_place:
+                # la versión anterior sigue siendo la buena hasta el final
+                plan.kept_metas.extend(batch["keep"])
+            else:
+                # se copian de la colección anterior con sus vectores: nada que re-embeber
+                old = current.get(ids=ids, include=["documents", "embeddings"])
+                pos = {cid: j for j, cid in enumerate(old["ids"])}
+                col.add(ids=ids, documents=[old["documents"][pos[cid]] for cid in ids],
+                        embeddings=[old["embeddings"][pos[cid]] for cid in ids], metadatas=metas)
+        report()
+
+    def rollback() -> None:
+        # quita lo que se llegó a añadir; un fallo aquí no tapa el error original
+        if not plan.added_ids:
+            return
+        try:
+            if in_place:
+                col.delete(ids=plan.added_ids)
+            lexical_index.delete(plan.added_ids)
+            if settings.compact_index:
+                compact_index.delete(plan.added_ids)
+        except Exception:
+            logger.exception("ingest.rollback_failed", extra={"source": source_name, "ids": len(plan.added_ids)})
+
+    try:
+        # las páginas van pasando al splitter según se extraen
+        chunks = iter_chunks(plan.count_pages(iter_pdf_texts(pdf_path)))
+        try:
+            stats = run_pipeline(
+                ("chunk", plan.batches(chunks)),
+                [("embed", embed)],
+                ("write", write),
+                queue_size=settings.ingest_queue_depth,
+                stop=stop,
+            )
+        except PipelineAborted:
+            raise IngestCancelled(f"Ingesta de '{source_name}' cancelada")
+
+        # tiempos de las etapas del pipeline: la fuente incluye extracción + troceo
+        observe("ingest_extract", plan.extract_s, timings)
+        observe("ingest_chunk", max(0.0, stats["chunk"]["busy_s"] - plan.extract_s), timings)
+        observe("ingest_embed", stats["embed"]["busy_s"], timings)
+        observe("ingest_write", stats["write"]["busy_s"], timings)
 
-    ids = [f"{file_hash}:{c['page']}:{c['chunk']}" for c in chunks]
-    texts = [c["text"] for c in chunks]
-    metadatas = [
-        {"source": source_name, "page": c["page"], "chunk": c["chunk"], "file_hash": file_hash}
-        for c in chunks
-    ]
+        if not plan.chunks:
+            # si no hay texto, puede ser PDF escaneado sin OCR
+            observe("ingest_total", time.perf_counter() - t_start, timings)
+            return {
+                "file_hash": file_hash,
+                "source": source_name,
+                "added_chunks": 0,
+                "collection_count": collection_handle.count(),
+                "note": "El PDF no tiene texto extraíble (¿escaneado sin OCR?) o todo quedó vacío tras limpieza.",
+                "timings": timings,
+            }
 
-    # Guardamos en la colección
-    col.add(ids=ids, documents=texts, metadatas=metadatas)
+        with timed("ingest_cleanup", timings):
+            # página/posición nuevas de los chunks reutilizados
+            for start in range(0, len(plan.kept_metas), plan.batch_size):
+                part = plan.kept_metas[start:start + plan.batch_size]
+                col.update(ids=[cid for cid, _ in part], metadatas=[m for _, m in part])
+            # Borra los chunks que ya no existen en la nueva versión
+            stale_ids = plan.stale_ids()
+            if stale_ids:
+                if in_place:
+                    col.delete(ids=stale_ids)
+                lexical_index.delete(stale_ids)
+                if settings.compact_index:
+                    compact_index.delete(stale_ids)
+            # marca de ingesta completa: permite saltarse el próximo upload idéntico
+            col.update(ids=[plan.first_id], metadatas=[{"chunk_count": plan.chunks, "count_hash": file_hash}])
+            collection_handle.publish(source_name, col, file_hash, plan.chunks)
+            published = True
+    except BaseException:
+        # cancelada o fallida (también Ctrl+C o el cierre del proceso)
+        if not published:
+            rollback()
+        raise
+    finally:
+        if not published:
+            # cancelada, fallida o sin texto: la colección nueva (modo source) sobra
+            collection_handle.abandon(col)
+        # los resultados cacheados de /chat para esta fuente ya no valen
+        invalidate_source(source_name)
 
+    observe("ingest_total", time.perf_counter() - t_start, timings)
+    CHUNKS.labels(event="ingest_added").inc(len(plan.added_ids))
+    CHUNKS.labels(event="ingest_kept").inc(len(plan.kept))
+    CHUNKS.labels(event="ingest_removed").inc(len(stale_ids))
     return {
         "file_hash": file_hash,
         "source": source_name,
-        "added_chunks": len(texts),
-        "collection_count": col.count(),
+        "skipped": False,
+        "pages": plan.pages,
+        "added_chunks": len(plan.added_ids),
+        "kept_chunks": len(plan.kept),
+        "removed_chunks": len(stale_ids),
+        "collection_count": collection_handle.count(),
+        "pipeline": stats,
+        "timings": timings,
     }
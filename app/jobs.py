@@ -0,0 +1,308 @@
+from __future__ import annotations
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import structlog
+
+from app.settings import settings
+
+"""
+Cola de trabajos de ingesta en segundo plano: /ingest devuelve un job_id
+al momento y un pool de workers procesa los PDFs. El estado se guarda en
+SQLite junto a data/chroma, así que sobrevive a reinicios.
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = {DONE, FAILED, CANCELLED}
+
+logger = structlog.get_logger()
+
+
+def default_jobs_path() -> Path:
+    return Path(settings.jobs_db_path or Path(settings.chroma_path).parent / "jobs.sqlite3")
+
+
+class JobStore:
+    _COLUMNS = (
+        "id", "source", "path", "status", "created_at", "started_at", "finished_at",
+        "pages_total", "pages", "chunks", "embedded", "error", "result", "owner_pid", "cancel_requested",
+        "file_hash",
+    )
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # timeout: otro proceso (app.cli) puede estar escribiendo
+        self._conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    pages_total INTEGER,
+                    pages INTEGER DEFAULT 0,
+                    chunks INTEGER DEFAULT 0,
+                    embedded INTEGER DEFAULT 0,
+                    error TEXT,
+                    result TEXT,
+                    owner_pid INTEGER,
+                    cancel_requested INTEGER DEFAULT 0,
+                    file_hash TEXT
+                )
+                """
+            )
+            # bases creadas antes de que existieran estas columnas
+            cols = {r[1] for r in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "owner_pid" not in cols:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+            if "cancel_requested" not in cols:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER DEFAULT 0")
+            if "file_hash" not in cols:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN file_hash TEXT")
+
+    def create(self, source: str, path: Path, file_hash: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, source, path, status, created_at, file_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, source, str(path), QUEUED, time.time(), file_hash),
+            )
+        return job_id
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        if "result" in fields and fields["result"] is not None:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id: str) -> bool:
+        # QUEUED -> RUNNING de forma atómica: sólo un worker (de cualquier proceso) se lo queda
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, owner_pid = ?, error = NULL"
+                " WHERE id = ? AND status = ? AND cancel_requested = 0",
+                (RUNNING, time.time(), os.getpid(), job_id, QUEUED),
+            )
+        return cur.rowcount == 1
+
+    def request_cancel(self, job_id: str) -> bool:
+        # marca la cancelación; si aún estaba en cola se cancela directamente
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN (?, ?)", (job_id, QUEUED, RUNNING)
+            )
+            if cur.rowcount:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                    (CANCELLED, time.time(), job_id, QUEUED),
+                )
+        return cur.rowcount == 1
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, limit: int = 50, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM jobs"
+        args: tuple = ()
+        if status:
+            sql += " WHERE status = ?"
+            args = (status,)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, (*args, limit)).fetchall()
+        return [self._to_dict(r) for r in rows]
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+        return [self._to_dict(r) for r in rows]
+
+    def find_active(self, file_hash: str, source: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # trabajo en cola o en curso con el mismo archivo (y la misma fuente, si se indica)
+        sql = "SELECT * FROM jobs WHERE file_hash = ? AND status IN (?, ?) AND cancel_requested = 0"
+        args: tuple = (file_hash, QUEUED, RUNNING)
+        if source is not None:
+            sql += " AND source = ?"
+            args += (source,)
+        with self._lock:
+            row = self._conn.execute(sql + " ORDER BY created_at LIMIT 1", args).fetchone()
+        return self._to_dict(row) if row else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        d = dict(row)
+        if d.get("result"):
+            d["result"] = json.loads(d["result"])
+        # ETA aproximada a partir de las páginas procesadas
+        d["eta_s"] = None
+        if d["status"] == RUNNING and d.get("started_at") and d.get("pages_total") and d.get("pages"):
+            elapsed = time.time() - d["started_at"]
+            d["eta_s"] = round(elapsed / d["pages"] * max(0, d["pages_total"] - d["pages"]), 1)
+        return d
+
+
+class JobManager:
+    def __init__(self, path: Path, concurrency: int):
+        self.path = Path(path)
+        self.store: Optional[JobStore] = None
+        self.concurrency = max(1, concurrency)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stops: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._shutting_down = False
+
+    def start(self) -> int:
+        """
+        Arranca los workers y re-encola lo que quedó a medias en el último
+        apagado. Devuelve cuántos trabajos se retomaron.
+        """
+        self._shutting_down = False
+        if self.store is None:
+            self.store = JobStore(self.path)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ingest-job")
+        pending = [j for j in self.store.unfinished() if j["status"] == QUEUED or not _alive(j.get("owner_pid"))]
+        for job in pending:
+            if job["status"] == RUNNING:
+                # su proceso murió a medias: vuelve a la cola
+                self.store.update(job["id"], status=QUEUED, owner_pid=None)
+            self._schedule(job["id"])
+        return len(pending)
+
+    def submit(self, path: Path, source: str, file_hash: Optional[str] = None) -> str:
+        job_id = self.store.create(source, path, file_hash)
+        self._schedule(job_id)
+        return job_id
+
+    def _schedule(self, job_id: str) -> None:
+        with self._lock:
+            self._stops[job_id] = threading.Event()
+        if self._executor is None:
+            raise RuntimeError("JobManager no arrancado")
+        self._executor.submit(self._run, job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        # el trabajo puede estar corriendo en otro worker: éste lo verá en la base
+        if not self.store.request_cancel(job_id):
+            return False
+        with self._lock:
+            ev = self._stops.get(job_id)
+        if ev:
+            ev.set()
+        return True
+
+    def _run(self, job_id: str) -> None:
+        # import diferido: la pila de ingesta (pypdf, splitter) se carga al primer trabajo
+        from app.ingest import IngestCancelled, ingest_pdf
+
+        with self._lock:
+            stop = self._stops.get(job_id) or threading.Event()
+        if stop.is_set() or not self.store.claim(job_id):
+            # cancelado, o ya lo tomó otro worker
+            self._forget(job_id)
+            return
+        job = self.store.get(job_id)
+        last = [0.0]
+
+        def progress(p: Dict[str, Any]) -> None:
+            # como mucho una escritura (y una consulta de cancelación) por segundo en SQLite
+            now = time.monotonic()
+            if now - last[0] >= 1.0:
+                last[0] = now
+                self.store.update(job_id, **p)
+                if self.store.cancel_requested(job_id):
+                    stop.set()
+
+        try:
+            res = ingest_pdf(
+                Path(job["path"]), source_name=job["source"], progress=progress, stop=stop,
+                file_hash=job.get("file_hash"),
+            )
+            self.store.update(
+                job_id,
+                status=DONE,
+                finished_at=time.time(),
+                pages=res.get("pages", 0),
+                chunks=res.get("added_chunks", 0) + res.get("kept_chunks", 0),
+                embedded=res.get("added_chunks", 0),
+                result=res,
+            )
+            logger.info("ingest.ok", extra={"job_id": job_id, "file": job["source"], **res})
+        except IngestCancelled as e:
+            if self._shutting_down and not self.store.cancel_requested(job_id):
+                # apagado del servidor: se retoma en el próximo arranque
+                self.store.update(job_id, status=QUEUED, started_at=None, owner_pid=None)
+            else:
+                self.store.update(job_id, status=CANCELLED, finished_at=time.time(), error=str(e))
+        except Exception as e:
+            logger.exception("ingest.error", extra={"job_id": job_id, "err": str(e)})
+            self.store.update(job_id, status=FAILED, finished_at=time.time(), error=str(e))
+        finally:
+            self._forget(job_id)
+
+    def _forget(self, job_id: str) -> None:
+        with self._lock:
+            self._stops.pop(job_id, None)
+
+    def shutdown(self) -> None:
+        self._shutting_down = True
+        with self._lock:
+            for ev in self._stops.values():
+                ev.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+def _alive(pid: Optional[int]) -> bool:
+    # ¿sigue vivo el proceso que tenía el trabajo?
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+job_manager = JobManager(default_jobs_path(), settings.ingest_concurrency)
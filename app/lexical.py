@@ -0,0 +1,360 @@
+from __future__ import annotations
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.settings import settings
+
+"""
+Índice léxico BM25 en SQLite, junto a data/chroma. Complementa la búsqueda
+vectorial: encuentra códigos, referencias y nombres exactos que los
+embeddings suelen perder, y sirve de respaldo si el embedder no responde.
+"""
+
+# BM25 estándar
+_K1 = 1.2
+_B = 0.75
+
+# Términos presentes en más de esta fracción de chunks apenas discriminan:
+# si la consulta tiene otros, se ignoran para no recorrer listas enormes
+_COMMON_DF = 0.6
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_SEP_RE = re.compile(r"[-_./]")
+
+STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun cada como con contra cual cuales
+cuando de del desde donde dos el ella ellas ellos en entre era eran es esa esas ese eso esos esta estaba
+estan estas este esto estos fue fueron ha hay han hasta la las le les lo los mas me mi mis muy nada ni no
+nos o os otra otras otro otros para pero poco por porque que quien se sea segun ser si sin sobre son su
+sus tambien tan tanto te tiene tienen todo todos tu tus un una unas uno unos y ya yo
+""".split())
+
+
+def _fold(text: str) -> str:
+    # minúsculas y sin tildes (canción -> cancion)
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _stem(word: str) -> str:
+    # stemmer ligero para español: quita plural y vocal final (clientes -> client)
+    if len(word) <= 4:
+        return word
+    if word.endswith("es") and len(word) > 5:
+        word = word[:-2]
+    elif word.endswith("s"):
+        word = word[:-1]
+    if word[-1] in "aoe" and len(word) > 4:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Términos para BM25. Los códigos (con dígitos, p. ej. 'AB-1234' o
+    'art.45') se indexan juntos ('ab1234') y por sus partes numéricas, así
+    coinciden se escriban como se escriban; las palabras pasan por
+    stopwords y stemming.
+    """
+    out: List[str] = []
+    for tok in _WORD_RE.findall(_fold(text)):
+        if any(c.isdigit() for c in tok):
+            # código: junto y sus partes numéricas ('ab-1234' -> 'ab1234', '1234');
+            # prefijos como 'ab' o 'ref' se repiten en todos los códigos y no aportan
+            parts = _SEP_RE.split(tok)
+            out.append("".join(parts))
+            if len(parts) > 1:
+                out.extend(p for p in parts if len(p) > 1 and any(c.isdigit() for c in p))
+        elif _SEP_RE.search(tok):
+            # palabras compuestas (socio-económico): junta y cada parte
+            parts = [p for p in _SEP_RE.split(tok) if len(p) > 1 and p not in STOPWORDS]
+            out.append("".join(_SEP_RE.split(tok)))
+            out.extend(_stem(p) for p in parts)
+        elif len(tok) > 1 and tok not in STOPWORDS:
+            out.append(_stem(tok))
+    return out
+
+
+def looks_like_lookup(query: str) -> bool:
+    """
+    Consultas de búsqueda exacta: entre comillas, o cortas y con algún
+    código/número ('pieza AB-1234', 'artículo 45'). Van por el índice léxico
+    sin calcular embedding.
+    """
+    q = query.strip()
+    if len(q) > 2 and q[0] in "\"'«" and q[-1] in "\"'»":
+        return True
+    words = q.split()
+    return 0 < len(words) <= 3 and any(any(c.isdigit() for c in w) and len(w) >= 2 for w in words)
+
+
+def rrf_fuse(rankings: Sequence[Sequence[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Reciprocal Rank Fusion: cada lista suma 1/(k + posición) a sus IDs.
+    Devuelve (id, score) de mayor a menor.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for pos, cid in enumerate(ranking):
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + pos + 1)
+    return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+
+
+def default_bm25_path() -> Path:
+    return Path(settings.bm25_path or Path(settings.chroma_path).parent / "bm25.sqlite3")
+
+
+class BM25Index:
+    """
+    Índice invertido persistente, actualizado por chunk desde ingest_pdf:
+    - docs(doc, id, src, len): doc es un entero interno; id, el de Chroma;
+    - postings(term, doc, tf, len, src): longitud y fuente van repetidas en
+      cada posting para puntuar sin JOIN (src es un entero de sources).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # N y longitud media; valen mientras no cambie PRAGMA data_version
+        # (lo sube cualquier escritura de otra conexión, p. ej. app.cli)
+        self._stats: Optional[Tuple[int, float]] = None
+        self._version: Optional[int] = None
+        self._sources: Dict[str, int] = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # timeout: app.cli puede estar escribiendo en el mismo archivo
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS sources (src INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS docs ("
+                    " doc INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, src INTEGER NOT NULL, len INTEGER NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS postings ("
+                    " term TEXT NOT NULL, doc INTEGER NOT NULL, tf INTEGER NOT NULL,"
+                    " len INTEGER NOT NULL, src INTEGER NOT NULL,"
+                    " PRIMARY KEY (term, doc)) WITHOUT ROWID"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS postings_by_doc ON postings(doc)")
+            self._sources = dict(conn.execute("SELECT name, src FROM sources").fetchall())
+            self._conn = conn
+        return self._conn
+
+    def _src(self, conn: sqlite3.Connection, name: str) -> int:
+        # otra conexión puede haberla creado entre tanto: OR IGNORE y se relee
+        src = self._sources.get(name)
+        if src is None:
+            conn.execute("INSERT OR IGNORE INTO sources (name) VALUES (?)", (name,))
+            src = conn.execute("SELECT src FROM sources WHERE name = ?", (name,)).fetchone()[0]
+            self._sources[name] = src
+        return src
+
+    def _lookup_src(self, conn: sqlite3.Connection, name: str) -> Optional[int]:
+        # sin crearla; si no está en memoria puede haberla añadido otra conexión
+        src = self._sources.get(name)
+        if src is None:
+            row = conn.execute("SELECT src FROM sources WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                src = self._sources[name] = row[0]
+        return src
+
+    def add(self, items: Iterable[Tuple[str, str, str]]) -> int:
+        # items: (id, texto, source); reemplaza lo que hubiera con ese id
+        parsed = [(cid, source, Counter(tokenize(text))) for cid, text, source in items]
+        if not parsed:
+            return 0
+        with self._lock:
+            conn = self._db()
+            try:
+                with conn:
+                    self._delete_ids(conn, [cid for cid, _, _ in parsed])
+                    postings: List[Tuple[str, int, int, int, int]] = []
+                    for cid, source, tf in parsed:
+                        src = self._src(conn, source)
+                        dl = sum(tf.values())
+                        doc = conn.execute("INSERT INTO docs (id, src, len) VALUES (?, ?, ?)", (cid, src, dl)).lastrowid
+                        postings.extend((term, doc, n, dl, src) for term, n in tf.items())
+                    conn.executemany("INSERT INTO postings (term, doc, tf, len, src) VALUES (?, ?, ?, ?, ?)", postings)
+            except Exception:
+                # la transacción se deshizo: las fuentes nuevas tampoco existen
+                self._sources = dict(conn.execute("SELECT name, src FROM sources").fetchall())
+                raise
+            finally:
+                self._stats = None
+        return len(parsed)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        if not ids:
+            return
+        with self._lock:
+            conn = self._db()
+            with conn:
+                self._delete_ids(conn, ids)
+            self._stats = None
+
+    def delete_source(self, source: str) -> None:
+        with self._lock:
+            conn = self._db()
+            src = self._lookup_src(conn, source)
+            if src is None:
+                return
+            with conn:
+                conn.execute("DELETE FROM postings WHERE src = ?", (src,))
+                conn.execute("DELETE FROM docs WHERE src = ?", (src,))
+            self._stats = None
+
+    @staticmethod
+    def _delete_ids(conn: sqlite3.Connection, ids: Sequence[str]) -> None:
+        # SQLite limita el número de parámetros: borramos por tandas
+        for start in range(0, len(ids), 500):
+            part = list(ids[start:start + 500])
+            marks = ",".join("?" * len(part))
+            docs = [r[0] for r in conn.execute(f"SELECT doc FROM docs WHERE id IN ({marks})", part)]
+            if not docs:
+                continue
+            dmarks = ",".join("?" * len(docs))
+            conn.execute(f"DELETE FROM postings WHERE doc IN ({dmarks})", docs)
+            conn.execute(f"DELETE FROM docs WHERE doc IN ({dmarks})", docs)
+
+    def _corpus_stats(self, conn: sqlite3.Connection) -> Tuple[int, float]:
+        # data_version no cambia con las escrituras propias: esas ponen _stats a None
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._stats is None or version != self._version:
+            n, avg = conn.execute("SELECT COUNT(*), AVG(len) FROM docs").fetchone()
+            self._stats = (n or 0, float(avg or 0.0))
+            self._version = version
+        return self._stats
+
+    def search(self, query: str, k: int, source: Optional[str] = None) -> List[Tuple[str, float]]:
+        """
+        Top-k (id, score) por BM25. El idf se calcula sobre todo el índice;
+        source sólo filtra los candidatos.
+        """
+        qtf = Counter(tokenize(query))
+        if not qtf or k <= 0:
+            return []
+        with self._lock:
+            conn = self._db()
+            n_docs, avgdl = self._corpus_stats(conn)
+            src = self._lookup_src(conn, source) if source else None
+            if n_docs == 0 or (source and src is None):
+                return []
+            terms = list(qtf)
+            marks = ",".join("?" * len(terms))
+            df = dict(conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({marks}) GROUP BY term", terms
+            ).fetchall())
+            terms = [t for t in terms if df.get(t)]
+            rare = [t for t in terms if df[t] <= _COMMON_DF * n_docs]
+            if rare:
+                terms = rare
+            lists = []
+            for t in terms:
+                if src is None:
+                    rows = conn.execute("SELECT doc, tf, len FROM postings WHERE term = ?", (t,)).fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT doc, tf, len FROM postings WHERE term = ? AND src = ?", (t, src)
+                    ).fetchall()
+                if rows:
+                    lists.append((t, np.asarray(rows, dtype=np.float64)))
+            if not lists:
+                return []
+
+            # puntuación vectorizada: cada posting aporta idf * tf normalizado
+            docs = np.concatenate([a[:, 0] for _, a in lists]).astype(np.int64)
+            contrib = []
+            for t, a in lists:
+                idf = math.log(1.0 + (n_docs - df[t] + 0.5) / (df[t] + 0.5))
+                tf, dl = a[:, 1], a[:, 2]
+                contrib.append(idf * qtf[t] * tf * (_K1 + 1.0) / (tf + _K1 * (1.0 - _B + _B * dl / (avgdl or 1.0))))
+            uniq, inv = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inv, weights=np.concatenate(contrib))
+            top = np.argsort(-scores)[:k] if len(scores) <= 4 * k else np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+            picked = [int(uniq[i]) for i in top]
+            dmarks = ",".join("?" * len(picked))
+            names = dict(conn.execute(f"SELECT doc, id FROM docs WHERE doc IN ({dmarks})", picked).fetchall())
+        return [(names[d], float(scores[i])) for d, i in zip(picked, top) if d in names]
+
+    def term_matches(self, query: str, ids: Sequence[str]) -> Tuple[Dict[str, float], Dict[str, Dict[str, int]]]:
+        """
+        Para el re-ranking: idf de cada término de la consulta y, por cada
+        id de ids, los términos de la consulta que contiene con su tf. Sale
+        de los postings ya calculados en la ingesta, sin volver a tokenizar
+        los chunks.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not ids:
+            return {}, {}
+        with self._lock:
+            conn = self._db()
+            n_docs, _ = self._corpus_stats(conn)
+            tmarks = ",".join("?" * len(terms))
+            df = dict(conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({tmarks}) GROUP BY term", terms
+            ).fetchall())
+            imarks = ",".join("?" * len(ids))
+            rows = conn.execute(
+                f"SELECT d.id, p.term, p.tf FROM postings p JOIN docs d ON d.doc = p.doc"
+                f" WHERE p.term IN ({tmarks}) AND d.id IN ({imarks})", (*terms, *ids)
+            ).fetchall()
+        # términos que no están en el índice: idf máximo (rarísimos)
+        idf = {t: math.log(1.0 + (n_docs - df.get(t, 0) + 0.5) / (df.get(t, 0) + 0.5)) for t in terms}
+        matches: Dict[str, Dict[str, int]] = {}
+        for cid, term, tf in rows:
+            matches.setdefault(cid, {})[term] = tf
+        return idf, matches
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            return {r[0] for r in self._db().execute("SELECT id FROM docs")}
+
+    def count(self) -> int:
+        with self._lock:
+            return self._corpus_stats(self._db())[0]
+
+    def sync_with_collection(self, col, batch_size: int = 1000) -> Dict[str, int]:
+        """
+        Pone el índice al día con la colección de Chroma (p. ej. datos
+        ingestados antes de que existiera el índice): añade lo que falta y
+        quita lo que ya no está.
+        """
+        chroma_ids = set(col.get(include=[]).get("ids") or [])
+        have = self.ids()
+        missing = [cid for cid in chroma_ids if cid not in have]
+        stale = [cid for cid in have if cid not in chroma_ids]
+        for start in range(0, len(missing), batch_size):
+            res = col.get(ids=missing[start:start + batch_size], include=["documents", "metadatas"])
+            self.add(
+                (cid, doc or "", str((meta or {}).get("source", "")))
+                for cid, doc, meta in zip(res["ids"], res["documents"], res["metadatas"])
+            )
+        self.delete(stale)
+        return {"added": len(missing), "removed": len(stale)}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._stats = None
+            self._version = None
+            self._sources = {}
+
+
+lexical_index = BM25Index(default_bm25_path())
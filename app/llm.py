@@ -1,44 +1,204 @@
 from __future__ import annotations
+import json
+import threading
+import time
+import httpx
 import requests
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Iterator
+from app.concurrency import get_async_client
+from app.metrics import count_tokens, observe, timed
+from app.resilience import get_upstream, request_key
 from app.settings import settings
 
 """
-La app se conecta con Ollama, manda las preguntas junto al contexto, 
+La app se conecta con Ollama, manda las preguntas junto al contexto,
 y devuelve la respuesta generada por el modelo
 """
 
 class LLMClient:
-    def __init__(self, host: str, model: str, timeout: int = 300):  # 300s
+    def __init__(self, host: str, model: str, timeout: float = 300, num_ctx: int = 8192):  # 300s
         self.host = host.rstrip("/")
         self.model = model
         self.timeout = timeout
+        self.num_ctx = num_ctx
         self.session = requests.Session()
+        self.upstream = get_upstream("llm")
 
-    # Función para chatear con el modelo
-    def chat(self, messages: List[Dict[str, str]], stream: bool = False) -> Dict[str, Any]:
-        payload = {
+    def _payload(self, messages: List[Dict[str, str]], stream: bool) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
             "model": self.model,
             "messages": messages,
             "stream": stream,
             "options": {
                 "temperature": 0.2,
-                "num_ctx": 8192,   # prueba 8192; si tu hw soporta más, sube a 16384
+                "num_ctx": self.num_ctx,   # NUM_CTX; si tu hw soporta más, sube a 16384
             },
         }
-        # mandamos la request a Ollama
-        r = self.session.post(f"{self.host}/api/chat", json=payload, timeout=self.timeout)
-        r.raise_for_status()
-        data = r.json()
+        if settings.ollama_keep_alive:
+            payload["keep_alive"] = settings.ollama_keep_alive
+        return payload
+
+    # Función para chatear con el modelo
+    def chat(self, messages: List[Dict[str, str]], stream: bool = False) -> Dict[str, Any]:
+        if stream:
+            # juntamos los trozos del stream en una sola respuesta
+            parts: List[str] = []
+            final: Dict[str, Any] = {}
+            for ev in self.chat_stream(messages):
+                if ev.get("done"):
+                    final = ev
+                else:
+                    parts.append(ev.get("content", ""))
+            return {
+                "content": "".join(parts),
+                "model": self.model,
+                "prompt_tokens": final.get("prompt_tokens"),
+                "completion_tokens": final.get("completion_tokens"),
+            }
 
+        # mandamos la request a Ollama (con reintentos; preguntas idénticas en vuelo van juntas)
+        url, payload = f"{self.host}/api/chat", self._payload(messages, False)
+        with timed("llm"):
+            r = self.upstream.call(lambda t: self.session.post(url, json=payload, timeout=t),
+                                   self.timeout, key=request_key(url, payload))
+            r.raise_for_status()
+        out = self._parse_chat(r.json(), self.model)
+        count_tokens(out.get("prompt_tokens"), out.get("completion_tokens"))
+        return out
+
+    @staticmethod
+    def _parse_chat(data: Any, model: str) -> Dict[str, Any]:
         if isinstance(data, dict):
+            usage = {
+                "prompt_tokens": data.get("prompt_eval_count"),
+                "completion_tokens": data.get("eval_count"),
+            }
             if "message" in data and isinstance(data["message"], dict):
-                return {"content": data["message"].get("content", ""), "model": self.model}
+                return {"content": data["message"].get("content", ""), "model": model, **usage}
             if "content" in data:
-                return {"content": data.get("content", ""), "model": self.model}
-        return {"content": str(data), "model": self.model}
+                return {"content": data.get("content", ""), "model": model, **usage}
+        return {"content": str(data), "model": model}
+
+    def _parse_stream_line(self, line: str | bytes) -> List[Dict[str, Any]]:
+        # Convierte una línea NDJSON de Ollama en 0, 1 o 2 eventos
+        data = json.loads(line)
+        if data.get("error"):
+            raise RuntimeError(f"Ollama: {data['error']}")
+        events: List[Dict[str, Any]] = []
+        content = (data.get("message") or {}).get("content", "")
+        if content:
+            events.append({"content": content})
+        if data.get("done"):
+            events.append({
+                "done": True,
+                "model": self.model,
+                "prompt_tokens": data.get("prompt_eval_count"),
+                "completion_tokens": data.get("eval_count"),
+            })
+        return events
+
+    def chat_stream(self, messages: List[Dict[str, str]]) -> Iterator[Dict[str, Any]]:
+        """
+        Genera los tokens según llegan de Ollama (NDJSON):
+        {"content": "..."} por cada trozo y al final
+        {"done": True, "prompt_tokens": ..., "completion_tokens": ...}.
+        """
+        clock = _StreamClock()
+        url, payload = f"{self.host}/api/chat", self._payload(messages, True)
+        # sin coalescing: cada cliente recibe su propio stream
+        r = self.upstream.call(lambda t: self.session.post(url, json=payload, timeout=t, stream=True), self.timeout)
+        with r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                for ev in self._parse_stream_line(line):
+                    clock.see(ev)
+                    yield ev
+                    if ev.get("done"):
+                        return
+
+    # Versiones asíncronas (cliente httpx compartido, no bloquean el event loop)
+
+    @staticmethod
+    def _timeout(timeout: float) -> httpx.Timeout:
+        return httpx.Timeout(timeout, connect=min(settings.ollama_connect_timeout, timeout))
+
+    async def achat(self, messages: List[Dict[str, str]], timeout: float | None = None) -> Dict[str, Any]:
+        client = get_async_client()
+        url, payload = f"{self.host}/api/chat", self._payload(messages, False)
+        with timed("llm"):
+            r = await self.upstream.acall(lambda t: client.post(url, json=payload, timeout=self._timeout(t)),
+                                          timeout or self.timeout, key=request_key(url, payload))
+            r.raise_for_status()
+        out = self._parse_chat(r.json(), self.model)
+        count_tokens(out.get("prompt_tokens"), out.get("completion_tokens"))
+        return out
+
+    async def achat_stream(
+        self, messages: List[Dict[str, str]], timeout: float | None = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        client = get_async_client()
+        clock = _StreamClock()
+        url, payload = f"{self.host}/api/chat", self._payload(messages, True)
+
+        def open_stream(t: float):
+            req = client.build_request("POST", url, json=payload, timeout=self._timeout(t))
+            return client.send(req, stream=True)
+
+        r = await self.upstream.acall(open_stream, timeout or self.timeout)
+        try:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line:
+                    continue
+                for ev in self._parse_stream_line(line):
+                    clock.see(ev)
+                    yield ev
+                    if ev.get("done"):
+                        return
+        finally:
+            await r.aclose()
+
+
+    async def apreload(self, timeout: float | None = None) -> None:
+        """
+        Carga el modelo en Ollama sin generar nada (messages vacío), para que
+        la primera pregunta no pague la carga en frío.
+        """
+        # mismas options que las preguntas: otro num_ctx obligaría a recargarlo
+        client = get_async_client()
+        url, payload = f"{self.host}/api/chat", self._payload([], False)
+        r = await self.upstream.acall(lambda t: client.post(url, json=payload, timeout=self._timeout(t)),
+                                      timeout or self.timeout, key=request_key(url, payload))
+        r.raise_for_status()
+
+
+class _StreamClock:
+    # Métricas de una respuesta en streaming: primer token (llm_ttft) y total (llm)
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.first = False
+
+    def see(self, ev: Dict[str, Any]) -> None:
+        if not self.first and ev.get("content"):
+            self.first = True
+            observe("llm_ttft", time.perf_counter() - self.t0)
+        if ev.get("done"):
+            observe("llm", time.perf_counter() - self.t0)
+            count_tokens(ev.get("prompt_tokens"), ev.get("completion_tokens"))
+
+
+_llm: LLMClient | None = None
+_llm_lock = threading.Lock()
 
 def get_llm() -> LLMClient:
+    # Una instancia por proceso: reutiliza las conexiones keep-alive
+    global _llm
     if settings.llm_provider.lower() == "ollama":
-        return LLMClient(settings.ollama_host, settings.ollama_model)
+        with _llm_lock:
+            if _llm is None:
+                _llm = LLMClient(settings.ollama_host, settings.ollama_model, timeout=settings.llm_timeout,
+                                 num_ctx=settings.llm_num_ctx)
+            return _llm
     raise NotImplementedError(f"LLM provider '{settings.llm_provider}' no implementado")
@@ -1,26 +1,138 @@
 from __future__ import annotations
 
+# lo primero: marca el inicio del arranque (ver app.warmup)
+from app.warmup import warmup
+
+import asyncio
+import json
+import time
+import zipfile
+from contextlib import aclosing, asynccontextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from app.settings import settings
 from app.logging_config import configure_logging
-from app.schemas import ChatRequest, ChatResponse, SourceChunk
-from app.ingest import ingest_pdf
-from app.rag import retrieve_context, build_messages
+from app.schemas import ChatBatchRequest, ChatRequest, ChatResponse, SourceChunk
+from app.rag import aembed_questions, aretrieve_context, aretrieve_many, pack_messages
 from app.llm import get_llm
-from app.embeddings import get_embeddings
+from app.resilience import error_status, set_deadline
+from app.metrics import CHUNKS, timed
+from app.cache import MISSING, answer_cache, answer_context_key
+from app.retriever import collection_handle
+from app.lexical import lexical_index
+from app.compact import compact_index
+from app.concurrency import aclose as aclose_concurrency, run_blocking
+from app.pdf_extract import shutdown_pool as shutdown_pdf_pool
+from app.shards import shutdown_pool as shutdown_shard_pool
+from app.jobs import job_manager
+from app.uploads import (
+    UploadRejected, UploadSizeLimit, UploadTooLarge, commit as commit_upload, discard, iter_form_files, iter_zip_pdfs,
+)
+from app.sessions import SESSION_COOKIE, SESSION_HEADER, new_session_id, session_store, valid_session_id
 
 logger = configure_logging()
-app = FastAPI(title="RAG Chatbot FastAPI", version="1.0.0")
 
-# Recuerda el último archivo subido para filtrar el contexto por defecto
-LAST_SOURCE: Optional[str] = None
+
+async def _open_chroma() -> Dict[str, Any]:
+    # Abrimos Chroma una sola vez para todo el proceso
+    await run_blocking(collection_handle.open)
+    logger.info("chroma.open", extra={"path": collection_handle.path})
+    return {"path": collection_handle.path}
+
+
+async def _open_shards() -> Dict[str, Any]:
+    # SHARD_MODE: lo ingestado antes en la colección única pasa a su colección
+    migrated = await run_blocking(collection_handle.router.migrate, collection_handle.get())
+    shards = len(await run_blocking(collection_handle.router.catalog.collections))
+    logger.info("shards.open", extra={"mode": collection_handle.shard_mode, "shards": shards, **migrated})
+    return {"mode": collection_handle.shard_mode, "shards": shards, "migrated": migrated}
+
+
+async def _sync_bm25() -> Dict[str, Any]:
+    # índice BM25: recupera lo que se ingestó antes de que existiera
+    synced = await run_blocking(lexical_index.sync_with_collection, collection_handle.view())
+    logger.info("bm25.sync", extra={"path": str(lexical_index.path), **synced})
+    return synced
+
+
+async def _sync_compact() -> Dict[str, Any]:
+    # índice compacto (COMPACT_INDEX): se construye con los vectores que ya guarda Chroma
+    synced = await run_blocking(compact_index.sync_with_collection, collection_handle.view())
+    logger.info("compact.sync", extra={"path": str(compact_index.path), **synced})
+    return {**synced, **compact_index.stats()}
+
+
+async def _start_jobs() -> Dict[str, Any]:
+    # trabajos de ingesta: retoma los que quedaron a medias
+    resumed = await run_blocking(job_manager.start)
+    logger.info("jobs.start", extra={"resumed": resumed, "path": str(job_manager.path)})
+    return {"resumed": resumed}
+
+
+async def _open_sessions() -> Dict[str, Any]:
+    pruned = await run_blocking(session_store.prune, settings.session_ttl)
+    logger.info("sessions.open", extra={"pruned": pruned, "path": str(session_store.path)})
+    return {"pruned": pruned}
+
+
+async def _warm_llm() -> Dict[str, Any]:
+    # Ollama carga el modelo en frío con la primera llamada: que no sea un usuario
+    await get_llm().apreload()
+    return {"model": settings.ollama_model}
+
+
+async def _warm_embeddings() -> Dict[str, Any]:
+    # sin caché: la idea es que Ollama cargue el modelo
+    await collection_handle.embedder.aembed(["warmup"], use_cache=False)
+    return {"model": settings.ollama_embed_model}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup.mark("import")
+    core = [("chroma", _open_chroma), ("bm25", _sync_bm25), ("jobs", _start_jobs), ("sessions", _open_sessions)]
+    if settings.compact_index:
+        core.insert(2, ("compact", _sync_compact))
+    if collection_handle.sharded:
+        core.insert(1, ("shards", _open_shards))
+    models = [("llm", _warm_llm), ("embeddings", _warm_embeddings)] if settings.warmup_models else []
+    if settings.lazy_startup:
+        # uvicorn acepta conexiones ya; /chat e /ingest esperan a la parte core
+        warmup.start(core, models)
+    else:
+        if not await warmup.run_core(core):
+            raise RuntimeError(f"Arranque fallido: {warmup.error}")
+        warmup.start([], models)
+    try:
+        yield
+    finally:
+        await warmup.stop()
+        await run_blocking(job_manager.shutdown)
+        await aclose_concurrency()
+        shutdown_pdf_pool()
+        shutdown_shard_pool()
+        collection_handle.close()
+        lexical_index.close()
+        compact_index.close()
+        session_store.close()
+        logger.info("chroma.close", extra={"path": collection_handle.path})
+
+
+app = FastAPI(title="RAG Chatbot FastAPI", version="1.0.0", lifespan=lifespan)
+
+NO_CONTEXT_ANSWER = "No encontré información relevante en la base de conocimientos para responder."
+
+# 413 por Content-Length antes de leer el cuerpo (va por dentro de CORS para llevar sus cabeceras)
+app.add_middleware(
+    UploadSizeLimit,
+    limits={"/ingest": settings.upload_max_bytes, "/ingest/bulk": settings.bulk_max_bytes},
+)
 
 # CORS
 app.add_middleware(
@@ -37,9 +149,34 @@ Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
 @app.get("/health")
 def health():
+    # liveness: el proceso responde aunque siga arrancando; "ready" dice si ya atiende
+    return {"status": "ok", "ready": warmup.ready}
+
+
+@app.get("/health/live")
+def health_live():
     return {"status": "ok"}
 
 
+@app.get("/health/ready")
+def health_ready():
+    # readiness: 503 hasta que el warm-up termina (Chroma, BM25, trabajos y modelos)
+    status = warmup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+async def _require_core() -> None:
+    """
+    Durante el arranque (LAZY_STARTUP) espera a que Chroma, BM25 y la cola de
+    trabajos estén abiertos; si no llegan en READY_TIMEOUT, 503.
+    """
+    if warmup.core_ok:
+        return
+    if not await warmup.wait_core(settings.ready_timeout):
+        detail = f"La app está arrancando ({warmup.error})" if warmup.error else "La app está arrancando"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+
 @app.get("/")
 def index():
     html_path = Path(__file__).parent / "ui" / "index.html"
@@ -48,102 +185,707 @@ def index():
     return HTMLResponse(html_path.read_text(encoding="utf-8"))
 
 
-@app.post("/ingest")
-async def ingest(file: UploadFile = File(...)):
+def _session(request: Request) -> Tuple[str, bool]:
     """
-    Sube un PDF, lo trocea e ingesta en Chroma. Guarda el nombre como LAST_SOURCE.
+    ID de sesión del cliente: cabecera X-Session-ID o cookie rag_session.
+    Si no trae ninguno válido se crea uno nuevo (segundo valor = True).
     """
-    try:
-        if not file.filename.lower().endswith(".pdf"):
-            raise HTTPException(status_code=400, detail="Solo se aceptan PDFs")
+    sid = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if valid_session_id(sid):
+        return sid, False
+    return new_session_id(), True
+
+
+def _attach_session(response: Response, sid: str, new: bool) -> None:
+    response.headers[SESSION_HEADER] = sid
+    if new:
+        response.set_cookie(SESSION_COOKIE, sid, max_age=int(settings.session_ttl), httponly=True, samesite="lax")
+
+
+@app.get("/session")
+async def get_session(request: Request, response: Response):
+    sid, new = _session(request)
+    _attach_session(response, sid, new)
+    return await run_blocking(session_store.get, sid)
+
 
-        uploads_dir = Path("data/uploads")
-        uploads_dir.mkdir(parents=True, exist_ok=True)
+@app.delete("/session")
+async def reset_session(request: Request, response: Response):
+    # olvida la fuente activa y el historial guardado de esta sesión
+    sid, new = _session(request)
+    _attach_session(response, sid, new)
+    await run_blocking(session_store.reset, sid)
+    return {"id": sid, "reset": True}
 
-        dest = uploads_dir / file.filename
-        dest.write_bytes(await file.read())
 
-        res = ingest_pdf(dest, source_name=file.filename)
-        logger.info("ingest.ok", extra={"file": file.filename, **res})
+def _find_ingested(file_hash: str, source: str) -> Optional[str]:
+    # import diferido: pypdf y el splitter sólo se cargan si se ingesta aquí
+    from app.ingest import find_ingested
 
-        # recuerda la fuente actual para el chat
-        global LAST_SOURCE
-        LAST_SOURCE = file.filename
+    return find_ingested(file_hash, source)
 
-        # devolvemos también la fuente actual
-        return {**res, "source": file.filename}
+
+def _check_duplicate(staged, source: str) -> Optional[Dict[str, Any]]:
+    # ¿ya está ingerido o en cola? Sólo mira el hash, sin abrir el PDF
+    job = job_manager.store.find_active(staged.file_hash)
+    if job:
+        return {"status": "already_queued", "job_id": job["id"], "source": job["source"]}
+    found = _find_ingested(staged.file_hash, source)
+    if found == source:
+        return {"status": "unchanged", "source": source}
+    if found:
+        return {"status": "duplicate", "source": found, "duplicate_of": found}
+    return None
+
+
+def _accept(staged, name: str, force: bool) -> Dict[str, Any]:
+    """
+    Destino de un archivo ya copiado a disco: si su hash ya está ingerido
+    o en cola (y no se pide force) se descarta; si no, pasa a
+    data/uploads/<file_hash>.pdf y se encola su ingesta como fuente name.
+    """
+    try:
+        dup = None if force else _check_duplicate(staged, name)
+    except BaseException:
+        discard(staged)
+        raise
+    if dup:
+        discard(staged)
+        logger.info("ingest.duplicate", extra={"file": name, "file_hash": staged.file_hash, **dup})
+        return {**dup, "file": name, "file_hash": staged.file_hash}
+    dest = commit_upload(staged, name)
+    job_id = job_manager.submit(dest, name, staged.file_hash)
+    logger.info("ingest.queued", extra={"file": name, "job_id": job_id, "bytes": staged.size})
+    return {"status": "queued", "job_id": job_id, "source": name, "file": name, "file_hash": staged.file_hash}
+
+
+def _multipart_body(field: str, many: bool = False) -> Dict[str, Any]:
+    # /ingest y /ingest/bulk leen el multipart a mano: así sale el campo en /docs
+    binary = {"type": "string", "format": "binary"}
+    schema = {"type": "array", "items": binary} if many else binary
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object", "required": [field], "properties": {field: schema}}}}}}
+
+
+@app.post("/ingest", openapi_extra=_multipart_body("file"))
+async def ingest(
+    request: Request,
+    response: Response,
+    wait: bool = Query(False),
+    force: bool = Query(False),
+):
+    """
+    Sube un PDF (campo file) y encola su ingesta; devuelve el job_id al
+    momento (consulta el progreso en /jobs/{job_id}). Con wait=true ingesta
+    dentro de la petición como antes. El archivo va del cuerpo de la
+    petición a disco en una pasada calculando su hash: si ese contenido ya
+    está ingerido o en cola no se vuelve a procesar (status
+    unchanged/duplicate/already_queued), salvo con force=true. La fuente
+    pasa a ser la activa de la sesión del cliente.
+    """
+    sid, new = _session(request)
+    _attach_session(response, sid, new)
+    await _require_core()
+
+    def limit_for(field: str, name: str) -> int:
+        if field != "file":
+            raise UploadRejected(f"Campo inesperado: {field}")
+        if not name.lower().endswith(".pdf"):
+            raise UploadRejected("Solo se aceptan PDFs")
+        return settings.upload_max_bytes
+
+    staged = None
+    try:
+        async with aclosing(iter_form_files(request, limit_for, settings.upload_max_bytes)) as parts:
+            async for part in parts:
+                if part.field != "file":
+                    continue
+                if part.error is not None:
+                    raise part.error
+                staged, name = part.staged, part.name
+                break
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UploadRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if staged is None:
+        raise HTTPException(status_code=422, detail="Falta el archivo (campo file)")
+    try:
+        if wait:
+            dup = None if force else await run_blocking(_check_duplicate, staged, name)
+            if dup:
+                discard(staged)
+                res = {**dup, "file_hash": staged.file_hash, "skipped": True}
+            else:
+                dest = await run_blocking(commit_upload, staged, name)
+                from app.ingest import ingest_pdf
+
+                # pypdf, embeddings y Chroma son bloqueantes: van al pool de hilos
+                res = await run_blocking(ingest_pdf, dest, source_name=name, file_hash=staged.file_hash)
+                logger.info("ingest.ok", extra={"file": name, **res})
+        else:
+            res = await run_blocking(_accept, staged, name, force)
+
+        # recuerda la fuente actual para el chat de esta sesión (la ya ingerida si es un duplicado)
+        await run_blocking(session_store.set_source, sid, res["source"])
+        return res
     except Exception as e:
+        discard(staged)
         logger.exception("ingest.error", extra={"err": str(e)})
         raise HTTPException(status_code=500, detail=f"Ingesta fallida: {e}")
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
+def _accept_zip(path, budget: int, slots: int, force: bool) -> Tuple[List[Dict[str, Any]], int]:
+    # PDFs de un ZIP, uno a uno; devuelve sus resultados y los bytes descomprimidos
+    results: List[Dict[str, Any]] = []
+    used = accepted = 0
+    for name, staged, reason in iter_zip_pdfs(path, budget):
+        if staged is None:
+            results.append({"file": name, "status": "rejected", "detail": reason})
+            continue
+        used += staged.size
+        accepted += 1
+        if accepted > slots:
+            discard(staged)
+            results.append({"file": name, "status": "rejected", "detail": "Demasiados archivos en la subida"})
+            continue
+        try:
+            results.append(_accept(staged, name, force))
+        except Exception as e:
+            logger.exception("ingest.error", extra={"file": name, "err": str(e)})
+            results.append({"file": name, "status": "failed", "detail": str(e)})
+    return results, used
+
+
+@app.post("/ingest/bulk", openapi_extra=_multipart_body("files", many=True))
+async def ingest_bulk(request: Request, force: bool = Query(False)):
+    """
+    Varios PDFs (o ZIPs con PDFs) en una sola petición (campo files): cada
+    archivo va a disco en una pasada con su hash según llega y se encola
+    como en /ingest, con la misma detección de duplicados. Devuelve un
+    resultado por archivo; no cambia la fuente activa de la sesión. Si el
+    cuerpo pasa de BULK_MAX_BYTES se deja de leer y "truncated" dice por qué.
+    """
+    await _require_core()
+    results: List[Dict[str, Any]] = []
+    used = 0
+
+    def slots() -> int:
+        return settings.bulk_max_files - sum(r["status"] != "rejected" for r in results)
+
+    def limit_for(field: str, name: str) -> int:
+        lower = name.lower()
+        if not lower.endswith((".pdf", ".zip")):
+            raise UploadRejected("Solo se aceptan PDFs o ZIPs")
+        if slots() <= 0:
+            raise UploadRejected("Demasiados archivos en la subida")
+        # un ZIP sólo está limitado por lo que queda de la petición
+        limit = settings.bulk_max_bytes - used
+        return min(settings.upload_max_bytes, limit) if lower.endswith(".pdf") else limit
+
+    out: Dict[str, Any] = {}
+    try:
+        async with aclosing(iter_form_files(request, limit_for, settings.bulk_max_bytes)) as parts:
+            async for part in parts:
+                name, staged = part.name, part.staged
+                if part.field != "files":
+                    if staged is not None:
+                        discard(staged)
+                    continue
+                if part.error is not None:
+                    results.append({"file": name, "status": "rejected", "detail": str(part.error)})
+                    continue
+                # el límite se fijó al empezar la parte; lo procesado desde entonces puede bajarlo
+                try:
+                    limit = limit_for(part.field, name)
+                except UploadRejected as e:
+                    discard(staged)
+                    results.append({"file": name, "status": "rejected", "detail": str(e)})
+                    continue
+                if staged.size > limit:
+                    discard(staged)
+                    results.append({"file": name, "status": "rejected",
+                                    "detail": f"El archivo supera el máximo de {limit} bytes"})
+                    continue
+                free = slots()
+                used += staged.size
+                try:
+                    if name.lower().endswith(".zip"):
+                        budget = settings.bulk_max_bytes - used
+                        try:
+                            rows, unzipped = await run_blocking(_accept_zip, staged.path, budget, free, force)
+                        except zipfile.BadZipFile as e:
+                            rows, unzipped = [{"file": name, "status": "rejected", "detail": f"ZIP no válido: {e}"}], 0
+                        finally:
+                            discard(staged)
+                        used += unzipped
+                        results.extend(rows)
+                    else:
+                        results.append(await run_blocking(_accept, staged, name, force))
+                except Exception as e:
+                    logger.exception("ingest.error", extra={"file": name, "err": str(e)})
+                    results.append({"file": name, "status": "failed", "detail": str(e)})
+    except UploadTooLarge as e:
+        # lo ya encolado se queda; el resto de la petición no se lee
+        out["truncated"] = str(e)
+    except UploadRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    counts: Dict[str, int] = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    logger.info("ingest.bulk", extra={"files": len(results), "bytes": used, **counts, **out})
+    return {"files": results, "counts": counts, **out}
+
+
+def _delete_source(source: str) -> Dict[str, Any]:
+    # import diferido, como en /ingest
+    from app.ingest import delete_source
+
+    return delete_source(source)
+
+
+@app.delete("/sources/{source}")
+async def delete_source(source: str):
+    """
+    Borra una fuente ingerida (Chroma, BM25 e índice compacto). Con
+    SHARD_MODE=source se elimina su colección sin tocar las demás.
+    """
+    await _require_core()
+    res = await run_blocking(_delete_source, source)
+    if not res["removed_chunks"]:
+        raise HTTPException(status_code=404, detail="Fuente no encontrada")
+    logger.info("source.deleted", extra=res)
+    return res
 
+
+@app.get("/jobs")
+async def list_jobs(limit: int = Query(50, ge=1, le=500), status: Optional[str] = None):
+    await _require_core()
+    return await run_blocking(job_manager.store.list, limit, status)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    await _require_core()
+    job = await run_blocking(job_manager.store.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    await _require_core()
+    if not await run_blocking(job_manager.cancel, job_id):
+        raise HTTPException(status_code=409, detail="El trabajo no existe o ya terminó")
+    return await run_blocking(job_manager.store.get, job_id)
+
+
+async def _prepare_chat(req: ChatRequest, sid: str) -> Dict[str, Any]:
+    """
+    Parte común de /chat y /chat/stream: recupera contexto, arma los
+    mensajes para el LLM y las fuentes usadas. La fuente por defecto y,
+    si el cliente no manda history, el historial salen de la sesión.
+    """
+    top_k = req.top_k or settings.max_context_chunks
+
+    # si tu ChatRequest no tiene 'source', getattr devolverá None
+    requested_source: Optional[str] = getattr(req, "source", None)
+    current_source: Optional[str] = requested_source or await run_blocking(session_store.source, sid)
+
+    ctx = await aretrieve_context(req.message, top_k=top_k, source=current_source, mmr=req.mmr)
+
+    history: List[Dict[str, str]] = []
+    # el historial guardado en el servidor crece con cada turno: si entrara en la
+    # clave, repetir o parafrasear una pregunta en la misma sesión nunca acertaría
+    cache_history: List[Dict[str, str]] = []
+    if ctx["contexts"]:
+        if req.history is not None:
+            history = cache_history = [m.model_dump() for m in req.history]
+        elif settings.session_history:
+            history = await run_blocking(session_store.history, sid)
+    return _build_prep(req, ctx, top_k, current_source, history, cache_history)
+
+
+def _build_prep(req: ChatRequest, ctx: Dict[str, Any], top_k: int, current_source: Optional[str],
+                history: List[Dict[str, str]],
+                cache_history: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+    # Con el contexto ya recuperado: empaqueta el prompt y consulta la caché de respuestas;
+    # cache_history es la parte del historial que entra en la clave (por defecto, todo)
+    timings: Dict[str, float] = dict(ctx["timings"])
+
+    contexts: List[str] = ctx["contexts"]
+    metas = ctx["metas"]
+    ids = ctx["ids"]
+    dists = ctx["distances"]
+
+    extra = {
+        "top_k": top_k,
+        "mmr": ctx["mmr"],
+        "mmr_ms": ctx["mmr_ms"],
+        "retrieval_cache": "hit" if ctx["cached"] else "miss",
+        "retrieval": ctx["mode"],
+        "source": current_source,
+    }
+    if req.timings:
+        # el mismo dict se completa con llm_ms/total_ms al terminar
+        extra["timings"] = timings
+    if not contexts:
+        return {"contexts": contexts, "messages": None, "used": [], "extra": extra, "timings": timings}
+
+    # Construir mensajes
+    with timed("build_prompt", timings):
+        packed = pack_messages(req.message, contexts, metas, history)
+    kept = packed["kept"]
+    dropped = len(contexts) - len(kept)
+    if dropped:
+        CHUNKS.labels(event="prompt_dropped").inc(dropped)
+    extra["prompt_tokens_est"] = packed["prompt_tokens_est"]
+    extra["packing"] = {
+        "kept": len(kept),
+        "dropped": dropped,
+        "truncated": len(packed["truncated"]),
+        "history_dropped": packed["history_dropped"],
+    }
+
+    # sólo las fuentes que de verdad entraron en el prompt
+    used = [
+        SourceChunk(
+            id=ids[i],
+            source=str((metas[i] or {}).get("source", "desconocido")),
+            page=(metas[i] or {}).get("page"),
+            distance=float(dists[i]) if dists and i < len(dists) and dists[i] is not None else None,
+            text=contexts[i][:5000],
+        )
+        for i in kept
+    ]
+    prep = {"contexts": [contexts[i] for i in kept], "messages": packed["messages"], "used": used,
+            "extra": extra, "timings": timings, "answer_cache": None, "cached_answer": None}
+
+    # caché semántica de respuestas: misma fuente, mismos chunks recuperados y
+    # pregunta parecida -> reutilizamos la respuesta sin llamar al LLM
+    if ctx["qvec"] is not None:
+        key = answer_context_key(current_source, ids, history if cache_history is None else cache_history)
+        generation = answer_cache.generation
+        hit, sim = answer_cache.lookup(ctx["qvec"], key)
+        extra["answer_cache"] = "miss" if hit is MISSING else "hit"
+        if hit is not MISSING:
+            extra["answer_cache_similarity"] = round(sim, 4)
+            prep["cached_answer"] = hit
+        prep["answer_cache"] = {
+            "qvec": ctx["qvec"],
+            "key": key,
+            "generation": generation,
+            "sources": frozenset(u.source for u in used),
+        }
+    return prep
+
+
+async def _save_turn(sid: str, question: str, answer: str) -> None:
+    # historial en el servidor: sólo si está activo; un fallo aquí no rompe la respuesta
+    if not settings.session_history:
+        return
     try:
-        top_k = req.top_k or settings.max_context_chunks
+        await run_blocking(session_store.append, sid, [("user", question), ("assistant", answer)])
+    except Exception as e:
+        logger.warning("session.error", extra={"err": str(e)})
 
-        # si tu ChatRequest no tiene 'source', getattr devolverá None
-        requested_source: Optional[str] = getattr(req, "source", None)
-        current_source: Optional[str] = requested_source or LAST_SOURCE
 
-        ctx = retrieve_context(req.message, top_k=top_k, source=current_source)
+def _remember_answer(prep: Dict[str, Any], answer: str, model: Optional[str],
+                     prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    ac = prep["answer_cache"]
+    if ac is None or not answer:
+        return
+    answer_cache.store(
+        ac["qvec"], ac["key"], ac["sources"],
+        {"answer": answer, "model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+        generation=ac["generation"],
+    )
 
-        contexts: List[str] = ctx["contexts"]
-        metas = ctx["metas"]
-        ids = ctx["ids"]
-        dists = ctx["distances"]
 
-        if not contexts:
+def _chat_error(e: Exception) -> HTTPException:
+    # Ollama caído (circuito abierto) -> 503; plazo o timeout agotado -> 504; el resto 500
+    status = error_status(e)
+    if status == 500:
+        logger.exception("chat.error", extra={"err": str(e)})
+    else:
+        logger.warning("chat.unavailable", extra={"err": str(e), "status": status})
+    headers = {"Retry-After": str(int(settings.breaker_reset))} if status == 503 else None
+    return HTTPException(status_code=status, detail=str(e), headers=headers)
+
+
+def _ms_since(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000, 1)
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest, request: Request, response: Response):
+
+    t0 = time.perf_counter()
+    sid, new = _session(request)
+    _attach_session(response, sid, new)
+    await _require_core()
+    # plazo total para las llamadas a Ollama de esta petición (embeddings + LLM, reintentos incluidos)
+    set_deadline(settings.request_deadline)
+    try:
+        prep = await _prepare_chat(req, sid)
+        extra = prep["extra"]
+        timings = prep["timings"]
+
+        if not prep["contexts"]:
+            timings["total_ms"] = _ms_since(t0)
             return ChatResponse(
-                answer="No encontré información relevante en la base de conocimientos para responder.",
+                answer=NO_CONTEXT_ANSWER,
                 used_sources=[],
                 model=None,
-                extra={"top_k": top_k, "mmr": getattr(req, "mmr", None), "source": current_source},
+                extra=extra,
             )
 
-        # Construir mensajes e invocar LLM
-        history = [m.model_dump() for m in (req.history or [])]
-        msgs = build_messages(req.message, contexts, metas, history)
+        cached = prep["cached_answer"]
+        if cached is not None:
+            timings["total_ms"] = _ms_since(t0)
+            logger.info("chat.ok", extra={"top_k": extra["top_k"], "n_ctx": len(prep["contexts"]),
+                                          "source": extra["source"], "answer_cache": "hit", "timings": timings})
+            await _save_turn(sid, req.message, cached["answer"])
+            return ChatResponse(used_sources=prep["used"], extra=extra, **cached)
 
+        # Invocar LLM (el histograma lo registra LLMClient; aquí sólo el desglose)
         llm = get_llm()
-        out = llm.chat(msgs)
+        t_llm = time.perf_counter()
+        out = await llm.achat(prep["messages"])
+        timings["llm_ms"] = _ms_since(t_llm)
+        timings["total_ms"] = _ms_since(t0)
         answer = out.get("content", "")
 
-        used = [
-            SourceChunk(
-                id=ids[i],
-                source=str((metas[i] or {}).get("source", "desconocido")),
-                page=(metas[i] or {}).get("page"),
-                distance=float(dists[i]) if dists and i < len(dists) else None,
-                text=contexts[i][:5000],
-            )
-            for i in range(len(contexts))
-        ]
-
         resp = ChatResponse(
             answer=answer,
-            used_sources=used,
+            used_sources=prep["used"],
+            # Ollama omite prompt_eval_count si reutiliza el prompt cacheado: usamos la estimación
+            prompt_tokens=out.get("prompt_tokens") or extra["prompt_tokens_est"],
+            completion_tokens=out.get("completion_tokens"),
             model=out.get("model"),
-            extra={
-                "top_k": top_k,
-                "mmr": getattr(req, "mmr", None) if getattr(req, "mmr", None) is not None else getattr(settings, "mmr", None),
-                "source": current_source,
-            },
+            extra=extra,
         )
-        logger.info("chat.ok", extra={"top_k": top_k, "n_ctx": len(contexts), "source": current_source})
+        _remember_answer(prep, answer, resp.model, resp.prompt_tokens, resp.completion_tokens)
+        await _save_turn(sid, req.message, answer)
+        logger.info("chat.ok", extra={"top_k": extra["top_k"], "n_ctx": len(prep["contexts"]), "source": extra["source"],
+                                      "prompt_tokens": resp.prompt_tokens, "completion_tokens": resp.completion_tokens,
+                                      "timings": timings})
         return resp
     except Exception as e:
-        logger.exception("chat.error", extra={"err": str(e)})
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _chat_error(e)
+
+
+def _ndjson(event: Dict[str, Any]) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    """
+    Igual que /chat pero en NDJSON, un evento por línea:
+    {"type": "sources", ...} primero, luego {"type": "token", "content": ...}
+    por cada trozo del modelo y al final {"type": "done", ...} con los tokens
+    usados y ttft_ms (tiempo hasta el primer token).
+    """
+    t0 = time.perf_counter()
+    sid, new = _session(request)
+    await _require_core()
+    set_deadline(settings.request_deadline)
+    try:
+        prep = await _prepare_chat(req, sid)
+    except Exception as e:
+        raise _chat_error(e)
+
+    extra = prep["extra"]
+    timings = prep["timings"]
+    used = [u.model_dump() for u in prep["used"]]
+
+    async def events():
+        yield _ndjson({"type": "sources", "used_sources": used, "extra": extra})
+        if not prep["contexts"]:
+            yield _ndjson({"type": "token", "content": NO_CONTEXT_ANSWER})
+            yield _ndjson({"type": "done", "answer": NO_CONTEXT_ANSWER, "model": None,
+                           "prompt_tokens": None, "completion_tokens": None, "extra": extra})
+            return
+
+        cached = prep["cached_answer"]
+        if cached is not None:
+            # respuesta ya conocida: un solo token con todo el texto
+            timings["total_ms"] = _ms_since(t0)
+            yield _ndjson({"type": "token", "content": cached["answer"]})
+            yield _ndjson({"type": "done", **cached,
+                           "extra": {**extra, "ttft_ms": timings["total_ms"], "total_ms": timings["total_ms"]}})
+            await _save_turn(sid, req.message, cached["answer"])
+            logger.info("chat.ok", extra={"top_k": extra["top_k"], "n_ctx": len(prep["contexts"]),
+                                          "source": extra["source"], "stream": True, "answer_cache": "hit",
+                                          "timings": timings})
+            return
+
+        parts: List[str] = []
+        ttft_ms: Optional[float] = None
+        t_llm = time.perf_counter()
+        try:
+            async for ev in get_llm().achat_stream(prep["messages"]):
+                if ev.get("done"):
+                    answer = "".join(parts)
+                    timings["llm_ms"] = _ms_since(t_llm)
+                    timings["total_ms"] = _ms_since(t0)
+                    prompt_tokens = ev.get("prompt_tokens") or extra["prompt_tokens_est"]
+                    _remember_answer(prep, answer, ev.get("model"), prompt_tokens, ev.get("completion_tokens"))
+                    await _save_turn(sid, req.message, answer)
+                    extra_done = {
+                        **extra,
+                        "ttft_ms": ttft_ms,
+                        "total_ms": timings["total_ms"],
+                    }
+                    yield _ndjson({
+                        "type": "done",
+                        "answer": answer,
+                        "model": ev.get("model"),
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": ev.get("completion_tokens"),
+                        "extra": extra_done,
+                    })
+                    logger.info("chat.ok", extra={"top_k": extra["top_k"], "n_ctx": len(prep["contexts"]),
+                                                  "source": extra["source"], "stream": True, "ttft_ms": ttft_ms,
+                                                  "prompt_tokens": prompt_tokens,
+                                                  "completion_tokens": ev.get("completion_tokens"),
+                                                  "timings": timings})
+                    return
+                if ttft_ms is None:
+                    ttft_ms = _ms_since(t0)
+                parts.append(ev["content"])
+                yield _ndjson({"type": "token", "content": ev["content"]})
+        except Exception as e:
+            # la respuesta ya empezó: avisamos del error dentro del stream
+            logger.exception("chat.error", extra={"err": str(e), "stream": True})
+            yield _ndjson({"type": "error", "status": error_status(e), "detail": str(e)})
+
+    resp = StreamingResponse(events(), media_type="application/x-ndjson")
+    _attach_session(resp, sid, new)
+    return resp
+
+
+@app.post("/chat/batch")
+async def chat_batch(batch: ChatBatchRequest, request: Request):
+    """
+    Muchas preguntas en una petición (evaluación offline, FAQs). Todas se
+    embeben en una sola llamada y cada grupo con la misma fuente/top_k/mmr
+    comparte una consulta a Chroma; luego el LLM se llama con hasta
+    BATCH_CONCURRENCY peticiones en paralelo. Responde en NDJSON:
+    {"type": "result", "index": i, ...ChatResponse} (o {"type": "error",
+    "index": i, "detail": ...}) según van terminando, y {"type": "done", ...}
+    al final. Sólo usa el history que venga en cada pregunta.
+    """
+    t0 = time.perf_counter()
+    reqs = batch.requests
+    if not reqs:
+        raise HTTPException(status_code=400, detail="El lote está vacío")
+    if len(reqs) > settings.batch_max_requests:
+        raise HTTPException(status_code=413,
+                            detail=f"Máximo {settings.batch_max_requests} preguntas por lote")
+    sid, new = _session(request)
+    await _require_core()
+    session_source = await run_blocking(session_store.source, sid)
+    concurrency = max(1, min(batch.concurrency or settings.batch_concurrency, settings.batch_concurrency))
+
+    # una recuperación por combinación de fuente, top_k y mmr
+    groups: Dict[Tuple[Optional[str], int, Optional[bool]], List[int]] = {}
+    for i, r in enumerate(reqs):
+        key = (r.source or session_source, r.top_k or settings.max_context_chunks, r.mmr)
+        groups.setdefault(key, []).append(i)
+
+    async def answer(i: int, ctx: Dict[str, Any], top_k: int, source: Optional[str],
+                     sem: asyncio.Semaphore) -> Dict[str, Any]:
+        r = reqs[i]
+        try:
+            history = [m.model_dump() for m in r.history] if r.history and ctx["contexts"] else []
+            prep = _build_prep(r, ctx, top_k, source, history)
+            extra = prep["extra"]
+            timings = prep["timings"]
+            if not prep["contexts"]:
+                resp = ChatResponse(answer=NO_CONTEXT_ANSWER, used_sources=[], model=None, extra=extra)
+            elif prep["cached_answer"] is not None:
+                resp = ChatResponse(used_sources=prep["used"], extra=extra, **prep["cached_answer"])
+            else:
+                async with sem:
+                    # cada pregunta tiene su plazo, contado desde que le toca turno
+                    set_deadline(settings.request_deadline)
+                    t_llm = time.perf_counter()
+                    out = await get_llm().achat(prep["messages"])
+                    timings["llm_ms"] = _ms_since(t_llm)
+                answer_text = out.get("content", "")
+                resp = ChatResponse(
+                    answer=answer_text,
+                    used_sources=prep["used"],
+                    prompt_tokens=out.get("prompt_tokens") or extra["prompt_tokens_est"],
+                    completion_tokens=out.get("completion_tokens"),
+                    model=out.get("model"),
+                    extra=extra,
+                )
+                _remember_answer(prep, answer_text, resp.model, resp.prompt_tokens, resp.completion_tokens)
+            # total_ms cuenta desde que empezó el lote
+            timings["total_ms"] = _ms_since(t0)
+            return {"type": "result", "index": i, **resp.model_dump()}
+        except Exception as e:
+            logger.exception("chat.batch.error", extra={"err": str(e), "index": i})
+            return {"type": "error", "index": i, "detail": str(e)}
+
+    async def events():
+        sem = asyncio.Semaphore(concurrency)
+        tasks: List[asyncio.Task] = []
+        errors = 0
+        cache_hits = 0
+        try:
+            # todas las preguntas en una sola llamada al embedder; cada grupo
+            # las encuentra luego en la caché de vectores
+            if len(groups) > 1:
+                try:
+                    await aembed_questions([r.message for r in reqs])
+                except Exception:
+                    pass  # el grupo lo reintenta y cae a BM25 o avisa del error
+            for (source, top_k, mmr), idxs in groups.items():
+                try:
+                    ctxs = await aretrieve_many([reqs[i].message for i in idxs], top_k=top_k, source=source, mmr=mmr)
+                except Exception as e:
+                    logger.exception("chat.batch.error", extra={"err": str(e), "source": source})
+                    for i in idxs:
+                        errors += 1
+                        yield _ndjson({"type": "error", "index": i, "detail": str(e)})
+                    continue
+                tasks.extend(asyncio.create_task(answer(i, ctx, top_k, source, sem)) for i, ctx in zip(idxs, ctxs))
+            retrieve_ms = _ms_since(t0)
+
+            for fut in asyncio.as_completed(tasks):
+                ev = await fut
+                if ev["type"] == "error":
+                    errors += 1
+                elif (ev.get("extra") or {}).get("answer_cache") == "hit":
+                    cache_hits += 1
+                yield _ndjson(ev)
+
+            summary = {"count": len(reqs), "errors": errors, "answer_cache_hits": cache_hits,
+                       "concurrency": concurrency, "groups": len(groups),
+                       "retrieve_ms": retrieve_ms, "total_ms": _ms_since(t0)}
+            yield _ndjson({"type": "done", **summary})
+            logger.info("chat.batch.ok", extra=summary)
+        finally:
+            # si el cliente se va, no seguimos gastando LLM
+            for t in tasks:
+                t.cancel()
+
+    resp = StreamingResponse(events(), media_type="application/x-ndjson")
+    _attach_session(resp, sid, new)
+    return resp
 
 
 @app.get("/debug/embed")
-def debug_embed(q: str = Query("hola mundo")):
+async def debug_embed(q: str = Query("hola mundo")):
 
     try:
-        emb = get_embeddings()
-        vecs = emb.embed([q])
+        emb = collection_handle.embedder
+        vecs = await emb.aembed([q])
         return JSONResponse({"len": len(vecs[0]), "preview": vecs[0][:8]})
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
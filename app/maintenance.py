@@ -0,0 +1,176 @@
+from __future__ import annotations
+import re
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, List
+
+import structlog
+
+from app.compact import compact_index
+from app.lexical import lexical_index
+from app.retriever import collection_handle
+from app.settings import settings
+
+"""
+Mantenimiento de la base de Chroma en CHROMA_PATH (desde app.cli, con la
+API parada: Chroma no admite dos procesos escribiendo la misma base):
+- store_stats: colecciones, chunks y páginas por fuente, tamaño en disco;
+- compact_store: índices BM25/compacto al día, colecciones huérfanas fuera,
+  HNSW rehecho sin los borrados (reindex) y VACUUM del SQLite de Chroma.
+"""
+
+logger = structlog.get_logger()
+
+_SEGMENT_DIR = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+# sufijo de la copia mientras se rehace una colección
+_REINDEX_SUFFIX = "-reindex"
+
+
+def _disk(path: Path) -> Dict[str, int]:
+    if not path.is_dir():
+        return {"sqlite_bytes": 0, "segment_bytes": 0, "total_bytes": 0}
+    sqlite_bytes = sum(p.stat().st_size for p in path.glob("chroma.sqlite3*"))
+    segments = sum(p.stat().st_size for d in path.iterdir() if d.is_dir() for p in d.rglob("*") if p.is_file())
+    return {"sqlite_bytes": sqlite_bytes, "segment_bytes": segments, "total_bytes": sqlite_bytes + segments}
+
+
+def _pages(col: Any, batch_size: int = 5000) -> Dict[str, Dict[str, Any]]:
+    # chunks, páginas distintas y marca de ingesta completa por fuente
+    out: Dict[str, Dict[str, Any]] = {}
+    total = col.count()
+    for offset in range(0, total, batch_size):
+        res = col.get(include=["metadatas"], limit=batch_size, offset=offset)
+        for meta in res.get("metadatas") or []:
+            meta = meta or {}
+            row = out.setdefault(str(meta.get("source", "")), {"chunks": 0, "pages": set(), "complete": False})
+            row["chunks"] += 1
+            row["pages"].add(meta.get("page"))
+            if meta.get("count_hash"):
+                row["complete"] = True
+    return out
+
+
+def store_stats(top: int = 20) -> Dict[str, Any]:
+    path = Path(collection_handle.path)
+    client = collection_handle.client
+    collections = []
+    sources: Dict[str, Dict[str, Any]] = {}
+    for col in client.list_collections():
+        collections.append({"name": col.name, "count": col.count()})
+        for src, row in _pages(col).items():
+            acc = sources.setdefault(src, {"chunks": 0, "pages": set(), "complete": False})
+            acc["chunks"] += row["chunks"]
+            acc["pages"] |= row["pages"]
+            acc["complete"] = acc["complete"] or row["complete"]
+    per_source = sorted(
+        ({"source": s, "chunks": r["chunks"], "pages": len(r["pages"]), "complete": r["complete"]}
+         for s, r in sources.items()),
+        key=lambda r: -r["chunks"],
+    )
+    out: Dict[str, Any] = {
+        "path": str(path),
+        "shard_mode": collection_handle.shard_mode or None,
+        "collections": len(collections),
+        "chunks": sum(c["count"] for c in collections),
+        "sources": len(per_source),
+        "incomplete_sources": [r["source"] for r in per_source if not r["complete"]],
+        "pages": sum(r["pages"] for r in per_source),
+        "top_sources": per_source[:top],
+        "disk": _disk(path),
+        "bm25_chunks": lexical_index.count(),
+    }
+    if settings.compact_index:
+        out["compact"] = compact_index.stats()
+    return out
+
+
+def _copy(src: Any, dst: Any, batch_size: int) -> int:
+    ids = src.get(include=[]).get("ids") or []
+    for start in range(0, len(ids), batch_size):
+        got = src.get(ids=ids[start:start + batch_size], include=["documents", "metadatas", "embeddings"])
+        dst.add(ids=got["ids"], documents=got["documents"], metadatas=got["metadatas"],
+                embeddings=got["embeddings"])
+    return len(ids)
+
+
+def reindex_collection(client: Any, name: str, batch_size: int = 1000) -> int:
+    """
+    Rehace una colección copiándola a otra nueva (el HNSW de Chroma no
+    suelta el sitio de lo borrado) y le devuelve el nombre original. Si una
+    ejecución anterior se cortó entre el borrado y el renombrado, la termina.
+    """
+    tmp_name = f"{name[:63 - len(_REINDEX_SUFFIX)]}{_REINDEX_SUFFIX}"
+    names = {c.name for c in client.list_collections()}
+    if name not in names and tmp_name in names:
+        client.get_collection(tmp_name).modify(name=name)
+        return client.get_collection(name).count()
+    if tmp_name in names:
+        client.delete_collection(tmp_name)
+    old = client.get_collection(name)
+    new = client.create_collection(tmp_name, metadata=old.metadata)
+    copied = _copy(old, new, batch_size)
+    client.delete_collection(name)
+    new.modify(name=name)
+    logger.info("maintenance.reindex", extra={"collection": name, "chunks": copied})
+    return copied
+
+
+def _orphan_shards(client: Any) -> List[str]:
+    # colecciones de ingestas que no llegaron a publicarse (el proceso murió a medias)
+    if not collection_handle.sharded:
+        return []
+    known = set(collection_handle.router.catalog.collections())
+    return [c.name for c in client.list_collections()
+            if c.name != collection_handle.name and c.name not in known]
+
+
+def _orphan_segment_dirs(path: Path) -> List[Path]:
+    # carpetas HNSW de segmentos que ya no están en el SQLite de Chroma
+    db = path / "chroma.sqlite3"
+    if not db.exists():
+        return []
+    conn = sqlite3.connect(str(db))
+    try:
+        known = {r[0] for r in conn.execute("SELECT id FROM segments")}
+    finally:
+        conn.close()
+    return [d for d in path.iterdir() if d.is_dir() and _SEGMENT_DIR.match(d.name) and d.name not in known]
+
+
+def compact_store(reindex: bool = False, vacuum: bool = True, batch_size: int = 1000) -> Dict[str, Any]:
+    path = Path(collection_handle.path)
+    before = _disk(path)
+    client = collection_handle.client
+    out: Dict[str, Any] = {"orphan_shards": _orphan_shards(client)}
+    for name in out["orphan_shards"]:
+        collection_handle.router.drop(name)
+
+    if reindex:
+        # una copia "-reindex" que quedó de una ejecución cortada cuenta como su colección
+        names = sorted({c.name[:-len(_REINDEX_SUFFIX)] if c.name.endswith(_REINDEX_SUFFIX) else c.name
+                        for c in client.list_collections()})
+        out["reindexed"] = {name: reindex_collection(client, name, batch_size) for name in names}
+        # los objetos de colección que tenía abiertos ya no existen
+        collection_handle.reset()
+
+    out["bm25"] = lexical_index.sync_with_collection(collection_handle.view())
+    if settings.compact_index:
+        out["compact"] = compact_index.sync_with_collection(collection_handle.view())
+
+    # lo que sigue necesita la base cerrada
+    collection_handle.close()
+    orphans = _orphan_segment_dirs(path)
+    for d in orphans:
+        shutil.rmtree(d, ignore_errors=True)
+    out["orphan_segment_dirs"] = [d.name for d in orphans]
+    if vacuum and (path / "chroma.sqlite3").exists():
+        conn = sqlite3.connect(str(path / "chroma.sqlite3"))
+        try:
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+    out["disk_before"] = before
+    out["disk_after"] = _disk(path)
+    return out
+
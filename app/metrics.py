@@ -0,0 +1,119 @@
+from __future__ import annotations
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+"""
+Métricas propias de la app. Se registran en el registro por defecto de
+prometheus_client, así que salen en /metrics junto a las del Instrumentator.
+"""
+
+CACHE_EVENTS = Counter(
+    "rag_cache_events_total",
+    "Eventos de las cachés internas (hit, miss, eviction, expired, invalidated)",
+    ["cache", "event"],
+)
+
+CACHE_SIZE = Gauge(
+    "rag_cache_entries",
+    "Entradas actuales en cada caché interna",
+    ["cache"],
+)
+
+CACHE_HIT_RATIO = Gauge(
+    "rag_cache_hit_ratio",
+    "Aciertos / consultas de cada caché interna desde el arranque",
+    ["cache"],
+)
+
+# Latencia por etapa del pipeline RAG. Los buckets llegan a 2 min porque
+# la generación del LLM puede tardar mucho más que el resto.
+_STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds",
+    "Duración de cada etapa (embed_query, retrieve, chroma_query, mmr, build_prompt, llm, llm_ttft, embed, ingest_*)",
+    ["stage"],
+    buckets=_STAGE_BUCKETS,
+)
+
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total",
+    "Tokens procesados por el LLM (prompt y completion)",
+    ["kind"],
+)
+
+EMBEDDED_TEXTS = Counter(
+    "rag_embedded_texts_total",
+    "Textos enviados al modelo de embeddings",
+)
+
+EMBED_CACHE_EVENTS = Counter(
+    "rag_embed_cache_total",
+    "Consultas a la caché persistente de embeddings por resultado (hit, miss)",
+    ["outcome"],
+)
+
+CHUNKS = Counter(
+    "rag_chunks_total",
+    "Chunks por evento (retrieved, ingest_added, ingest_kept, ingest_removed)",
+    ["event"],
+)
+
+STARTUP_SECONDS = Gauge(
+    "rag_startup_seconds",
+    "Arranque: segundos desde que se importó la app hasta cada fase (import, ready) y duración de cada paso del warm-up",
+    ["phase"],
+)
+
+READY = Gauge(
+    "rag_ready",
+    "1 cuando el warm-up terminó y la app está lista para recibir tráfico",
+)
+
+BREAKER_STATE = Gauge(
+    "rag_circuit_state",
+    "Estado del circuit breaker de cada servicio remoto (0 closed, 1 half_open, 2 open)",
+    ["upstream"],
+)
+
+RERANK_EVENTS = Counter(
+    "rag_rerank_total",
+    "Re-ranking de candidatos por resultado (applied, over_budget, error)",
+    ["outcome"],
+)
+
+UPSTREAM_EVENTS = Counter(
+    "rag_upstream_events_total",
+    "Eventos de las llamadas a Ollama (retry, failure, rejected, coalesced, deadline)",
+    ["upstream", "event"],
+)
+
+
+def observe(stage: str, seconds: float, timings: Optional[Dict[str, float]] = None) -> None:
+    # Registra la etapa en el histograma y, si se pasa, también en el desglose (ms)
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    if timings is not None:
+        timings[f"{stage}_ms"] = round(timings.get(f"{stage}_ms", 0.0) + seconds * 1000, 3)
+
+
+@contextmanager
+def timed(stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """
+    with timed("chroma_query", timings): ...
+    Mide el bloque aunque lance excepción.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0, timings)
+
+
+def count_tokens(prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    if prompt_tokens:
+        LLM_TOKENS.labels(kind="prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(kind="completion").inc(completion_tokens)
@@ -0,0 +1,62 @@
+from __future__ import annotations
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+"""
+Maximal Marginal Relevance (MMR): elige fragmentos relevantes para la
+pregunta pero poco parecidos entre sí, para no llenar el contexto con
+chunks casi duplicados (p. ej. por el solapamiento del splitter).
+"""
+
+def _normalize(m: np.ndarray) -> np.ndarray:
+    # normaliza por filas; las filas nulas quedan en 0
+    norms = np.linalg.norm(m, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+def mmr_select(
+    query_vec: Sequence[float],
+    cand_vecs: Sequence[Sequence[float]],
+    k: int,
+    lambda_mult: float = 0.5,
+    relevance: Optional[Sequence[float]] = None,
+) -> List[int]:
+    """
+    Devuelve los índices (en orden de selección) de hasta k candidatos.
+    lambda_mult=1 -> sólo relevancia, lambda_mult=0 -> sólo diversidad.
+    relevance permite pasar otra puntuación (en [0, 1]) en lugar del coseno
+    con la pregunta, p. ej. la fusión léxica + vectorial.
+    """
+    cands = np.asarray(cand_vecs, dtype=np.float32)
+    n = cands.shape[0] if cands.ndim == 2 else 0
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    cands = _normalize(cands)
+    q = _normalize(np.asarray(query_vec, dtype=np.float32).reshape(1, -1))[0]
+
+    if relevance is None:
+        # similitud coseno de todos los candidatos con la pregunta (una sola matmul)
+        relevance = cands @ q
+    else:
+        relevance = np.asarray(relevance, dtype=np.float32)
+    # similitud máxima de cada candidato con lo ya elegido; se actualiza por paso
+    max_sim = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+
+    first = int(np.argmax(relevance))
+    selected = [first]
+    available[first] = False
+
+    while len(selected) < k:
+        np.maximum(max_sim, cands @ cands[selected[-1]], out=max_sim)
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_sim
+        scores[~available] = -np.inf
+        nxt = int(np.argmax(scores))
+        selected.append(nxt)
+        available[nxt] = False
+
+    return selected
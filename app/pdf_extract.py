@@ -0,0 +1,113 @@
+from __future__ import annotations
+import functools
+import itertools
+import multiprocessing
+import re
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from app.settings import settings
+
+"""
+Extracción y limpieza del texto de los PDFs. Módulo ligero a propósito
+(sólo pypdf, y al primer uso): los procesos del pool lo importan sin cargar Chroma.
+"""
+
+_KEEP = "\n\t "
+
+
+@functools.lru_cache(maxsize=256)
+def _strip_pattern(bad: str) -> "re.Pattern[str]":
+    return re.compile("[" + re.escape(bad) + "]")
+
+
+# Limpia el texto para evitar caracteres raros
+def sanitize_text(s: str) -> str:
+    if not s:
+        return ""
+    # Normaliza caracteres a forma estándar
+    s = unicodedata.normalize("NFKC", s)
+    # Quita control chars, surrogates sueltos y NULs pero mantiene saltos y tabs.
+    # En vez de mirar carácter a carácter, miramos sólo los caracteres distintos
+    # del texto (set() va en C) y borramos los malos con una regex cacheada.
+    bad = "".join(sorted(c for c in set(s) if not (c.isprintable() or c in _KEEP)))
+    if bad:
+        s = _strip_pattern(bad).sub("", s)
+    return s.strip()
+
+
+def _page_ranges(n_pages: int, workers: int) -> List[Tuple[int, int]]:
+    # varios rangos por worker para repartir mejor páginas pesadas
+    step = max(4, -(-n_pages // (workers * 4)))
+    return [(a, min(a + step, n_pages)) for a in range(0, n_pages, step)]
+
+
+def extract_page_range(pdf_path: str, start: int, end: int) -> List[dict]:
+    # Se ejecuta dentro de un proceso del pool: abre su propio PdfReader
+    from pypdf import PdfReader
+    reader = PdfReader(pdf_path)
+    return [
+        {"page": i + 1, "text": sanitize_text(reader.pages[i].extract_text() or "")}
+        for i in range(start, end)
+    ]
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    # 'spawn' evita heredar hilos/sockets del servidor; el pool se reutiliza
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.pdf_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_pdf_texts(pdf_path: Path, workers: Optional[int] = None) -> Iterator[dict]:
+    """
+    Devuelve las páginas ({"page", "text"}) en orden según se van extrayendo.
+    PDFs grandes se reparten por rangos de páginas en un pool de procesos.
+    """
+    from pypdf import PdfReader
+    reader = PdfReader(str(pdf_path))
+    n_pages = len(reader.pages)
+    workers = settings.pdf_workers if workers is None else workers
+
+    if workers <= 1 or n_pages < settings.pdf_parallel_min_pages:
+        for i, page in enumerate(reader.pages, start=1):
+            yield {"page": i, "text": sanitize_text(page.extract_text() or "")}
+        return
+
+    # ventana acotada de rangos en vuelo: no se adelanta todo el documento en memoria
+    pool = get_pool()
+    pending = deque()
+    ranges = iter(_page_ranges(n_pages, workers))
+    try:
+        for a, b in itertools.islice(ranges, workers * 2):
+            pending.append(pool.submit(extract_page_range, str(pdf_path), a, b))
+        while pending:
+            pages = pending.popleft().result()
+            nxt = next(ranges, None)
+            if nxt is not None:
+                pending.append(pool.submit(extract_page_range, str(pdf_path), *nxt))
+            yield from pages
+    finally:
+        for fut in pending:
+            fut.cancel()
@@ -0,0 +1,151 @@
+from __future__ import annotations
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+"""
+Pipeline por etapas con colas acotadas entre ellas (backpressure): cada
+etapa corre en su hilo y sólo avanza si la siguiente tiene hueco, así la
+memoria no crece con el tamaño del documento.
+"""
+
+_DONE = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.max_queue = 0
+
+    def as_dict(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            "items": self.items,
+            "busy_s": round(self.busy, 3),
+            "items_per_s": round(self.items / self.busy, 1) if self.busy > 0 else None,
+            "utilization": round(self.busy / elapsed, 3) if elapsed > 0 else None,
+            "max_queue_depth": self.max_queue,
+        }
+
+
+def run_pipeline(
+    source: Tuple[str, Iterable[Any]],
+    stages: List[Tuple[str, Callable[[Any], Any]]],
+    sink: Tuple[str, Callable[[Any], None]],
+    queue_size: int = 4,
+    stop: Optional[threading.Event] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    source -> stages[0] -> ... -> sink, cada uno como (nombre, función/iterable).
+    Con stop (threading.Event) se puede cancelar desde fuera. Las etapas devuelven el elemento
+    transformado (None = descartar). El sink corre en el hilo que llama.
+    Si alguna etapa falla, se paran todas y se relanza la excepción.
+    Devuelve estadísticas por etapa (items, tiempo ocupado, cola máxima).
+    """
+    abort = threading.Event()
+    errors: List[BaseException] = []
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+    stats = [StageStats(source[0])] + [StageStats(n) for n, _ in stages] + [StageStats(sink[0])]
+
+    def stopped() -> bool:
+        return abort.is_set() or (stop is not None and stop.is_set())
+
+    def put(q: queue.Queue, item: Any, st: StageStats) -> None:
+        while True:
+            if stopped():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=0.1)
+                st.max_queue = max(st.max_queue, q.qsize())
+                return
+            except queue.Full:
+                continue
+
+    def get(q: queue.Queue) -> Any:
+        while True:
+            if stopped():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def fail(e: BaseException) -> None:
+        if not isinstance(e, PipelineAborted):
+            errors.append(e)
+        abort.set()
+
+    def run_source() -> None:
+        st = stats[0]
+        try:
+            it = iter(source[1])
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                st.busy += time.perf_counter() - t0
+                st.items += 1
+                put(queues[0], item, st)
+            put(queues[0], _DONE, st)
+        except BaseException as e:
+            fail(e)
+
+    def run_stage(i: int, fn: Callable[[Any], Any]) -> None:
+        st = stats[i + 1]
+        try:
+            while True:
+                item = get(queues[i])
+                if item is _DONE:
+                    put(queues[i + 1], _DONE, st)
+                    return
+                t0 = time.perf_counter()
+                out = fn(item)
+                st.busy += time.perf_counter() - t0
+                st.items += 1
+                if out is not None:
+                    put(queues[i + 1], out, st)
+        except BaseException as e:
+            fail(e)
+
+    threads = [threading.Thread(target=run_source, name="pipeline-source", daemon=True)]
+    threads += [
+        threading.Thread(target=run_stage, args=(i, fn), name=f"pipeline-{name}", daemon=True)
+        for i, (name, fn) in enumerate(stages)
+    ]
+    t_start = time.perf_counter()
+    for t in threads:
+        t.start()
+
+    st = stats[-1]
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is _DONE:
+                break
+            t0 = time.perf_counter()
+            sink[1](item)
+            st.busy += time.perf_counter() - t0
+            st.items += 1
+    except BaseException as e:
+        fail(e)
+    finally:
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    if stopped():
+        raise PipelineAborted("pipeline cancelado")
+
+    elapsed = time.perf_counter() - t_start
+    out = {s.name: s.as_dict(elapsed) for s in stats}
+    out["elapsed_s"] = round(elapsed, 3)
+    return out
@@ -1,116 +1,589 @@
 from __future__ import annotations
+import time
 from typing import Any, Dict, List, Optional
 
-from app.retriever import get_collection
+import numpy as np
+import structlog
+
+from app.concurrency import run_blocking
+from app.metrics import CHUNKS, observe, timed
+from app.cache import MISSING, normalize_question, query_vector_cache, retrieval_cache, vector_key
+from app.compact import compact_index
+from app.lexical import lexical_index, looks_like_lookup, rrf_fuse
+from app.mmr import mmr_select
+from app.rerank import rerank
+from app.retriever import collection_handle
+from app.settings import settings
+from app.tokens import MESSAGE_OVERHEAD, estimate_messages, estimate_tokens, truncate_to_tokens
+
+logger = structlog.get_logger()
+
+
+def embed_question(question: str) -> List[float]:
+    """
+    Vector de la pregunta, cacheado por (modelo de embeddings, texto normalizado).
+    """
+    key = (settings.ollama_embed_model, normalize_question(question))
+    vec = query_vector_cache.get(key)
+    if vec is MISSING:
+        vec = collection_handle.embed_query(question)
+        query_vector_cache.set(key, vec)
+    return vec
+
+
+async def aembed_question(question: str) -> List[float]:
+    # Igual que embed_question pero sin bloquear el event loop
+    key = (settings.ollama_embed_model, normalize_question(question))
+    vec = query_vector_cache.get(key)
+    if vec is MISSING:
+        vec = (await collection_handle.embedder.aembed([question]))[0]
+        query_vector_cache.set(key, vec)
+    return vec
 
 # Función para recuperar contexto desde la base vectorial (Chroma)
 
-def retrieve_context(question: str, top_k: int, source: Optional[str] = None) -> Dict[str, Any]:
+def _plan_retrieval(question: str) -> bool:
+    # True = probar sólo el índice léxico (búsqueda exacta de un código/cita)
+    return settings.hybrid_search and looks_like_lookup(question)
+
+
+def retrieve_context(
+    question: str,
+    top_k: int,
+    source: Optional[str] = None,
+    mmr: Optional[bool] = None,
+) -> Dict[str, Any]:
     """
     busca en Chroma los fragmentos más parecidos a la pregunta.
+    Con mmr=True re-ordena los candidatos con Maximal Marginal Relevance.
+    Con HYBRID_SEARCH combina además el ranking BM25 (ver _query_context).
     """
-    col = get_collection()
+    use_mmr = settings.mmr if mmr is None else mmr
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+
+    out = None
+    qvec: Optional[List[float]] = None
+    if _plan_retrieval(question):
+        out = _retrieve(question, None, top_k, source, use_mmr, timings)
+    if out is None or not out["contexts"]:
+        # Embebemos la pregunta una vez; MMR necesita el vector y Chroma lo reutiliza
+        try:
+            with timed("embed_query", timings):
+                qvec = embed_question(question)
+        except Exception as e:
+            if not settings.hybrid_search:
+                raise
+            logger.warning("embed.unavailable", extra={"err": str(e)})
+        if qvec is not None or out is None:
+            out = _retrieve(question, qvec, top_k, source, use_mmr, timings)
+    observe("retrieve", time.perf_counter() - t0, timings)
+    # qvec: vector de la pregunta (None si sólo se usó BM25), para la caché de respuestas
+    return {**out, "timings": timings, "qvec": qvec}
+
+
+async def aretrieve_context(
+    question: str,
+    top_k: int,
+    source: Optional[str] = None,
+    mmr: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """
+    Versión asíncrona de retrieve_context: el embedding va por httpx y la
+    consulta a Chroma (bloqueante) al pool de hilos acotado.
+    """
+    use_mmr = settings.mmr if mmr is None else mmr
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+
+    out = None
+    qvec: Optional[List[float]] = None
+    if _plan_retrieval(question):
+        out = await run_blocking(_retrieve, question, None, top_k, source, use_mmr, timings)
+    if out is None or not out["contexts"]:
+        try:
+            with timed("embed_query", timings):
+                qvec = await aembed_question(question)
+        except Exception as e:
+            if not settings.hybrid_search:
+                raise
+            # sin embedder seguimos sólo con BM25
+            logger.warning("embed.unavailable", extra={"err": str(e)})
+        if qvec is not None or out is None:
+            out = await run_blocking(_retrieve, question, qvec, top_k, source, use_mmr, timings)
+    observe("retrieve", time.perf_counter() - t0, timings)
+    # qvec: vector de la pregunta (None si sólo se usó BM25), para la caché de respuestas
+    return {**out, "timings": timings, "qvec": qvec}
+
+
+async def aembed_questions(questions: List[str]) -> List[List[float]]:
+    """
+    Vectores de varias preguntas: las que no están en caché (sin repetir)
+    van juntas en una sola llamada al embedder.
+    """
+    keys = [(settings.ollama_embed_model, normalize_question(q)) for q in questions]
+    vecs: List[Any] = [query_vector_cache.get(k) for k in keys]
+    todo: Dict[tuple, str] = {}
+    for k, q, v in zip(keys, questions, vecs):
+        if v is MISSING:
+            todo.setdefault(k, q)
+    if todo:
+        got = await collection_handle.embedder.aembed(list(todo.values()))
+        fresh = dict(zip(todo, got))
+        for k, v in fresh.items():
+            query_vector_cache.set(k, v)
+        vecs = [fresh[k] if v is MISSING else v for k, v in zip(keys, vecs)]
+    return vecs
+
+
+def _from_cache(cached: Dict[str, Any]) -> Dict[str, Any]:
+    # los tiempos de etapa guardados son de la petición que llenó la caché: no se repiten
+    return {**cached, "mmr_ms": None, "cached": True}
+
+
+def _retrieve_many(
+    questions: List[str],
+    qvecs: List[List[float]],
+    top_k: int,
+    source: Optional[str],
+    use_mmr: bool,
+    timings: Optional[Dict[str, float]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    _retrieve para un lote con la misma fuente/top_k/mmr: las consultas
+    que no están en caché comparten una única col.query; BM25, fusión y MMR
+    siguen siendo por pregunta.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(questions)
+    pending: List[tuple] = []
+    generation = retrieval_cache.generation
+    for i, (q, qvec) in enumerate(zip(questions, qvecs)):
+        key, mode = _retrieval_key(q, qvec, top_k, source, use_mmr)
+        cached = retrieval_cache.get(key)
+        if cached is not MISSING:
+            results[i] = _from_cache(cached)
+        else:
+            pending.append((i, key, mode))
+
+    if pending:
+        col = collection_handle.view(source)
+        n_initial = max(top_k * 3, top_k)
+        with timed("chroma_query", timings):
+            cand_lists = _vector_candidates(col, [qvecs[i] for i, _, _ in pending], n_initial, source, use_mmr,
+                                            timings)
+        for (i, key, mode), cands in zip(pending, cand_lists):
+            out = _rank(col, cands, qvecs[i], top_k, source, use_mmr, timings, questions[i], mode)
+            retrieval_cache.set(key, out, generation=generation)
+            results[i] = {**out, "cached": False}
+
+    CHUNKS.labels(event="retrieved").inc(sum(len(r["contexts"]) for r in results))
+    return results
+
+
+async def aretrieve_many(
+    questions: List[str],
+    top_k: int,
+    source: Optional[str] = None,
+    mmr: Optional[bool] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Recupera contexto para varias preguntas a la vez (/chat/batch): un solo
+    embedding por lotes y una sola consulta a Chroma. Sin embedder y con
+    HYBRID_SEARCH cae a BM25 pregunta a pregunta. Los tiempos son del lote
+    entero y se comparten entre todos los resultados.
+    """
+    use_mmr = settings.mmr if mmr is None else mmr
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+
+    qvecs: Optional[List[List[float]]] = None
+    try:
+        with timed("embed_query", timings):
+            qvecs = await aembed_questions(questions)
+    except Exception as e:
+        if not settings.hybrid_search:
+            raise
+        logger.warning("embed.unavailable", extra={"err": str(e), "batch": len(questions)})
+
+    if qvecs is not None:
+        outs = await run_blocking(_retrieve_many, questions, qvecs, top_k, source, use_mmr, timings)
+    else:
+        outs = [await run_blocking(_retrieve, q, None, top_k, source, use_mmr, timings) for q in questions]
+    observe("retrieve", time.perf_counter() - t0, timings)
+    return [
+        {**out, "timings": timings, "qvec": qvecs[i] if qvecs is not None else None}
+        for i, out in enumerate(outs)
+    ]
+
+
+def _retrieval_key(
+    question: str,
+    qvec: Optional[List[float]],
+    top_k: int,
+    source: Optional[str],
+    use_mmr: bool,
+) -> tuple:
+    # El modo decide qué entra en la clave:
+    # vector -> sólo el vector; lexical -> sólo el texto; hybrid -> ambos
+    if qvec is None:
+        mode = "lexical"
+    else:
+        mode = "hybrid" if settings.hybrid_search else "vector"
+    key = (
+        vector_key(qvec) if qvec is not None else None,
+        top_k,
+        source or None,      # invalidate_source mira esta posición
+        use_mmr,
+        mode,
+        # con RERANK el texto también cuenta (solapamiento con la pregunta)
+        normalize_question(question) if mode != "vector" or settings.rerank else None,
+    )
+    return key, mode
+
+
+def _retrieve(
+    question: str,
+    qvec: Optional[List[float]],
+    top_k: int,
+    source: Optional[str],
+    use_mmr: bool,
+    timings: Optional[Dict[str, float]] = None,
+) -> Dict[str, Any]:
+    # Consulta con caché de resultados
+    key, mode = _retrieval_key(question, qvec, top_k, source, use_mmr)
+    generation = retrieval_cache.generation
+    cached = retrieval_cache.get(key)
+    if cached is not MISSING:
+        CHUNKS.labels(event="retrieved").inc(len(cached["contexts"]))
+        return _from_cache(cached)
+
+    out = _query_context(qvec, top_k, source, use_mmr, timings, question=question, mode=mode)
+    retrieval_cache.set(key, out, generation=generation)
+    CHUNKS.labels(event="retrieved").inc(len(out["contexts"]))
+    return {**out, "cached": False}
+
+
+def _query_context(
+    qvec: Optional[List[float]],
+    top_k: int,
+    source: Optional[str],
+    use_mmr: bool,
+    timings: Optional[Dict[str, float]] = None,
+    question: Optional[str] = None,
+    mode: str = "vector",
+) -> Dict[str, Any]:
+    """
+    mode="vector": sólo Chroma; "lexical": sólo BM25; "hybrid": ambos
+    rankings fusionados con RRF. Con MMR, la relevancia de cada candidato es
+    su puntuación fusionada (o el coseno en modo vector).
+    """
+    col = collection_handle.view(source)
     n_initial = max(top_k * 3, top_k)
+    want_embs = use_mmr and qvec is not None
 
+    # id -> (documento, metadatos, distancia, embedding)
+    cands: Dict[str, tuple] = {}
+    if qvec is not None:
+        with timed("chroma_query", timings):
+            cands = _vector_candidates(col, [qvec], n_initial, source, want_embs, timings)[0]
+    return _rank(col, cands, qvec, top_k, source, use_mmr, timings, question, mode)
+
+
+def _vector_candidates(
+    col: Any,
+    qvecs: List[List[float]],
+    n_results: int,
+    source: Optional[str],
+    want_embs: bool,
+    timings: Optional[Dict[str, float]] = None,
+) -> List[Dict[str, tuple]]:
+    """
+    Una sola col.query para todos los vectores (con SHARD_MODE y sin
+    fuente, col reparte la consulta entre colecciones). Por cada uno devuelve
+    id -> (documento, metadatos, distancia, embedding), de más a menos parecido.
+    """
+    if settings.compact_index:
+        return _compact_candidates(col, qvecs, n_results, source, want_embs, timings)
+    include = ["documents", "metadatas", "distances"]  # en Chroma 0.5.x no existe "ids" en include
+    if want_embs:
+        include.append("embeddings")
     query_kwargs: Dict[str, Any] = dict(
-        query_texts=[question],
-        n_results=n_initial,
-        include=["documents", "metadatas", "distances"],  # en Chroma 0.5.x no existe "ids" en include
+        query_embeddings=qvecs,
+        n_results=n_results,
+        include=include,
     )
-    if source:
-        query_kwargs["where"] = {"source": {"$eq": source}}
-
+    where = collection_handle.source_filter(source)
+    if where:
+        query_kwargs["where"] = where
     res = col.query(**query_kwargs)
 
-    docs: List[str] = (res.get("documents") or [[]])[0]
-    metas: List[dict] = (res.get("metadatas") or [[]])[0]
-    dists: List[float] = (res.get("distances") or [[]])[0]
-
-    if not docs:
-        return {"contexts": [], "ids": [], "metas": [], "distances": []}
-
-    # Construye IDs a partir de metadatos si están, si no, enumera.
-    ids: List[str] = []
-    if metas:
-        for m in metas:
-            if isinstance(m, dict) and ("file_hash" in m or "page" in m or "chunk" in m):
-                ids.append(f"{m.get('file_hash', 'doc')}:{m.get('page', '?')}:{m.get('chunk', '?')}")
-            else:
-                ids.append("doc")
-    else:
-        ids = [f"doc:{j}" for j in range(len(docs))]
+    def row(field: str, q: int) -> Any:
+        rows = res.get(field)
+        return rows[q] if rows is not None and len(rows) > q else None
+
+    out: List[Dict[str, tuple]] = []
+    for q in range(len(qvecs)):
+        docs: List[str] = row("documents", q) or []
+        metas: List[dict] = row("metadatas", q) or []
+        dists: List[float] = row("distances", q) or []
+        ids: List[str] = row("ids", q) or []
+        embs = row("embeddings", q) if want_embs else None
+        # Orden por menor distancia (cosine): menor = más parecido
+        order = sorted(range(len(docs)), key=lambda j: (dists[j] if dists and dists[j] is not None else 1e9))
+        cands: Dict[str, tuple] = {}
+        for j in order:
+            emb = embs[j] if embs is not None and j < len(embs) else None
+            cands[ids[j]] = (docs[j], metas[j] if j < len(metas) else None, dists[j] if dists else None, emb)
+        out.append(cands)
+    return out
 
-    # Orden por menor distancia (cosine): menor = más parecido
-    if dists:
-        order = sorted(range(len(docs)), key=lambda j: (dists[j] if dists[j] is not None else 1e9))
+
+def _compact_candidates(
+    col: Any,
+    qvecs: List[List[float]],
+    n_results: int,
+    source: Optional[str],
+    want_embs: bool,
+    timings: Optional[Dict[str, float]] = None,
+) -> List[Dict[str, tuple]]:
+    """
+    Como _vector_candidates, pero con COMPACT_INDEX: barrido aproximado en
+    el índice compacto de n_results * COMPACT_OVERSAMPLE candidatos y
+    re-orden exacto (coseno) con sus vectores float, leídos de Chroma en
+    un solo col.get. Las distancias son las mismas que daría Chroma.
+    """
+    with timed("compact_scan", timings):
+        coarse = compact_index.search(qvecs, n_results * max(1, settings.compact_oversample), source)
+    wanted = list(dict.fromkeys(cid for hits in coarse for cid, _ in hits))
+    if not wanted:
+        return [{} for _ in qvecs]
+    got = col.get(ids=wanted, include=["documents", "metadatas", "embeddings"])
+    pos = {cid: j for j, cid in enumerate(got["ids"])}
+    embs = np.asarray(got["embeddings"], dtype=np.float32)
+    norms = np.linalg.norm(embs, axis=1)
+    norms[norms == 0] = 1.0
+
+    out: List[Dict[str, tuple]] = []
+    for qvec, hits in zip(qvecs, coarse):
+        # el índice puede ir por delante de Chroma un instante: ignoramos huérfanos
+        rows = [pos[cid] for cid, _ in hits if cid in pos]
+        q = np.asarray(qvec, dtype=np.float32)
+        sims = embs[rows] @ q / (norms[rows] * (np.linalg.norm(q) or 1.0))
+        cands: Dict[str, tuple] = {}
+        for o in np.argsort(-sims)[:n_results]:
+            j = rows[o]
+            emb = got["embeddings"][j] if want_embs else None
+            cands[got["ids"][j]] = (got["documents"][j], got["metadatas"][j], float(1.0 - sims[o]), emb)
+        out.append(cands)
+    return out
+
+
+def _rank(
+    col: Any,
+    cands: Dict[str, tuple],
+    qvec: Optional[List[float]],
+    top_k: int,
+    source: Optional[str],
+    use_mmr: bool,
+    timings: Optional[Dict[str, float]],
+    question: Optional[str],
+    mode: str,
+) -> Dict[str, Any]:
+    # BM25 (si toca), fusión RRF y MMR sobre los candidatos vectoriales ya traídos
+    n_initial = max(top_k * 3, top_k)
+    want_embs = use_mmr and qvec is not None
+    cands = dict(cands)
+    vec_ids: List[str] = list(cands)
+
+    lex_ids: List[str] = []
+    lex_scores: Dict[str, float] = {}
+    if mode != "vector" and question:
+        with timed("lexical", timings):
+            hits = lexical_index.search(question, n_initial, source)
+        lex_ids = [cid for cid, _ in hits]
+        lex_scores = dict(hits)
+        # los que sólo encontró BM25 hay que traerlos de Chroma
+        missing = [cid for cid in lex_ids if cid not in cands]
+        if missing:
+            include = ["documents", "metadatas"] + (["embeddings"] if want_embs else [])
+            got = col.get(ids=missing, include=include)
+            got_embs = got.get("embeddings") if want_embs else None
+            for j, cid in enumerate(got["ids"]):
+                emb = got_embs[j] if got_embs is not None and j < len(got_embs) else None
+                cands[cid] = (got["documents"][j], got["metadatas"][j], None, emb)
+            # el índice puede ir por delante de Chroma un instante: ignoramos huérfanos
+            lex_ids = [cid for cid in lex_ids if cid in cands]
+
+    if mode == "hybrid":
+        fused = rrf_fuse([vec_ids, lex_ids], k=settings.rrf_k)[:n_initial]
+        ranked = [cid for cid, _ in fused]
+        top_score = fused[0][1] if fused else 1.0
+        relevance = [score / top_score for _, score in fused]
+    elif mode == "lexical":
+        ranked = lex_ids
+        top_score = lex_scores[ranked[0]] if ranked else 1.0
+        relevance = [lex_scores[cid] / top_score for cid in ranked]
     else:
-        order = list(range(len(docs)))
+        ranked = vec_ids
+        relevance = None
+
+    if not ranked:
+        return {"contexts": [], "ids": [], "metas": [], "distances": [], "mmr": use_mmr, "mmr_ms": None, "mode": mode}
 
-    idxs = order[: min(top_k, len(order))]
+    if settings.rerank and question:
+        # rasgos baratos (ingesta + postings BM25) sobre los candidatos, con presupuesto de tiempo
+        with timed("rerank", timings):
+            reranked = rerank(question, ranked, cands, relevance)
+        if reranked is not None:
+            ranked, relevance = reranked
+
+    mmr_ms: Optional[float] = None
+    embs = [cands[cid][3] for cid in ranked]
+    if want_embs and all(e is not None for e in embs):
+        # MMR: relevancia frente a diversidad entre los candidatos
+        t0 = time.perf_counter()
+        idxs = mmr_select(qvec, embs, top_k, settings.mmr_lambda, relevance=relevance)
+        elapsed = time.perf_counter() - t0
+        observe("mmr", elapsed, timings)
+        mmr_ms = round(elapsed * 1000, 3)
+    else:
+        idxs = list(range(min(top_k, len(ranked))))
 
+    picked = [ranked[i] for i in idxs]
     return {
-        "contexts": [docs[i] for i in idxs],
-        "ids": [ids[i] for i in idxs],
-        "metas": [metas[i] for i in idxs],
-        "distances": [dists[i] for i in idxs] if dists else [],
+        "contexts": [cands[cid][0] for cid in picked],
+        "ids": picked,
+        "metas": [cands[cid][1] for cid in picked],
+        "distances": [cands[cid][2] for cid in picked],
+        "mmr": use_mmr,
+        "mmr_ms": mmr_ms,
+        "mode": mode,
     }
 
 """
 Arma el prompt para el LLM con instrucciones, historial y contexto
 """
-def build_messages(
+
+SYSTEM_PROMPT = (
+    "Eres un asistente útil. Responde SIEMPRE en español.\n"
+    "Usa exclusivamente la información en el CONTEXTO para responder.\n"
+    "Si no hay suficiente información en el contexto, dilo claramente."
+)
+
+# Por debajo de esto no merece la pena meter un fragmento recortado
+_MIN_CONTEXT_TOKENS = 48
+
+
+def _fmt_meta(m: dict | None) -> str:
+    m = m or {}
+    src = m.get("source", "desconocido")
+    page = m.get("page")
+    if page is not None:
+        return f"{src} (p. {page})"
+    return str(src)
+
+
+def _user_message(question: str, blocks: List[str]) -> str:
+    context_block = "\n\n".join(blocks) if blocks else "N/A"
+    return (
+        f"Pregunta: {question}\n\n"
+        f"CONTEXTO (fragmentos numerados):\n{context_block}\n\n"
+        "Cuando cites, referencia los fragmentos así: [1], [2]."
+    )
+
+
+def prompt_budget() -> int:
+    # Tokens para el prompt: la ventana del modelo menos lo reservado para la respuesta
+    return max(256, settings.llm_num_ctx - settings.answer_reserve_tokens)
+
+
+def pack_messages(
     question: str,
     contexts: List[str],
     metas: List[dict],
     history: Optional[List[Dict[str, str]]] = None,
-) -> List[Dict[str, str]]:
-
+    budget: Optional[int] = None,
+) -> Dict[str, Any]:
     """
-    Construye el prompt para el LLM con:
-    - instrucciones de sistema
-    - historial (si existe)
-    - la pregunta del usuario + fragmentos de contexto
+    Construye los mensajes para el LLM cabiendo en budget tokens (estimados):
+    - el sistema y la pregunta van siempre;
+    - del historial se guardan los turnos más recientes, hasta
+      history_token_share del presupuesto (el más reciente se recorta si no cabe);
+    - los fragmentos entran por orden de ranking; el primero que no cabe se
+      recorta y los demás se descartan.
+    Devuelve messages, kept (índices de contexts usados, en orden),
+    truncated (índices recortados), history_dropped y prompt_tokens_est.
     """
-    history = history or []
+    budget = budget or prompt_budget()
+    history = [
+        m for m in (history or [])
+        if m.get("role") in {"user", "assistant", "system"} and isinstance(m.get("content"), str)
+    ]
+
+    system = {"role": "system", "content": SYSTEM_PROMPT}
+    used = estimate_messages([system]) + estimate_messages([{"content": _user_message(question, [])}])
 
-    def fmt_meta(m: dict | None) -> str:
-        m = m or {}
-        src = m.get("source", "desconocido")
-        page = m.get("page")
-        if page is not None:
-            return f"{src} (p. {page})"
-        return str(src)
+    # Historial: de más reciente a más antiguo mientras quepa en su parte
+    hist_budget = min(int(budget * settings.history_token_share), max(0, budget - used))
+    kept_history: List[Dict[str, str]] = []
+    hist_used = 0
+    for m in reversed(history):
+        cost = estimate_tokens(m["content"]) + MESSAGE_OVERHEAD
+        if hist_used + cost > hist_budget:
+            if not kept_history:
+                room = hist_budget - hist_used - MESSAGE_OVERHEAD
+                if room >= _MIN_CONTEXT_TOKENS:
+                    content = truncate_to_tokens(m["content"], room)
+                    kept_history.append({"role": m["role"], "content": content})
+                    hist_used += estimate_tokens(content) + MESSAGE_OVERHEAD
+            break
+        kept_history.append({"role": m["role"], "content": m["content"]})
+        hist_used += cost
+    kept_history.reverse()
+    used += hist_used
 
+    # Contexto: por ranking hasta llenar lo que queda
     blocks: List[str] = []
+    kept: List[int] = []
+    truncated: List[int] = []
     for i, ctx in enumerate(contexts):
-        meta_str = fmt_meta(metas[i] if metas and i < len(metas) else {})
-        blocks.append(f"[{i+1}] {meta_str}\n{ctx}".strip())
-    context_block = "\n\n".join(blocks) if blocks else "N/A"
-
-    # Mensaje de sistema con instrucciones claras
-    system_msg = (
-        "Eres un asistente útil. Responde SIEMPRE en español.\n"
-        "Usa exclusivamente la información en el CONTEXTO para responder.\n"
-        "Si no hay suficiente información en el contexto, dilo claramente."
-    )
-
-    # Mensaje de usuario con la pregunta y el contexto numerado
-    user_msg = (
-        f"Pregunta: {question}\n\n"
-        f"CONTEXTO (fragmentos numerados):\n{context_block}\n\n"
-        "Cuando cites, referencia los fragmentos así: [1], [2]."
-    )
+        header = f"[{len(blocks) + 1}] {_fmt_meta(metas[i] if metas and i < len(metas) else {})}\n"
+        room = budget - used - estimate_tokens(header) - 1
+        cost = estimate_tokens(ctx)
+        if cost > room:
+            if room < _MIN_CONTEXT_TOKENS:
+                break
+            ctx = truncate_to_tokens(ctx, room)
+            cost = estimate_tokens(ctx)
+            truncated.append(i)
+        blocks.append(f"{header}{ctx}".strip())
+        kept.append(i)
+        used += estimate_tokens(header) + cost + 1
+        if truncated:
+            break
 
-    # Lista final de mensajes para el LLM
-    messages: List[Dict[str, str]] = [{"role": "system", "content": system_msg}]
+    messages: List[Dict[str, str]] = [system, *kept_history]
+    messages.append({"role": "user", "content": _user_message(question, blocks)})
+    return {
+        "messages": messages,
+        "kept": kept,
+        "truncated": truncated,
+        "history_dropped": len(history) - len(kept_history),
+        "prompt_tokens_est": estimate_messages(messages),
+    }
 
-    # Agregamos el historial si existe (conversaciones previas)
-    for m in history:
-        r = m.get("role")
-        c = m.get("content")
-        if r in {"user", "assistant", "system"} and isinstance(c, str):
-            messages.append({"role": r, "content": c})
 
-    # Finalmente añadimos la nueva pregunta del usuario
-    messages.append({"role": "user", "content": user_msg})
-    return messages
+def build_messages(
+    question: str,
+    contexts: List[str],
+    metas: List[dict],
+    history: Optional[List[Dict[str, str]]] = None,
+) -> List[Dict[str, str]]:
+    """
+    Construye el prompt para el LLM con:
+    - instrucciones de sistema
+    - historial (si existe)
+    - la pregunta del usuario + fragmentos de contexto
+    ajustado al presupuesto de tokens (ver pack_messages).
+    """
+    return pack_messages(question, contexts, metas, history)["messages"]
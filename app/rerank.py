@@ -0,0 +1,154 @@
+from __future__ import annotations
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import structlog
+
+from app.lexical import lexical_index
+from app.metrics import RERANK_EVENTS
+from app.settings import settings
+
+"""
+Re-ranking ligero de los candidatos de la búsqueda (top_k * 3), sin otro
+modelo: una suma ponderada de rasgos baratos. Los rasgos de cada chunk
+(palabras, proporción de dígitos, palabras distintas) se calculan en la
+ingesta y van en sus metadatos; el solapamiento con la pregunta sale de
+los postings del índice BM25. Si no cabe en RERANK_BUDGET_MS, se queda el
+orden original.
+"""
+
+logger = structlog.get_logger()
+
+FEATURES = ("vector", "overlap", "length", "position", "noise")
+
+# chunks con menos palabras que esto cuentan como cortos (títulos, pies de página)
+_FULL_LENGTH_WORDS = 60
+
+
+def chunk_features(text: str) -> Dict[str, Any]:
+    # rasgos que se guardan en los metadatos del chunk en la ingesta
+    words = text.split()
+    n = len(words)
+    digits = sum(c.isdigit() for c in text)
+    return {
+        "f_words": n,
+        "f_digits": round(digits / max(1, len(text)), 4),
+        "f_uniq": round(len({w.lower() for w in words}) / max(1, n), 4),
+    }
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """
+    "vector=1,overlap=0.5,noise=-0.3" -> pesos; los que no aparecen valen 0.
+    """
+    weights = {f: 0.0 for f in FEATURES}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip().lower()
+        if name not in weights:
+            raise ValueError(f"RERANK_WEIGHTS: rasgo desconocido '{name}' (válidos: {', '.join(FEATURES)})")
+        weights[name] = float(value)
+    return weights
+
+
+class FeatureReranker:
+    """
+    score = sum(peso * rasgo), todos los rasgos en [0, 1]:
+    - vector: relevancia que trae la búsqueda (RRF o coseno), normalizada;
+    - overlap: fracción (ponderada por idf) de los términos de la pregunta
+      que aparecen en el chunk;
+    - length: chunks cortos puntúan menos;
+    - position: páginas del principio puntúan más (1/sqrt(página));
+    - noise: proporción de dígitos y palabras repetidas (índices, tablas,
+      cabeceras); con peso negativo los penaliza.
+    """
+
+    name = "features"
+
+    def __init__(self, weights: Dict[str, float]):
+        self.weights = weights
+
+    def score(self, question: str, ids: List[str], cands: Dict[str, tuple],
+              relevance: Optional[List[float]], deadline: float) -> Optional[List[float]]:
+        w = self.weights
+        idf: Dict[str, float] = {}
+        matches: Dict[str, Dict[str, int]] = {}
+        if w["overlap"]:
+            idf, matches = lexical_index.term_matches(question, ids)
+        total_idf = sum(idf.values()) or 1.0
+        if relevance is None:
+            # modo vector: similitud coseno (1 - distancia)
+            relevance = [1.0 - (cands[cid][2] if cands[cid][2] is not None else 1.0) for cid in ids]
+        top = max(relevance) if relevance else 0.0
+        top = top if top > 0 else 1.0
+
+        scores: List[float] = []
+        for cid, rel in zip(ids, relevance):
+            if time.perf_counter() > deadline:
+                return None
+            doc, meta, _, _ = cands[cid]
+            meta = meta or {}
+            if "f_words" not in meta:
+                # chunks ingeridos antes de guardar los rasgos
+                meta = {**meta, **chunk_features(doc or "")}
+            page = meta.get("page") or 1
+            feats = {
+                "vector": max(0.0, rel) / top,
+                "overlap": sum(idf[t] for t in matches.get(cid, ())) / total_idf,
+                "length": min(1.0, meta["f_words"] / _FULL_LENGTH_WORDS),
+                "position": 1.0 / math.sqrt(max(1, int(page))),
+                "noise": min(1.0, max(2.0 * meta["f_digits"], 1.0 - meta["f_uniq"])),
+            }
+            scores.append(sum(w[f] * v for f, v in feats.items() if w[f]))
+        return scores
+
+
+def build_reranker(name: str) -> Optional[FeatureReranker]:
+    prov = (name or "").strip().lower()
+    if not prov:
+        return None
+    if prov == "features":
+        return FeatureReranker(parse_weights(settings.rerank_weights))
+    raise NotImplementedError(f"Re-ranker '{name}' no implementado")
+
+
+_reranker: Optional[FeatureReranker] = None
+_reranker_key: Optional[Tuple[str, str]] = None
+
+
+def get_reranker() -> Optional[FeatureReranker]:
+    # se rehace si cambian RERANK o RERANK_WEIGHTS (p. ej. desde un benchmark)
+    global _reranker, _reranker_key
+    key = (settings.rerank, settings.rerank_weights)
+    if key != _reranker_key:
+        _reranker, _reranker_key = build_reranker(settings.rerank), key
+    return _reranker
+
+
+def rerank(question: str, ids: List[str], cands: Dict[str, tuple],
+           relevance: Optional[List[float]]) -> Optional[Tuple[List[str], List[float]]]:
+    """
+    Reordena ids con el re-ranker configurado; devuelve (ids, relevancia
+    en [0, 1]) o None si está apagado, falla o se pasa del presupuesto.
+    """
+    reranker = get_reranker()
+    if reranker is None or not ids:
+        return None
+    deadline = time.perf_counter() + settings.rerank_budget_ms / 1000.0
+    try:
+        scores = reranker.score(question, ids, cands, relevance, deadline)
+    except Exception as e:
+        RERANK_EVENTS.labels(outcome="error").inc()
+        logger.warning("rerank.error", extra={"err": str(e)})
+        return None
+    if scores is None or time.perf_counter() > deadline:
+        RERANK_EVENTS.labels(outcome="over_budget").inc()
+        return None
+    RERANK_EVENTS.labels(outcome="applied").inc()
+    order = sorted(range(len(ids)), key=lambda i: -scores[i])
+    lo, hi = min(scores), max(scores)
+    span = (hi - lo) or 1.0
+    return [ids[i] for i in order], [(scores[i] - lo) / span for i in order]
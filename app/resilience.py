@@ -0,0 +1,324 @@
+from __future__ import annotations
+import asyncio
+import contextvars
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+import requests
+import structlog
+
+from app.metrics import BREAKER_STATE, UPSTREAM_EVENTS
+from app.settings import settings
+
+"""
+Capa de resiliencia para las llamadas a Ollama:
+- reintentos con backoff exponencial y jitter para fallos transitorios
+  (conexión, timeout, 429 y 5xx);
+- circuit breaker: tras BREAKER_FAILURES fallos seguidos deja de llamar
+  durante BREAKER_RESET segundos y falla al momento (CircuitOpenError);
+- plazo por petición (deadline): cada llamada usa como timeout lo que le
+  queda a la petición de /chat, no los 300 s del cliente;
+- single-flight: llamadas idénticas en vuelo comparten una sola petición.
+"""
+
+T = TypeVar("T")
+logger = structlog.get_logger()
+
+# 501 y 404/405 no se reintentan: los usa el embedder para detectar Ollama antiguo
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+_TRANSIENT = (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+# Plazo de la petición en curso (time.monotonic()); None = sin plazo.
+# Cada petición HTTP corre en su propia tarea, así que no se mezcla entre clientes.
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("ollama_deadline", default=None)
+
+
+def set_deadline(seconds: Optional[float]) -> None:
+    # fija el plazo para lo que queda de la tarea actual (nunca lo alarga)
+    if not seconds or seconds <= 0:
+        return
+    new = time.monotonic() + seconds
+    current = _deadline.get()
+    _deadline.set(new if current is None else min(current, new))
+
+
+def remaining() -> Optional[float]:
+    dl = _deadline.get()
+    return None if dl is None else dl - time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    closed -> (N fallos seguidos) -> open -> (reset_timeout) -> half_open:
+    deja pasar una sola llamada de prueba; si va bien vuelve a closed y si
+    falla a open otra vez.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        BREAKER_STATE.labels(upstream=name).set(0)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def _set(self, state: str) -> None:
+        if state != self._state:
+            logger.warning("breaker.state", extra={"upstream": self.name, "from": self._state, "to": state})
+        self._state = state
+        BREAKER_STATE.labels(upstream=self.name).set(_STATE_VALUE[state])
+
+    def allow(self) -> None:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set(HALF_OPEN)
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        UPSTREAM_EVENTS.labels(upstream=self.name, event="rejected").inc()
+        raise CircuitOpenError(f"{self.name}: Ollama no responde, circuito abierto")
+
+    def release(self) -> None:
+        # la llamada de prueba terminó sin veredicto (cancelada, plazo agotado)
+        with self._lock:
+            self._probing = False
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set(CLOSED)
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            probing, self._probing = self._probing, False
+            if probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set(OPEN)
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class Upstream:
+    """
+    Un servicio remoto (el LLM o el embedder) con su breaker, política de
+    reintentos y tabla de llamadas en vuelo. call()/acall() reciben una
+    función que hace la petición con el timeout que se le pasa y devuelve
+    la respuesta (requests o httpx); el llamante hace raise_for_status.
+    En streaming, sólo se reintenta hasta recibir las cabeceras.
+    """
+
+    def __init__(self, name: str, attempts: Optional[int] = None, backoff: Optional[float] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.attempts = max(1, (settings.ollama_retries if attempts is None else attempts) + 1)
+        self.backoff = settings.ollama_retry_backoff if backoff is None else backoff
+        self.breaker = breaker or CircuitBreaker(name, settings.breaker_failures, settings.breaker_reset)
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+
+    def timeout(self, default: float) -> float:
+        # lo que queda del plazo de la petición, sin pasar del timeout del cliente
+        left = remaining()
+        if left is None:
+            return default
+        if left <= 0:
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="deadline").inc()
+            raise DeadlineExceeded(f"{self.name}: se agotó el plazo de la petición")
+        return min(default, left)
+
+    def delay(self, attempt: int) -> Optional[float]:
+        # full jitter; None si ya no cabe otro intento en el plazo
+        d = random.uniform(0, min(4.0, self.backoff * (2 ** attempt)))
+        left = remaining()
+        if left is not None and left <= d:
+            return None
+        return d
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.breaker.success()
+        else:
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="failure").inc()
+            self.breaker.failure()
+
+    @staticmethod
+    def _retryable(resp: Any) -> bool:
+        return getattr(resp, "status_code", 200) in RETRY_STATUS
+
+    # -- llamadas completas
+
+    def call(self, fn: Callable[[float], T], default_timeout: float, key: Optional[str] = None) -> T:
+        if key is not None and settings.coalesce_requests:
+            return self._single_flight(key, lambda: self._call(fn, default_timeout))
+        return self._call(fn, default_timeout)
+
+    def _call(self, fn: Callable[[float], T], default_timeout: float) -> T:
+        for attempt in range(self.attempts):
+            timeout = self.timeout(default_timeout)
+            self.breaker.allow()
+            try:
+                resp = fn(timeout)
+            except _TRANSIENT as e:
+                wait = self._on_error(attempt, e)
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                wait = self._on_response(attempt, resp)
+                if wait is None:
+                    return resp
+                resp.close()   # libera la conexión (respuestas en streaming)
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="retry").inc()
+            time.sleep(wait)
+        raise AssertionError("inalcanzable")
+
+    async def acall(self, fn: Callable[[float], Awaitable[T]], default_timeout: float,
+                    key: Optional[str] = None) -> T:
+        if key is not None and settings.coalesce_requests:
+            return await self._asingle_flight(key, lambda: self._acall(fn, default_timeout))
+        return await self._acall(fn, default_timeout)
+
+    async def _acall(self, fn: Callable[[float], Awaitable[T]], default_timeout: float) -> T:
+        for attempt in range(self.attempts):
+            timeout = self.timeout(default_timeout)
+            self.breaker.allow()
+            try:
+                resp = await fn(timeout)
+            except _TRANSIENT as e:
+                wait = self._on_error(attempt, e)
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                wait = self._on_response(attempt, resp)
+                if wait is None:
+                    return resp
+                await resp.aclose()
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="retry").inc()
+            await asyncio.sleep(wait)
+        raise AssertionError("inalcanzable")
+
+    def _on_error(self, attempt: int, e: BaseException) -> float:
+        # fallo de transporte: devuelve la espera hasta el siguiente intento o relanza
+        left = remaining()
+        if left is not None and left <= 0:
+            # el timeout lo acortó el plazo de la petición: no cuenta contra Ollama
+            self.breaker.release()
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="deadline").inc()
+            raise DeadlineExceeded(f"{self.name}: se agotó el plazo de la petición") from e
+        self.record(False)
+        wait = self.delay(attempt) if attempt + 1 < self.attempts else None
+        if wait is None:
+            raise e
+        return wait
+
+    def _on_response(self, attempt: int, resp: Any) -> Optional[float]:
+        # None = devolver la respuesta (buena, o mala tras el último intento)
+        ok = not self._retryable(resp)
+        self.record(ok)
+        if ok or attempt + 1 >= self.attempts:
+            return None
+        return self.delay(attempt)
+
+    # -- single-flight
+
+    def _single_flight(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="coalesced").inc()
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    async def _asingle_flight(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            # tarea aparte: si el primer cliente se va, los demás siguen esperando la respuesta
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._tasks.pop(key, None) if self._tasks.get(key) is t else None)
+        else:
+            UPSTREAM_EVENTS.labels(upstream=self.name, event="coalesced").inc()
+        return await asyncio.shield(task)
+
+
+def error_status(e: BaseException) -> int:
+    # código HTTP para un fallo de Ollama: 503 circuito abierto, 504 plazo o timeout agotado
+    if isinstance(e, CircuitOpenError):
+        return 503
+    if isinstance(e, (DeadlineExceeded, requests.Timeout, httpx.TimeoutException)):
+        return 504
+    return 500
+
+
+_upstreams: Dict[str, Upstream] = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name: str) -> Upstream:
+    # uno por servicio y proceso: todos los clientes comparten el mismo breaker
+    with _upstreams_lock:
+        if name not in _upstreams:
+            _upstreams[name] = Upstream(name)
+        return _upstreams[name]
+
+
+def request_key(url: str, payload: Dict[str, Any]) -> str:
+    # clave de single-flight: misma URL y mismo cuerpo
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(f"{url}\n{raw}".encode("utf-8")).hexdigest()
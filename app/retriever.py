@@ -1,21 +1,31 @@
 from __future__ import annotations
-from typing import List, Dict, Any, Iterable
-import chromadb
+from pathlib import Path
+from typing import List, Dict, Any, Iterable, Optional
+import threading
+
+import structlog
 
 from app.settings import settings
 from app.embeddings import get_embeddings
+from app.shards import SHARD_MODES, SOURCE, ShardCatalog, ShardRouter
+
+logger = structlog.get_logger()
 
 """
 Busca en la base vectorial Chroma los documentos más parecidos a una consulta.
 """
 
-__all__ = ["get_collection", "search", "build_embedding_function"]
+__all__ = ["CollectionHandle", "collection_handle", "get_collection", "search", "build_embedding_function"]
 
 class _LocalEmbeddingFunction:
 
     def __init__(self):
         self._embedder = get_embeddings()
 
+    @property
+    def embedder(self):
+        return self._embedder
+
     def __call__(self, input: Iterable[str]) -> List[List[float]]:
         texts: List[str] = list(input)
         return self._embedder.embed(texts)
@@ -29,19 +39,172 @@ def build_embedding_function(provider: str):
         return _LocalEmbeddingFunction()
     raise NotImplementedError(f"Embeddings provider '{provider}' no implementado")
 
+class CollectionHandle:
+    """
+    Cliente de Chroma + colección compartidos por todo el proceso.
+    Se abre una vez (en el arranque de la app o en el primer uso) y se
+    reutiliza en /chat, /ingest y search(); close() libera la persistencia
+    y el siguiente get() la vuelve a abrir. Con SHARD_MODE las fuentes
+    viven en colecciones aparte (app.shards): view() da la colección (o el
+    fan-out) que hay que consultar y writable()/publish() dónde escribir.
+    """
+
+    def __init__(self, path: str, name: str = "docs", shard_mode: Optional[str] = None):
+        self.path = path
+        self.name = name
+        self.shard_mode = (settings.shard_mode if shard_mode is None else shard_mode).strip().lower()
+        if self.shard_mode not in SHARD_MODES:
+            raise ValueError(f"SHARD_MODE no válido: '{self.shard_mode}' (source, hash o vacío)")
+        self._lock = threading.Lock()
+        self._client = None
+        self._collection = None
+        self._ef = None
+        self._router: Optional[ShardRouter] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._collection is not None
+
+    def open(self):
+        with self._lock:
+            if self._collection is None:
+                # import diferido: chromadb tarda medio segundo en cargar y el
+                # arranque (LAZY_STARTUP) no debería pagarlo
+                import chromadb
+                client = chromadb.PersistentClient(path=self.path)
+                ef = build_embedding_function(settings.embeddings_provider)
+                self._ef = ef
+                self._collection = client.get_or_create_collection(
+                    name=self.name,
+                    embedding_function=ef,
+                    metadata={"hnsw:space": "cosine"},
+                )
+                self._client = client
+                if self.shard_mode:
+                    # el catálogo va dentro de CHROMA_PATH: si se borra la base, se va con ella
+                    catalog = ShardCatalog(Path(self.path) / "shards.sqlite3")
+                    self._router = ShardRouter(client, ef, self.shard_mode, catalog, settings.shard_buckets)
+            return self._collection
+
+    def get(self):
+        col = self._collection
+        if col is not None:
+            return col
+        return self.open()
+
+    def close(self) -> None:
+        with self._lock:
+            client, self._client, self._collection, self._ef = self._client, None, None, None
+            router, self._router = self._router, None
+            if router is not None:
+                router.close()
+            if client is None:
+                return
+            # Chroma cachea un System por ruta: lo paramos y lo sacamos de la caché
+            # para que el próximo open() lea de nuevo el disco. Es interno de
+            # chromadb (0.5.x); clear_system_cache() es público pero no para el
+            # System (no suelta los archivos) y vacía la caché entera.
+            cache = getattr(type(client), "_identifier_to_system", None)
+            ident = getattr(client, "_identifier", None)
+            if isinstance(cache, dict) and ident is not None:
+                system = cache.pop(ident, None)
+                if system is not None:
+                    system.stop()
+                return
+            logger.warning("chroma.close_fallback", extra={"path": self.path})
+            client.clear_system_cache()
+
+    @property
+    def client(self):
+        # cliente de Chroma (mantenimiento: listar, copiar y renombrar colecciones)
+        if self._client is None:
+            self.open()
+        return self._client
+
+    @property
+    def embedder(self):
+        # Proveedor de embeddings de la colección (para las llamadas asíncronas)
+        ef = self._ef
+        if ef is None:
+            self.open()
+            ef = self._ef
+        return ef.embedder
+
+    def embed_query(self, text: str) -> List[float]:
+        # Reutiliza la misma función de embeddings (y su sesión HTTP) que la colección
+        ef = self._ef
+        if ef is None:
+            self.open()
+            ef = self._ef
+        return ef([text])[0]
+
+    # -- shards
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.shard_mode)
+
+    @property
+    def router(self) -> ShardRouter:
+        if self._router is None:
+            self.open()
+        return self._router
+
+    def view(self, source: Optional[str] = None):
+        # dónde buscar: la colección única, la de la fuente o todas en paralelo
+        if not self.sharded:
+            return self.get()
+        return self.router.view(source)
+
+    def source_filter(self, source: Optional[str]) -> Optional[Dict[str, Any]]:
+        # con una colección por fuente el where sobra: ya sólo hay chunks suyos
+        if not source or self.shard_mode == SOURCE:
+            return None
+        return {"source": {"$eq": source}}
+
+    def writable(self, source: str):
+        if not self.sharded:
+            return self.get()
+        return self.router.writable(source)
+
+    def publish(self, source: str, col, file_hash: Optional[str], chunks: int) -> None:
+        # ingesta completa: en modo source, desde aquí las consultas ven col
+        if self.sharded:
+            self.router.publish(source, col, file_hash, chunks)
+
+    def abandon(self, col) -> None:
+        if self.sharded:
+            self.router.abandon(col)
+
+    def delete_source(self, source: str, ids: List[str]) -> None:
+        if self.sharded:
+            self.router.delete_source(source, ids)
+        elif ids:
+            self.get().delete(ids=ids)
+
+    def sources_with_hash(self, file_hash: str) -> List[str]:
+        # fuentes cuya última ingesta completa fue este archivo (sólo con SHARD_MODE)
+        return self.router.catalog.sources_with_hash(file_hash) if self.sharded else []
+
+    def count(self) -> int:
+        return self.view().count()
+
+    def reset(self):
+        # Cierra y vuelve a abrir (p. ej. tras borrar data/chroma)
+        self.close()
+        return self.open()
+
+
+collection_handle = CollectionHandle(settings.chroma_path)
+
+
 def get_collection():
-    client = chromadb.PersistentClient(path=settings.chroma_path)
-    ef = build_embedding_function(settings.embeddings_provider)
-    return client.get_or_create_collection(
-        name="docs",
-        embedding_function=ef,
-        metadata={"hnsw:space": "cosine"},
-    )
+    return collection_handle.get()
 
 def search(query: str, k: int = 6) -> List[Dict[str, Any]]:
-    col = get_collection()
+    col = collection_handle.view()
     res = col.query(
-        query_texts=[query],
+        query_embeddings=[collection_handle.embed_query(query)],
         n_results=k,
         include=["documents", "metadatas", "distances"],
     )
@@ -17,6 +17,14 @@ class ChatRequest(BaseModel):
     mmr: Optional[bool] = None
     history: Optional[List[ChatMessage]] = None
     source: Optional[str] = None
+    # True: devuelve en extra["timings"] el desglose de tiempos por etapa (ms)
+    timings: bool = False
+
+# Varias preguntas de una vez (/chat/batch): evaluación offline, FAQs...
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest]
+    # llamadas al LLM en paralelo; None = BATCH_CONCURRENCY (nunca más que eso)
+    concurrency: Optional[int] = None
 
 # Un fragmento de documento recuperado como fuente
 class SourceChunk(BaseModel):
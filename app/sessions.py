@@ -0,0 +1,152 @@
+from __future__ import annotations
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.settings import settings
+
+"""
+Estado por sesión (fuente activa e historial opcional en el servidor) en
+SQLite junto a data/chroma, así que sobrevive a reinicios. La API corre en
+un solo proceso (Chroma y las cachés de /chat no se comparten entre
+procesos); el timeout de la conexión cubre a app.cli abriendo el archivo.
+"""
+
+SESSION_HEADER = "X-Session-ID"
+SESSION_COOKIE = "rag_session"
+
+_VALID_ID = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def valid_session_id(value: Optional[str]) -> bool:
+    return bool(value) and bool(_VALID_ID.match(value))
+
+
+def default_sessions_path() -> Path:
+    return Path(settings.sessions_db_path or Path(settings.chroma_path).parent / "sessions.sqlite3")
+
+
+class SessionStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # timeout: app.cli puede tener el archivo bloqueado un instante
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    " id TEXT PRIMARY KEY, source TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS messages ("
+                    " session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL,"
+                    " PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+                )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _touch(conn: sqlite3.Connection, session_id: str) -> None:
+        now = time.time()
+        conn.execute(
+            "INSERT INTO sessions (id, created_at, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+            (session_id, now, now),
+        )
+
+    def get(self, session_id: str) -> Dict[str, object]:
+        with self._lock:
+            conn = self._db()
+            row = conn.execute(
+                "SELECT source, created_at, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            n = conn.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+        source, created, updated = row if row else (None, None, None)
+        return {"id": session_id, "source": source, "messages": n, "created_at": created, "updated_at": updated}
+
+    def source(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._db().execute("SELECT source FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_source(self, session_id: str, source: Optional[str]) -> None:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                self._touch(conn, session_id)
+                conn.execute("UPDATE sessions SET source = ? WHERE id = ?", (source, session_id))
+
+    def history(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
+        # últimos mensajes, en orden cronológico
+        limit = limit or settings.session_history_max
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        return [{"role": r, "content": c} for r, c in reversed(rows)]
+
+    def append(self, session_id: str, messages: Sequence[Tuple[str, str]]) -> None:
+        """
+        Añade mensajes (rol, texto) y recorta a los últimos
+        session_history_max para que el historial no crezca sin límite.
+        """
+        if not messages:
+            return
+        with self._lock:
+            conn = self._db()
+            with conn:
+                self._touch(conn, session_id)
+                last = conn.execute(
+                    "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                conn.executemany(
+                    "INSERT INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                    [(session_id, last + i + 1, role, content) for i, (role, content) in enumerate(messages)],
+                )
+                conn.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND seq <= ?",
+                    (session_id, last + len(messages) - settings.session_history_max),
+                )
+
+    def reset(self, session_id: str) -> None:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def prune(self, max_idle_s: float) -> int:
+        # borra las sesiones sin actividad desde hace max_idle_s
+        cutoff = time.time() - max_idle_s
+        with self._lock:
+            conn = self._db()
+            with conn:
+                ids = [r[0] for r in conn.execute("SELECT id FROM sessions WHERE updated_at < ?", (cutoff,))]
+                conn.executemany("DELETE FROM messages WHERE session_id = ?", [(i,) for i in ids])
+                conn.executemany("DELETE FROM sessions WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+session_store = SessionStore(default_sessions_path())
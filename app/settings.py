@@ -19,18 +19,112 @@ class Settings(BaseModel):
     llm_provider: str = os.getenv("LLM_PROVIDER", "ollama")
     ollama_host: str = os.getenv("OLLAMA_HOST", "http://localhost:11434")
     ollama_model: str = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
+    llm_timeout: float = float(os.getenv("LLM_TIMEOUT", "300"))
+    ollama_connect_timeout: float = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+    ollama_max_connections: int = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+    # Cuánto mantiene Ollama los modelos en memoria tras cada llamada ("30m", "-1" = siempre; vacío = lo de Ollama)
+    ollama_keep_alive: str = os.getenv("OLLAMA_KEEP_ALIVE", "")
+    # Ventana de contexto del modelo; el prompt se ajusta a NUM_CTX - ANSWER_RESERVE_TOKENS
+    llm_num_ctx: int = int(os.getenv("NUM_CTX", "8192"))
+    answer_reserve_tokens: int = int(os.getenv("ANSWER_RESERVE_TOKENS", "1024"))
+    # Parte máxima del presupuesto del prompt para el historial
+    history_token_share: float = float(os.getenv("HISTORY_TOKEN_SHARE", "0.25"))
+
+    # Resiliencia de las llamadas a Ollama: reintentos con jitter para fallos
+    # transitorios, circuit breaker y plazo total por petición (0 = sin plazo)
+    ollama_retries: int = int(os.getenv("OLLAMA_RETRIES", "2"))
+    ollama_retry_backoff: float = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.25"))
+    breaker_failures: int = int(os.getenv("BREAKER_FAILURES", "5"))
+    breaker_reset: float = float(os.getenv("BREAKER_RESET", "30"))
+    request_deadline: float = float(os.getenv("REQUEST_DEADLINE", "300"))
+    # Llamadas idénticas en vuelo (mismo payload) comparten una sola petición
+    coalesce_requests: bool = _get_bool("COALESCE_REQUESTS", True)
 
     # Embeddings
     embeddings_provider: str = os.getenv("EMBEDDINGS_PROVIDER", "ollama")
     ollama_embed_model: str = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text:latest")
+    embed_concurrency: int = int(os.getenv("EMBED_CONCURRENCY", "4"))
+    embed_timeout: float = float(os.getenv("EMBED_TIMEOUT", "180"))
+    # Caché persistente de embeddings por (modelo, texto) en SQLite (vacío = data/embed_cache.sqlite3
+    # junto a CHROMA_PATH); pasado EMBED_CACHE_MAX_MB se borran los menos usados (0 = sin límite)
+    embed_cache: bool = _get_bool("EMBED_CACHE", True)
+    embed_cache_path: str = os.getenv("EMBED_CACHE_PATH", "")
+    embed_cache_max_mb: float = float(os.getenv("EMBED_CACHE_MAX_MB", "1024"))
 
     # Chroma / RAG
     chroma_path: str = os.getenv("CHROMA_PATH", "./data/chroma")
     max_context_chunks: int = int(os.getenv("MAX_CONTEXT_CHUNKS", "6"))
     mmr: bool = _get_bool("MMR", True)
+    mmr_lambda: float = float(os.getenv("MMR_LAMBDA", "0.5"))
+    # Búsqueda híbrida: BM25 (SQLite junto a CHROMA_PATH) + vectores, fusionados con RRF
+    hybrid_search: bool = _get_bool("HYBRID_SEARCH", True)
+    bm25_path: str = os.getenv("BM25_PATH", "")
+    rrf_k: int = int(os.getenv("RRF_K", "60"))
+    # Re-ranking ligero de los candidatos ("features" o vacío), pesos de cada rasgo
+    # y presupuesto en ms: si se pasa, se queda el orden de la búsqueda
+    rerank: str = os.getenv("RERANK", "")
+    rerank_weights: str = os.getenv("RERANK_WEIGHTS", "vector=1.0,overlap=0.5,length=0.15,position=0,noise=-0.3")
+    rerank_budget_ms: float = float(os.getenv("RERANK_BUDGET_MS", "5"))
+    # Índice compacto (int8 o binary en un memmap junto a CHROMA_PATH) para el barrido
+    # vectorial; de Chroma sólo se leen los vectores exactos de los k * OVERSAMPLE mejores
+    compact_index: bool = _get_bool("COMPACT_INDEX", False)
+    compact_quant: str = os.getenv("COMPACT_QUANT", "int8")
+    compact_path: str = os.getenv("COMPACT_PATH", "")
+    compact_oversample: int = int(os.getenv("COMPACT_OVERSAMPLE", "4"))
+    # Colecciones por fuente ("source") o por cubo de hash ("hash", SHARD_BUCKETS cubos);
+    # vacío = una sola colección. Las consultas sin fuente van a todas con SHARD_FANOUT_WORKERS hilos
+    shard_mode: str = os.getenv("SHARD_MODE", "")
+    shard_buckets: int = int(os.getenv("SHARD_BUCKETS", "16"))
+    shard_fanout_workers: int = int(os.getenv("SHARD_FANOUT_WORKERS", "8"))
     chunk_size: int = int(os.getenv("CHUNK_SIZE", "1200"))
     chunk_overlap: int = int(os.getenv("CHUNK_OVERLAP", "220"))
     ingest_batch_size: int = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+    # Extracción de PDFs en paralelo (procesos); PDFs pequeños van en serie
+    pdf_workers: int = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+    pdf_parallel_min_pages: int = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+    # Lotes en vuelo entre etapas del pipeline de ingesta (extraer -> embeber -> escribir)
+    ingest_queue_depth: int = int(os.getenv("INGEST_QUEUE_DEPTH", "4"))
+    # Trabajos de ingesta en segundo plano (vacío = data/jobs.sqlite3 junto a CHROMA_PATH)
+    ingest_concurrency: int = int(os.getenv("INGEST_CONCURRENCY", "2"))
+    jobs_db_path: str = os.getenv("JOBS_DB_PATH", "")
+    # Subidas: se copian a disco por trozos de UPLOAD_CHUNK_SIZE (con su SHA-256);
+    # máximo por archivo y, en /ingest/bulk, por petición y número de archivos
+    upload_max_bytes: int = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+    upload_chunk_size: int = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+    bulk_max_bytes: int = int(os.getenv("BULK_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+    bulk_max_files: int = int(os.getenv("BULK_MAX_FILES", "200"))
+
+    # Cachés de /chat (tamaño en entradas, TTL en segundos)
+    query_cache_size: int = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+    query_cache_ttl: float = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+    retrieval_cache_size: int = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))
+    retrieval_cache_ttl: float = float(os.getenv("RETRIEVAL_CACHE_TTL", "300"))
+    # Respuestas: preguntas parecidas (coseno >= umbral) con el mismo contexto recuperado
+    answer_cache_size: int = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+    answer_cache_ttl: float = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    answer_cache_threshold: float = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+    # Sesiones por cliente (cookie/cabecera X-Session-ID) en SQLite; sobreviven a reinicios
+    # (la API corre en un solo proceso, ver README). SESSION_HISTORY, opcional: guardar
+    # los turnos y usarlos cuando /chat no trae history
+    sessions_db_path: str = os.getenv("SESSIONS_DB_PATH", "")
+    session_history: bool = _get_bool("SESSION_HISTORY", False)
+    session_history_max: int = int(os.getenv("SESSION_HISTORY_MAX", "40"))
+    session_ttl: float = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+
+    # /chat/batch: llamadas al LLM en paralelo por lote y preguntas máximas por petición
+    batch_concurrency: int = int(os.getenv("BATCH_CONCURRENCY", "4"))
+    batch_max_requests: int = int(os.getenv("BATCH_MAX_REQUESTS", "500"))
+
+    # Arranque: LAZY_STARTUP no espera a Chroma/BM25 (se abren en segundo plano y
+    # /health/ready dice cuándo está listo); WARMUP_MODELS precarga LLM y embeddings
+    lazy_startup: bool = _get_bool("LAZY_STARTUP", False)
+    warmup_models: bool = _get_bool("WARMUP_MODELS", True)
+    # Lo que espera una petición que llega durante el arranque antes de dar 503
+    ready_timeout: float = float(os.getenv("READY_TIMEOUT", "60"))
+
+    # Hilos para trabajo bloqueante (Chroma, pypdf) fuera del event loop
+    blocking_workers: int = int(os.getenv("BLOCKING_WORKERS", "8"))
 
     cors_allow_origins: list[str] = Field(default_factory=lambda: ["*"])
 
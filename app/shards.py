@@ -0,0 +1,329 @@
+from __future__ import annotations
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import structlog
+
+from app.settings import settings
+
+"""
+Colecciones de Chroma por fuente (SHARD_MODE=source) o por cubo de hash del
+nombre de la fuente (SHARD_MODE=hash), con un catálogo en SQLite dentro de
+CHROMA_PATH: fuente -> colección, y file_hash y chunks de su última ingesta
+completa. Una consulta con fuente va sólo a su colección; sin fuente se
+lanza a todas en paralelo y se mezclan los mejores por distancia.
+"""
+
+SOURCE, HASH = "source", "hash"
+SHARD_MODES = ("", SOURCE, HASH)
+
+# hnsw:batch_size pequeño: Chroma compara uno a uno, en Python, los vectores
+# que aún no pasó al HNSW (hasta batch_size); con muchas colecciones pesa
+_SHARD_METADATA = {"hnsw:space": "cosine", "hnsw:batch_size": 10}
+
+logger = structlog.get_logger()
+
+
+def bucket_name(source: str, buckets: int) -> str:
+    # crc32: estable entre procesos (hash() de Python no lo es)
+    return f"bucket-{zlib.crc32(source.encode('utf-8')) % max(1, buckets):03d}"
+
+
+def new_shard_name(source: str) -> str:
+    # cada ingesta de una fuente va a una colección nueva; Chroma admite [a-zA-Z0-9._-], 3-63 caracteres
+    return f"src-{hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]}-{uuid.uuid4().hex[:8]}"
+
+
+class ShardCatalog:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS shards ("
+                    " source TEXT PRIMARY KEY, collection TEXT NOT NULL, file_hash TEXT,"
+                    " chunks INTEGER DEFAULT 0, updated_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS shards_hash ON shards (file_hash)")
+            self._conn = conn
+        return self._conn
+
+    def collection_of(self, source: str) -> Optional[str]:
+        with self._lock:
+            row = self._db().execute("SELECT collection FROM shards WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def collections(self) -> List[str]:
+        with self._lock:
+            rows = self._db().execute("SELECT DISTINCT collection FROM shards ORDER BY collection").fetchall()
+        return [r[0] for r in rows]
+
+    def sources_with_hash(self, file_hash: str) -> List[str]:
+        with self._lock:
+            rows = self._db().execute("SELECT source FROM shards WHERE file_hash = ?", (file_hash,)).fetchall()
+        return [r[0] for r in rows]
+
+    def set(self, source: str, collection: str, file_hash: Optional[str] = None, chunks: int = 0) -> Optional[str]:
+        # registra (o cambia) la colección de la fuente; devuelve la anterior
+        with self._lock:
+            conn = self._db()
+            with conn:
+                row = conn.execute("SELECT collection FROM shards WHERE source = ?", (source,)).fetchone()
+                conn.execute(
+                    "INSERT INTO shards (source, collection, file_hash, chunks, updated_at) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT(source) DO UPDATE SET collection = excluded.collection,"
+                    " file_hash = excluded.file_hash, chunks = excluded.chunks, updated_at = excluded.updated_at",
+                    (source, collection, file_hash, chunks, time.time()),
+                )
+        return row[0] if row else None
+
+    def remove(self, source: str) -> Optional[str]:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                row = conn.execute("SELECT collection FROM shards WHERE source = ?", (source,)).fetchone()
+                conn.execute("DELETE FROM shards WHERE source = ?", (source,))
+        return row[0] if row else None
+
+    def in_use(self, collection: str) -> bool:
+        with self._lock:
+            row = self._db().execute("SELECT 1 FROM shards WHERE collection = ? LIMIT 1", (collection,)).fetchone()
+        return row is not None
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT source, collection, file_hash, chunks, updated_at FROM shards ORDER BY source"
+            ).fetchall()
+        return [dict(zip(("source", "collection", "file_hash", "chunks", "updated_at"), r)) for r in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ThreadPoolExecutor:
+    # pool propio: el fan-out corre dentro de run_blocking y no debe esperar a su mismo pool
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(1, settings.shard_fanout_workers),
+                                       thread_name_prefix="shard")
+        return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ShardFanout:
+    """
+    Vista de sólo lectura sobre varias colecciones con la parte de la API
+    de Chroma que usa la app (query, get y count). Cada llamada va a todas
+    las colecciones en paralelo; query mezcla por distancia y devuelve los
+    n_results mejores de todas.
+    """
+
+    def __init__(self, collections: List[Any]):
+        self.collections = collections
+
+    def _map(self, fn: Callable[[Any], Any]) -> List[Any]:
+        return self._map_over(self.collections, lambda c, _: fn(c), self.collections)
+
+    @staticmethod
+    def _map_over(collections: List[Any], fn: Callable[[Any, Any], Any], keys: List[Any]) -> List[Any]:
+        if len(collections) <= 1:
+            return [fn(c, k) for c, k in zip(collections, keys)]
+        return list(get_pool().map(fn, collections, keys))
+
+    def query(self, query_embeddings: List[List[float]], n_results: int, include: List[str],
+              where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        extra = {"where": where} if where else {}
+        if len(self.collections) == 1:
+            return self.collections[0].query(query_embeddings=query_embeddings, n_results=n_results,
+                                             include=include, **extra)
+        # 1) sólo distancias en cada colección; 2) documentos/metadatos/vectores
+        # únicamente de los n_results ganadores, con un get por colección
+        parts = self._map(lambda c: c.query(query_embeddings=query_embeddings, n_results=n_results,
+                                            include=["distances"], **extra))
+        winners: List[List[tuple]] = []
+        wanted: Dict[int, set] = {}
+        for q in range(len(query_embeddings)):
+            rows = []
+            for s, part in enumerate(parts):
+                rows.extend((d, s, cid) for cid, d in zip(part["ids"][q], part["distances"][q]))
+            rows.sort(key=lambda r: r[0] if r[0] is not None else 1e9)
+            winners.append(rows[:n_results])
+            for _, s, cid in rows[:n_results]:
+                wanted.setdefault(s, set()).add(cid)
+
+        fields = [f for f in include if f not in ("distances", "uris")]
+        found: Dict[str, Dict[str, Any]] = {}
+        if fields and wanted:
+            shards = list(wanted)
+            gots = self._map_over([self.collections[s] for s in shards],
+                                  lambda c, s: c.get(ids=sorted(wanted[s]), include=fields), shards)
+            for got in gots:
+                for j, cid in enumerate(got["ids"]):
+                    found[cid] = {f: got[f][j] for f in fields}
+
+        out: Dict[str, Any] = {"ids": [[cid for _, _, cid in rows] for rows in winners]}
+        if "distances" in include:
+            out["distances"] = [[d for d, _, _ in rows] for rows in winners]
+        for f in fields:
+            out[f] = [[found.get(cid, {}).get(f) for _, _, cid in rows] for rows in winners]
+        return out
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None,
+            include: Optional[List[str]] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+        include = ["metadatas", "documents"] if include is None else include
+        kwargs: Dict[str, Any] = {"include": include}
+        if ids is not None:
+            kwargs["ids"] = ids
+        if where:
+            kwargs["where"] = where
+        if limit is not None:
+            kwargs["limit"] = limit
+        if ids is not None and not ids:
+            parts = []
+        else:
+            parts = self._map(lambda c: c.get(**kwargs))
+        fields = ["ids"] + [f for f in include if f != "uris"]
+        out: Dict[str, Any] = {f: [] for f in fields}
+        for part in parts:
+            for f in fields:
+                out[f].extend(part[f] if part.get(f) is not None else [])
+        if limit is not None:
+            out = {f: v[:limit] for f, v in out.items()}
+        return out
+
+    def count(self) -> int:
+        return sum(self._map(lambda c: c.count()))
+
+
+class ShardRouter:
+    """
+    Decide en qué colección vive cada fuente. En modo source cada ingesta
+    escribe en una colección nueva y, al terminar, el catálogo pasa a
+    apuntar a ella y la anterior se borra entera (sin delete por ids sobre
+    un índice grande); si se cancela, se borra la nueva. En modo hash
+    varias fuentes comparten cubo y se actualizan en su sitio.
+    """
+
+    def __init__(self, client: Any, ef: Any, mode: str, catalog: ShardCatalog, buckets: int):
+        self.client = client
+        self.ef = ef
+        self.mode = mode
+        self.catalog = catalog
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._cols: Dict[str, Any] = {}
+
+    def collection(self, name: str) -> Any:
+        with self._lock:
+            col = self._cols.get(name)
+            if col is None:
+                col = self._cols[name] = self.client.get_or_create_collection(
+                    name=name, embedding_function=self.ef, metadata=_SHARD_METADATA,
+                )
+            return col
+
+    def view(self, source: Optional[str] = None) -> Any:
+        if source:
+            name = self.catalog.collection_of(source)
+            return self.collection(name) if name else ShardFanout([])
+        return ShardFanout([self.collection(name) for name in self.catalog.collections()])
+
+    def writable(self, source: str) -> Any:
+        # colección donde escribir una ingesta de source (aún no visible en modo source)
+        if self.mode == SOURCE:
+            return self.collection(new_shard_name(source))
+        name = bucket_name(source, self.buckets)
+        if self.catalog.collection_of(source) != name:
+            self.catalog.set(source, name)
+        return self.collection(name)
+
+    def publish(self, source: str, col: Any, file_hash: Optional[str], chunks: int) -> None:
+        previous = self.catalog.set(source, col.name, file_hash, chunks)
+        if previous and previous != col.name and not self.catalog.in_use(previous):
+            self.drop(previous)
+
+    def abandon(self, col: Any) -> None:
+        # ingesta que no llegó a publicarse: su colección nueva sobra
+        if self.mode == SOURCE and not self.catalog.in_use(col.name):
+            self.drop(col.name)
+
+    def delete_source(self, source: str, ids: List[str]) -> None:
+        name = self.catalog.remove(source)
+        if name is None:
+            return
+        if self.catalog.in_use(name):
+            if ids:
+                self.collection(name).delete(ids=ids)
+        else:
+            self.drop(name)
+
+    def drop(self, name: str) -> None:
+        with self._lock:
+            self._cols.pop(name, None)
+        try:
+            self.client.delete_collection(name)
+        except ValueError:
+            pass   # ya no existía
+        logger.info("shards.drop", extra={"collection": name})
+
+    def migrate(self, legacy: Any, batch_size: int = 1000) -> Dict[str, int]:
+        """
+        Reparte en colecciones lo que se ingestó en la colección única
+        antes de activar SHARD_MODE (con sus vectores, sin re-embeber) y
+        lo quita de ella.
+        """
+        res = legacy.get(include=["metadatas"])
+        by_source: Dict[str, List[str]] = {}
+        marks: Dict[str, tuple] = {}
+        for cid, meta in zip(res.get("ids") or [], res.get("metadatas") or []):
+            meta = meta or {}
+            src = str(meta.get("source", ""))
+            by_source.setdefault(src, []).append(cid)
+            if meta.get("count_hash"):
+                marks[src] = (meta["count_hash"], meta.get("chunk_count") or 0)
+        for src, ids in by_source.items():
+            col = self.writable(src)
+            for start in range(0, len(ids), batch_size):
+                got = legacy.get(ids=ids[start:start + batch_size], include=["documents", "metadatas", "embeddings"])
+                col.upsert(ids=got["ids"], documents=got["documents"], metadatas=got["metadatas"],
+                           embeddings=got["embeddings"])
+            file_hash, chunks = marks.get(src, (None, len(ids)))
+            self.publish(src, col, file_hash, chunks)
+            for start in range(0, len(ids), batch_size):
+                legacy.delete(ids=ids[start:start + batch_size])
+        return {"sources": len(by_source), "chunks": sum(len(v) for v in by_source.values())}
+
+    def close(self) -> None:
+        with self._lock:
+            self._cols = {}
+        self.catalog.close()
@@ -0,0 +1,52 @@
+from __future__ import annotations
+import re
+from typing import Dict, List
+
+"""
+Estimación rápida de tokens sin cargar el tokenizador del modelo.
+Los tokenizadores BPE de llama y similares parten las palabras largas en
+trozos de ~4 caracteres y cada signo de puntuación cuenta aparte; esta
+aproximación suele quedar un poco por encima del valor real, que es lo
+que queremos para no pasarnos de num_ctx.
+"""
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Coste fijo de cada mensaje en la plantilla de chat (rol, separadores)
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    pieces = _TOKEN_RE.findall(text)
+    return len(pieces) + sum((len(p) - 1) // 4 for p in pieces if len(p) > 4)
+
+
+def estimate_messages(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m.get("content", "")) + MESSAGE_OVERHEAD for m in messages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Recorta text para que quepa en max_tokens (estimados), cortando en un
+    límite de palabra y, si queda cerca, al final de una frase.
+    """
+    if max_tokens <= 0:
+        return ""
+    n = 1   # la marca de recorte final
+    end = 0
+    for m in _TOKEN_RE.finditer(text):
+        p = m.group()
+        n += 1 + ((len(p) - 1) // 4 if len(p) > 4 else 0)
+        if n > max_tokens:
+            break
+        end = m.end()
+    else:
+        return text
+    cut = text[:end]
+    # preferimos terminar en una frase completa si no perdemos más de un 30%
+    dot = cut.rfind(". ")
+    if dot >= int(len(cut) * 0.7):
+        cut = cut[: dot + 1]
+    return cut.rstrip() + " …"
@@ -0,0 +1,378 @@
+from __future__ import annotations
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from app.concurrency import run_blocking
+from app.settings import settings
+
+try:
+    # python-multipart >= 0.0.13 se importa así; antes, como "multipart"
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+"""
+Subida de archivos sin tenerlos enteros en memoria: el multipart se lee
+directamente del cuerpo de la petición (iter_form_files) y cada archivo se
+escribe a disco una sola vez, calculando el SHA-256 a la vez (el mismo
+file_hash que guarda la ingesta) y cortando en cuanto pasa de su límite,
+también sin Content-Length. También desempaqueta los ZIP de /ingest/bulk de la misma forma.
+Cada contenido se guarda una sola vez como data/uploads/<file_hash>.pdf y no
+se sobrescribe nunca (un trabajo puede estar leyéndolo); el nombre con el que
+se subió va aparte, en data/uploads/names.sqlite3.
+"""
+
+UPLOADS_DIR = Path("data/uploads")
+NAMES_FILE = "names.sqlite3"
+
+_CONTENT_NAME = re.compile(r"^[0-9a-f]{16}\.pdf$")
+
+# lo que ocupa el multipart además del archivo (cabeceras, boundary)
+_MULTIPART_SLACK = 64 * 1024
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class UploadRejected(ValueError):
+    pass
+
+
+class Staged(NamedTuple):
+    # archivo ya copiado a un temporal junto a su destino, con su hash
+    path: Path
+    file_hash: str
+    size: int
+
+
+def file_digest(h: "hashlib._Hash") -> str:
+    # formato de file_hash en los metadatos de Chroma
+    return h.hexdigest()[:16]
+
+
+def hash_file(path: Path) -> str:
+    # file_hash de un archivo en disco, leído por trozos
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(settings.upload_chunk_size):
+            h.update(chunk)
+    return file_digest(h)
+
+
+def safe_name(filename: Optional[str]) -> str:
+    # sólo el nombre: nada de rutas ("../../x.pdf", "carpeta/x.pdf")
+    return Path((filename or "").replace("\\", "/")).name
+
+
+class _Sink:
+    # temporal único en directory: escribe, hashea y cuenta en una sola pasada
+    def __init__(self, max_bytes: int, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / f".upload-{uuid.uuid4().hex}.part"
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._h = hashlib.sha256()
+        self._fh = open(self.path, "wb")
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"El archivo supera el máximo de {self.max_bytes} bytes")
+        self._h.update(data)
+        self._fh.write(data)
+
+    def close(self) -> Staged:
+        self._fh.close()
+        return Staged(self.path, file_digest(self._h), self.size)
+
+    def abort(self) -> None:
+        self._fh.close()
+        self.path.unlink(missing_ok=True)
+
+
+def stage(src: BinaryIO, max_bytes: int, directory: Path = UPLOADS_DIR) -> Staged:
+    """
+    Copia src a un temporal único en directory por trozos, con su SHA-256.
+    Si pasa de max_bytes lanza UploadTooLarge y borra el temporal.
+    """
+    sink = _Sink(max_bytes, directory)
+    try:
+        while chunk := src.read(settings.upload_chunk_size):
+            sink.write(chunk)
+    except BaseException:
+        sink.abort()
+        raise
+    return sink.close()
+
+
+class Received(NamedTuple):
+    # un archivo del multipart: Staged, o el error por el que se descartó
+    field: str
+    name: str
+    staged: Optional[Staged]
+    error: Optional[ValueError]
+
+
+class _FormReader:
+    """
+    Callbacks de MultipartParser: cada parte con filename va a un _Sink con
+    el límite que diga limit_for(campo, nombre) al llegar sus cabeceras (o
+    UploadRejected: no se escribe nada). Los campos sin archivo se ignoran.
+    """
+
+    def __init__(self, limit_for: Callable[[str, str], int], directory: Path):
+        self.limit_for = limit_for
+        self.directory = directory
+        self.done: List[Received] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._hfield = b""
+        self._hvalue = b""
+        self._part: Optional[Tuple[str, str]] = None
+        self._sink: Optional[_Sink] = None
+        self._error: Optional[ValueError] = None
+
+    def callbacks(self) -> Dict[str, Callable]:
+        return {
+            "on_part_begin": self._begin,
+            "on_header_field": self._header_field,
+            "on_header_value": self._header_value,
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._data,
+            "on_part_end": self._end,
+        }
+
+    def _begin(self) -> None:
+        self._headers, self._part, self._sink, self._error = {}, None, None, None
+
+    def _header_field(self, data: bytes, start: int, end: int) -> None:
+        self._hfield += data[start:end]
+
+    def _header_value(self, data: bytes, start: int, end: int) -> None:
+        self._hvalue += data[start:end]
+
+    def _header_end(self) -> None:
+        self._headers[self._hfield.lower()] = self._hvalue
+        self._hfield, self._hvalue = b"", b""
+
+    def _headers_finished(self) -> None:
+        _, opts = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in opts:
+            return
+        field = opts.get(b"name", b"").decode("utf-8", "replace")
+        name = safe_name(opts[b"filename"].decode("utf-8", "replace"))
+        self._part = (field, name)
+        try:
+            self._sink = _Sink(self.limit_for(field, name), self.directory)
+        except UploadRejected as e:
+            self._error = e
+
+    def _data(self, data: bytes, start: int, end: int) -> None:
+        if self._sink is None:
+            return
+        try:
+            self._sink.write(data[start:end])
+        except UploadTooLarge as e:
+            # el resto de la parte se lee y se tira
+            self._sink.abort()
+            self._sink, self._error = None, e
+
+    def _end(self) -> None:
+        if self._part is None:
+            return
+        staged = self._sink.close() if self._sink is not None else None
+        self.done.append(Received(*self._part, staged, self._error))
+        self._part, self._sink = None, None
+
+    def abort(self) -> None:
+        if self._sink is not None:
+            self._sink.abort()
+            self._sink = None
+        for r in self.done:
+            if r.staged is not None:
+                discard(r.staged)
+        self.done = []
+
+
+async def iter_form_files(
+    request: Request, limit_for: Callable[[str, str], int], max_total: int, directory: Path = UPLOADS_DIR,
+) -> AsyncIterator[Received]:
+    """
+    Archivos de un multipart/form-data leído de request.stream(), según van
+    terminando; sin pasar por UploadFile (que copia antes el cuerpo entero a
+    otro temporal). Si el cuerpo pasa de max_total (más lo que ocupa el
+    multipart) lanza UploadTooLarge aunque no haya Content-Length. Úsese con
+    contextlib.aclosing: al salir antes de tiempo se borran los temporales
+    que no se llegaron a entregar.
+    """
+    ctype, opts = parse_options_header(request.headers.get("content-type", ""))
+    if ctype != b"multipart/form-data" or not opts.get(b"boundary"):
+        raise UploadRejected("Se esperaba multipart/form-data")
+    reader = _FormReader(limit_for, directory)
+    parser = MultipartParser(opts[b"boundary"], reader.callbacks())
+    limit = max_total + _MULTIPART_SLACK
+    total = 0
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            total += len(chunk)
+            if total > limit:
+                raise UploadTooLarge(f"La subida supera el máximo de {limit} bytes")
+            # escribir a disco bloquea: va al pool de hilos
+            await run_blocking(parser.write, chunk)
+            while reader.done:
+                yield reader.done.pop(0)
+        parser.finalize()
+        while reader.done:
+            yield reader.done.pop(0)
+    finally:
+        reader.abort()
+
+
+def content_path(file_hash: str, directory: Path = UPLOADS_DIR) -> Path:
+    return directory / f"{file_hash}.pdf"
+
+
+def is_content_path(path: Path) -> bool:
+    # <file_hash>.pdf (las subidas anteriores a esto conservan su nombre)
+    return bool(_CONTENT_NAME.match(path.name))
+
+
+class UploadNames:
+    """
+    Nombre de la subida -> file_hash de su última versión, para saber qué
+    <file_hash>.pdf corresponde a cada fuente (app.cli rebuild).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS names ("
+                    " name TEXT PRIMARY KEY, file_hash TEXT NOT NULL, updated_at REAL NOT NULL)"
+                )
+            self._conn = conn
+        return self._conn
+
+    def set(self, name: str, file_hash: str) -> None:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute(
+                    "INSERT INTO names (name, file_hash, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(name) DO UPDATE SET file_hash = excluded.file_hash, updated_at = excluded.updated_at",
+                    (name, file_hash, time.time()),
+                )
+
+    def items(self) -> List[Tuple[str, str]]:
+        if not self.path.exists():
+            return []
+        with self._lock:
+            return self._db().execute("SELECT name, file_hash FROM names ORDER BY name").fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+upload_names = UploadNames(UPLOADS_DIR / NAMES_FILE)
+
+
+def commit(staged: Staged, name: str) -> Path:
+    """
+    Guarda el temporal como <file_hash>.pdf y anota name -> file_hash.
+    Volver a subir un nombre con otro contenido crea otro archivo: los
+    trabajos en cola o en marcha siguen leyendo el suyo. Si el contenido
+    ya estaba se descarta el temporal.
+    """
+    dest = content_path(staged.file_hash, staged.path.parent)
+    if dest.exists():
+        discard(staged)
+    else:
+        # si otra subida del mismo contenido gana la carrera, el rename la pisa con los mismos bytes
+        os.replace(staged.path, dest)
+    upload_names.set(name, staged.file_hash)
+    return dest
+
+
+def discard(staged: Staged) -> None:
+    staged.path.unlink(missing_ok=True)
+
+
+def iter_zip_pdfs(path: Path, max_total: int) -> Iterator[Tuple[str, Optional[Staged], Optional[str]]]:
+    """
+    PDFs dentro de un ZIP, copiados uno a uno como stage(): (nombre,
+    Staged, None) o (nombre, None, motivo) si se rechaza. Los tamaños
+    se cuentan al descomprimir (no se fía de la cabecera) y el total no
+    puede pasar de max_total.
+    """
+    total = 0
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            name = safe_name(info.filename)
+            if info.is_dir() or info.filename.startswith("__MACOSX/") or name.startswith("."):
+                continue
+            if not name.lower().endswith(".pdf"):
+                yield name, None, "Solo se aceptan PDFs"
+                continue
+            limit = min(settings.upload_max_bytes, max_total - total)
+            if info.file_size > limit:
+                yield name, None, f"El archivo supera el máximo de {limit} bytes"
+                continue
+            try:
+                with zf.open(info) as src:
+                    staged = stage(src, limit)
+            except UploadTooLarge as e:
+                yield name, None, str(e)
+                continue
+            except (zipfile.BadZipFile, RuntimeError) as e:
+                # miembros corruptos o cifrados
+                yield name, None, f"No se pudo extraer: {e}"
+                continue
+            total += staged.size
+            yield name, staged, None
+
+
+class UploadSizeLimit:
+    """
+    Middleware ASGI: rechaza con 413 las subidas cuyo Content-Length ya
+    pasa del límite, antes de leer (y guardar) el cuerpo. Las que no lo
+    declaran las corta iter_form_files mientras las lee.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.limits:
+            length = dict(scope["headers"]).get(b"content-length")
+            limit = self.limits[scope["path"]] + _MULTIPART_SLACK
+            if length and length.isdigit() and int(length) > limit:
+                response = JSONResponse({"detail": f"La subida supera el máximo de {limit} bytes"}, status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import structlog
+
+from app.metrics import READY, STARTUP_SECONDS
+from app.settings import settings
+
+"""
+Estado del arranque de la app, en dos partes:
+- core: abrir Chroma, sincronizar BM25, retomar trabajos y sesiones. Sin
+  esto no se puede atender /chat ni /ingest (esperan con wait_core).
+- modelos: precarga del LLM y del modelo de embeddings en Ollama. Si falla
+  no bloquea nada; sólo se ve en el estado.
+Liveness = el proceso responde; readiness = las dos partes terminaron.
+"""
+
+# app.main importa este módulo lo primero: el arranque se cuenta desde aquí
+STARTED = time.perf_counter()
+
+logger = structlog.get_logger()
+
+Step = Tuple[str, Callable[[], Awaitable[Any]]]
+
+
+class Warmup:
+    def __init__(self, started: float = STARTED):
+        self.started = started
+        self.steps: Dict[str, Dict[str, Any]] = {}
+        self.marks: Dict[str, float] = {}
+        self.core_ok = False
+        self.ready = False
+        self.error: Optional[str] = None
+        self._core_done: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _event(self) -> asyncio.Event:
+        # se crea dentro del event loop que la espera
+        if self._core_done is None:
+            self._core_done = asyncio.Event()
+        return self._core_done
+
+    def mark(self, phase: str) -> None:
+        # segundos desde que se importó la app hasta esta fase
+        secs = time.perf_counter() - self.started
+        self.marks[f"{phase}_ms"] = round(secs * 1000, 1)
+        STARTUP_SECONDS.labels(phase=phase).set(secs)
+
+    async def _run_step(self, name: str, fn: Callable[[], Awaitable[Any]]) -> bool:
+        info: Dict[str, Any] = {"status": "running"}
+        self.steps[name] = info
+        t0 = time.perf_counter()
+        try:
+            result = await fn()
+        except Exception as e:
+            info.update(status="error", error=str(e))
+            logger.warning("warmup.error", extra={"step": name, "err": str(e)})
+            ok = False
+        else:
+            info["status"] = "ok"
+            if isinstance(result, dict):
+                info.update(result)
+            ok = True
+        elapsed = time.perf_counter() - t0
+        info["ms"] = round(elapsed * 1000, 1)
+        STARTUP_SECONDS.labels(phase=f"step_{name}").set(elapsed)
+        return ok
+
+    async def run_core(self, steps: List[Step]) -> bool:
+        # en orden; el primero que falla deja la app viva pero sin estar lista
+        self._event()
+        for name, fn in steps:
+            if not await self._run_step(name, fn):
+                self.error = f"{name}: {self.steps[name]['error']}"
+                break
+        else:
+            self.core_ok = True
+        self.mark("core")
+        self._event().set()
+        return self.core_ok
+
+    async def run(self, core: List[Step], models: List[Step]) -> None:
+        if core and not await self.run_core(core):
+            return
+        # los modelos se cargan a la vez; un fallo no impide estar listo
+        await asyncio.gather(*(self._run_step(name, fn) for name, fn in models))
+        self.ready = True
+        READY.set(1)
+        self.mark("ready")
+        logger.info("warmup.ready", extra=self.status())
+
+    def start(self, core: List[Step], models: List[Step]) -> asyncio.Task:
+        # warm-up en segundo plano: el arranque de uvicorn no lo espera
+        self._event()
+        self._task = asyncio.create_task(self.run(core, models))
+        return self._task
+
+    async def wait_core(self, timeout: float) -> bool:
+        if self.core_ok:
+            return True
+        try:
+            await asyncio.wait_for(self._event().wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.core_ok
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "core": self.core_ok,
+            "lazy": settings.lazy_startup,
+            "uptime_s": round(time.perf_counter() - self.started, 1),
+            **self.marks,
+            "error": self.error,
+            "steps": {name: dict(info) for name, info in self.steps.items()},
+        }
+
+
+warmup = Warmup()
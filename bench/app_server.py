@@ -0,0 +1,30 @@
+from __future__ import annotations
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import uvicorn
+
+"""
+Levanta app.main:app con uvicorn en un hilo, en un puerto libre, para
+medir por HTTP real (el TestClient acumula las respuestas en streaming).
+Configura OLLAMA_HOST/CHROMA_PATH en el entorno antes de llamarlo.
+"""
+
+@contextmanager
+def serve_app(host: str = "127.0.0.1") -> Iterator[str]:
+    from app.main import app
+
+    config = uvicorn.Config(app, host=host, port=0, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
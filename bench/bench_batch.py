@@ -0,0 +1,91 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import requests
+
+from bench.stub_ollama import StubOllama
+
+"""
+/chat/batch frente a N llamadas secuenciales a /chat contra el stub de
+Ollama (como haría un script de evaluación): tiempo total, preguntas por
+segundo y peticiones que llegan al stub. El lote embebe todas las preguntas
+de una vez, consulta Chroma una vez y solapa las llamadas al LLM.
+Uso: python -m bench.bench_batch --questions 64 --concurrency 8
+"""
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--questions", type=int, default=64)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--embed-latency", type=float, default=0.02, help="segundos por petición de embeddings")
+    ap.add_argument("--prefill", type=float, default=0.1, help="segundos hasta el primer token en el stub")
+    ap.add_argument("--tokens", type=int, default=10)
+    ap.add_argument("--token-delay", type=float, default=0.005)
+    args = ap.parse_args()
+
+    stub = StubOllama(latency=args.embed_latency, chat_prefill=args.prefill,
+                      token_delay=args.token_delay, tokens=args.tokens).start()
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = tempfile.mkdtemp(prefix="bench_chroma_")
+    os.environ["BATCH_CONCURRENCY"] = str(args.concurrency)
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    from app.retriever import collection_handle
+    from bench.app_server import serve_app
+
+    with serve_app() as base:
+        collection_handle.get().add(
+            ids=[f"bench:1:{i}" for i in range(200)],
+            documents=[f"Artículo {i}: la garantía cubre {i} meses." for i in range(200)],
+            metadatas=[{"source": "bench.pdf", "page": 1, "chunk": i, "file_hash": "bench"} for i in range(200)],
+        )
+        session = requests.Session()
+
+        # preguntas distintas en cada modo para que ninguna caché ayude
+        calls0 = stub.requests
+        t0 = time.perf_counter()
+        for i in range(args.questions):
+            r = session.post(f"{base}/chat", json={"message": f"pregunta secuencial {i}", "source": "bench.pdf"})
+            r.raise_for_status()
+        seq_s = time.perf_counter() - t0
+        seq_calls = stub.requests - calls0
+
+        calls0 = stub.requests
+        body = {"requests": [{"message": f"pregunta del lote {i}", "source": "bench.pdf"}
+                             for i in range(args.questions)]}
+        t0 = time.perf_counter()
+        first_ms = None
+        results = errors = 0
+        with session.post(f"{base}/chat/batch", json=body, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                ev = json.loads(line)
+                if ev["type"] == "result":
+                    results += 1
+                    if first_ms is None:
+                        first_ms = (time.perf_counter() - t0) * 1000
+                elif ev["type"] == "error":
+                    errors += 1
+                elif ev["type"] == "done":
+                    summary = ev
+        batch_s = time.perf_counter() - t0
+        batch_calls = stub.requests - calls0
+
+    stub.stop()
+    n = args.questions
+    print(f"preguntas={n} concurrencia={args.concurrency}")
+    print(f"/chat secuencial: {seq_s:.2f}s  {n / seq_s:.1f} preguntas/s  peticiones al stub={seq_calls}")
+    print(f"/chat/batch:      {batch_s:.2f}s  {n / batch_s:.1f} preguntas/s  peticiones al stub={batch_calls}"
+          f"  (resultados={results} errores={errors}, primero a {first_ms:.0f}ms,"
+          f" recuperación {summary['retrieve_ms']:.0f}ms)")
+    print(f"speedup={seq_s / batch_s:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
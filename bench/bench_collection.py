@@ -0,0 +1,57 @@
+from __future__ import annotations
+import argparse
+import statistics
+import tempfile
+import time
+
+import chromadb
+
+from app.retriever import CollectionHandle, build_embedding_function
+from app.settings import settings
+
+"""
+Coste de preparar la colección en cada petición: construcción por llamada
+(comportamiento anterior) frente al CollectionHandle compartido.
+Uso: python -m bench.bench_collection --iters 200
+"""
+
+def per_call(path: str):
+    # lo que hacía get_collection() antes en cada /chat, /ingest y search()
+    client = chromadb.PersistentClient(path=path)
+    ef = build_embedding_function(settings.embeddings_provider)
+    return client.get_or_create_collection(name="docs", embedding_function=ef,
+                                           metadata={"hnsw:space": "cosine"})
+
+
+def timeit(fn, iters: int) -> dict:
+    samples = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": round(statistics.fmean(samples), 4),
+        "p50_ms": round(samples[len(samples) // 2], 4),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 4),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--iters", type=int, default=200)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        handle = CollectionHandle(path)
+        handle.open()
+        before = timeit(lambda: per_call(path), args.iters)
+        after = timeit(handle.get, args.iters)
+        handle.close()
+
+    print(f"por llamada : {before}")
+    print(f"compartido  : {after}")
+
+
+if __name__ == "__main__":
+    main()
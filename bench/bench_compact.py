@@ -0,0 +1,129 @@
+from __future__ import annotations
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from bench.results import percentiles, write_results
+
+"""
+Índice compacto (COMPACT_INDEX) frente a la consulta vectorial actual de
+Chroma: recall@k respecto al top-k exacto (fuerza bruta en float32),
+latencia de _vector_candidates y bytes por chunk en disco. Los vectores son
+sintéticos, agrupados en temas como los de un modelo de embeddings real.
+Uso: python -m bench.bench_compact --chunks 20000 --dim 768 --queries 200
+"""
+
+
+def _dir_bytes(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def make_vectors(n: int, dim: int, topics: int, seed: int) -> np.ndarray:
+    # centro de tema + ruido: vecinos cercanos parecidos, como en un corpus real
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(topics, dim)).astype(np.float32)
+    vecs = centers[rng.integers(0, topics, n)] + rng.normal(scale=0.8, size=(n, dim)).astype(np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chunks", type=int, default=20000)
+    ap.add_argument("--dim", type=int, default=768)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=18, help="candidatos por consulta (top_k * 3 en /chat)")
+    ap.add_argument("--topics", type=int, default=50)
+    ap.add_argument("--oversample", default="1,2,4,8")
+    ap.add_argument("--seed", type=int, default=3)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix="bench_compact_"))
+    os.environ["CHROMA_PATH"] = str(tmp / "chroma")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    import app.rag as rag
+    from app.compact import CompactIndex
+    from app.retriever import collection_handle
+    from app.settings import settings
+
+    vecs = make_vectors(args.chunks, args.dim, args.topics, args.seed)
+    ids = [f"c{i}" for i in range(args.chunks)]
+    rng = np.random.default_rng(args.seed + 1)
+    qvecs = vecs[rng.integers(0, args.chunks, args.queries)] + rng.normal(scale=0.03, size=(args.queries, args.dim))
+    qvecs = (qvecs / np.linalg.norm(qvecs, axis=1, keepdims=True)).astype(np.float32)
+    # referencia: top-k exacto por coseno
+    exact = np.argsort(-(qvecs @ vecs.T), axis=1)[:, :args.k]
+    truth = [{ids[j] for j in row} for row in exact]
+
+    col = collection_handle.open()
+    t0 = time.perf_counter()
+    for s in range(0, args.chunks, 1000):
+        e = min(args.chunks, s + 1000)
+        col.add(ids=ids[s:e], documents=[f"chunk {i}" for i in range(s, e)], embeddings=vecs[s:e].tolist(),
+                metadatas=[{"source": "corpus.pdf", "page": i} for i in range(s, e)])
+    chroma_build_s = time.perf_counter() - t0
+
+    indexes: Dict[str, Any] = {}
+    build: Dict[str, float] = {}
+    for quant in ("int8", "binary"):
+        idx = CompactIndex(tmp / f"compact_{quant}", quant)
+        t0 = time.perf_counter()
+        for s in range(0, args.chunks, 1000):
+            idx.add(ids[s:s + 1000], vecs[s:s + 1000], ["corpus.pdf"] * len(ids[s:s + 1000]))
+        build[quant] = time.perf_counter() - t0
+        indexes[quant] = idx
+
+    def run(label: str) -> Dict[str, Any]:
+        lat: List[float] = []
+        recall: List[float] = []
+        for q, want in zip(qvecs, truth):
+            t0 = time.perf_counter()
+            got = rag._vector_candidates(col, [q.tolist()], args.k, None, False)[0]
+            lat.append((time.perf_counter() - t0) * 1000)
+            recall.append(len(want & set(got)) / len(want))
+        res = {"recall_at_k": round(float(np.mean(recall)), 4), "latency_ms": percentiles(lat)}
+        print(f"{label:14s} recall@{args.k}={res['recall_at_k']:.3f} p50={res['latency_ms']['p50']:.2f}ms "
+              f"p95={res['latency_ms']['p95']:.2f}ms")
+        return res
+
+    chroma_bytes = _dir_bytes(tmp / "chroma")
+    results: Dict[str, Any] = {
+        "storage": {
+            "float32_vector_bytes_per_chunk": args.dim * 4,
+            "chroma_disk_bytes_per_chunk": round(chroma_bytes / args.chunks, 1),
+            "chroma_build_s": round(chroma_build_s, 2),
+        },
+        "search": {},
+    }
+    print(f"chroma: {chroma_bytes / args.chunks:.0f} bytes/chunk en disco "
+          f"(vector float32: {args.dim * 4} bytes)")
+    settings.compact_index = False
+    results["search"]["chroma"] = run("chroma (hnsw)")
+
+    settings.compact_index = True
+    for quant, idx in indexes.items():
+        st = idx.stats()
+        results["storage"][quant] = {
+            "vector_bytes_per_chunk": st["vector_bytes_per_chunk"],
+            "disk_bytes_per_chunk": round(st["disk_bytes"] / args.chunks, 1),
+            "build_s": round(build[quant], 2),
+        }
+        print(f"{quant}: {st['vector_bytes_per_chunk']} bytes/chunk de vector, "
+              f"{st['disk_bytes'] / args.chunks:.0f} en disco con el mapa de ids")
+        rag.compact_index = idx
+        for over in [int(x) for x in args.oversample.split(",") if x]:
+            settings.compact_oversample = over
+            results["search"][f"{quant}_x{over}"] = run(f"{quant} x{over}")
+    collection_handle.close()
+
+    path = write_results("compact", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
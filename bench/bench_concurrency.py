@@ -0,0 +1,86 @@
+from __future__ import annotations
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.stub_ollama import StubOllama
+
+"""
+Prueba de carga de /chat contra el stub de Ollama: lanza N peticiones
+concurrentes y mide throughput, latencias y cuánto tarda /health mientras
+tanto. Con el camino asíncrono las generaciones se solapan; antes (llamadas
+bloqueantes dentro de 'async def') se serializaban en el worker.
+Uso: python -m bench.bench_concurrency --concurrency 16 --requests 64
+"""
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--requests", type=int, default=64)
+    ap.add_argument("--prefill", type=float, default=0.3, help="segundos hasta el primer token en el stub")
+    ap.add_argument("--tokens", type=int, default=10)
+    ap.add_argument("--token-delay", type=float, default=0.005)
+    args = ap.parse_args()
+
+    stub = StubOllama(latency=0.005, chat_prefill=args.prefill,
+                      token_delay=args.token_delay, tokens=args.tokens).start()
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = tempfile.mkdtemp(prefix="bench_chroma_")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    from app.retriever import collection_handle
+    from bench.app_server import serve_app
+
+    with serve_app() as base:
+        collection_handle.get().add(
+            ids=[f"bench:1:{i}" for i in range(50)],
+            documents=[f"Artículo {i}: la garantía cubre {i} meses." for i in range(50)],
+            metadatas=[{"source": "bench.pdf", "page": 1, "chunk": i, "file_hash": "bench"} for i in range(50)],
+        )
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+        def one(i: int) -> float:
+            t0 = time.perf_counter()
+            r = session.post(f"{base}/chat", json={"message": f"pregunta {i}", "source": "bench.pdf"})
+            r.raise_for_status()
+            return (time.perf_counter() - t0) * 1000
+
+        # /health en paralelo para ver si el loop sigue respondiendo
+        health_ms = []
+        stop = threading.Event()
+
+        def probe():
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                requests.get(f"{base}/health")
+                health_ms.append((time.perf_counter() - t0) * 1000)
+                time.sleep(0.05)
+
+        prober = threading.Thread(target=probe, daemon=True)
+        prober.start()
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            lat = sorted(pool.map(one, range(args.requests)))
+        wall = time.perf_counter() - t0
+        stop.set()
+        prober.join()
+
+    stub.stop()
+    per_req = args.prefill + args.tokens * args.token_delay
+    print(f"peticiones={args.requests} concurrencia={args.concurrency} tiempo={wall:.2f}s")
+    print(f"throughput={args.requests / wall:.1f} req/s "
+          f"(serializado sería ~{1 / per_req:.1f} req/s)")
+    print(f"latencia p50={lat[len(lat) // 2]:.0f}ms p95={lat[int(len(lat) * 0.95) - 1]:.0f}ms")
+    if health_ms:
+        print(f"/health durante la carga: max={max(health_ms):.0f}ms media={statistics.fmean(health_ms):.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
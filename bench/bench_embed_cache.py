@@ -0,0 +1,80 @@
+from __future__ import annotations
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+from bench.results import write_results
+from bench.stub_ollama import StubOllama
+from bench.synth_pdf import make_pdf
+
+"""
+Caché persistente de embeddings (EMBED_CACHE): ingesta de varios PDFs con
+la caché vacía, reingesta tras borrar la base de Chroma (caché llena) y
+con EMBED_CACHE=false, contando las peticiones que llegan al stub de Ollama.
+Uso: python -m bench.bench_embed_cache --pdfs 4 --pages 100 --embed-latency 0.05
+"""
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pdfs", type=int, default=4)
+    ap.add_argument("--pages", type=int, default=100)
+    ap.add_argument("--embed-latency", type=float, default=0.05)
+    ap.add_argument("--per-item", type=float, default=0.001)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    stub = StubOllama(latency=args.embed_latency, per_item=args.per_item).start()
+    tmp = Path(tempfile.mkdtemp(prefix="bench_embed_cache_"))
+    chroma = tmp / "chroma"
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = str(chroma)
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    from app.embed_cache import embed_cache
+    from app.ingest import ingest_pdf
+    from app.lexical import lexical_index
+    from app.pdf_extract import shutdown_pool
+    from app.retriever import collection_handle
+    from app.settings import settings
+
+    pdfs = [make_pdf(tmp / f"doc_{i}.pdf", args.pages, seed=i) for i in range(args.pdfs)]
+
+    def run(label: str, cache: bool) -> Dict[str, Any]:
+        # base de Chroma y BM25 desde cero; la caché de embeddings se conserva
+        collection_handle.close()
+        lexical_index.close()
+        shutil.rmtree(chroma, ignore_errors=True)
+        Path(lexical_index.path).unlink(missing_ok=True)
+        settings.embed_cache = cache
+        collection_handle.open()
+        collection_handle.embedder.cache = embed_cache if cache else None
+        before = stub.requests
+        t0 = time.perf_counter()
+        chunks = sum(ingest_pdf(p, p.name)["added_chunks"] for p in pdfs)
+        dt = time.perf_counter() - t0
+        row = {"s": round(dt, 2), "chunks": chunks, "chunks_per_s": round(chunks / dt, 1),
+               "ollama_requests": stub.requests - before}
+        print(f"{label:14s} {dt:6.2f}s  {chunks / dt:7.1f} chunks/s  peticiones a Ollama={row['ollama_requests']}")
+        return row
+
+    results = {
+        "cold": run("caché vacía", True),
+        "warm": run("caché llena", True),
+        "no_cache": run("sin caché", False),
+        "cache": embed_cache.stats(),
+    }
+    print(f"caché: {results['cache']['entries']} entradas, {results['cache']['bytes'] / 1e6:.1f} MB")
+    collection_handle.close()
+    shutdown_pool()
+    stub.stop()
+
+    path = write_results("embed_cache", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+from __future__ import annotations
+import argparse
+import time
+
+from app.embeddings import OllamaEmbeddings
+from bench.stub_ollama import StubOllama
+
+"""
+Mide textos/seg de OllamaEmbeddings contra el stub local.
+Uso: python -m bench.bench_embeddings --texts 2000 --latency 0.01
+"""
+
+def run_case(name: str, stub: StubOllama, texts, **kwargs) -> dict:
+    emb = OllamaEmbeddings(stub.url, "stub-embed", **kwargs)
+    before = stub.requests
+    t0 = time.perf_counter()
+    vecs = emb.embed(texts)
+    dt = time.perf_counter() - t0
+    assert len(vecs) == len(texts)
+    return {
+        "case": name,
+        "texts": len(texts),
+        "seconds": round(dt, 3),
+        "texts_per_sec": round(len(texts) / dt, 1),
+        "http_requests": stub.requests - before,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--texts", type=int, default=1000)
+    ap.add_argument("--latency", type=float, default=0.01, help="segundos por petición en el stub")
+    ap.add_argument("--batch-size", type=int, default=256)
+    ap.add_argument("--concurrency", type=int, default=8)
+    args = ap.parse_args()
+
+    texts = [f"fragmento de prueba número {i} " * 8 for i in range(args.texts)]
+    results = []
+
+    with StubOllama(latency=args.latency, batch=False) as stub:
+        results.append(run_case("secuencial (1 texto/petición)", stub, texts, batch_size=1, concurrency=1))
+
+    with StubOllama(latency=args.latency, batch=True) as stub:
+        results.append(run_case("batch /api/embed", stub, texts,
+                                batch_size=args.batch_size, concurrency=args.concurrency))
+
+    with StubOllama(latency=args.latency, batch=False) as stub:
+        results.append(run_case("fallback /api/embeddings concurrente", stub, texts,
+                                batch_size=args.batch_size, concurrency=args.concurrency))
+
+    for r in results:
+        print(f"{r['case']:<40} {r['texts_per_sec']:>10} textos/s  "
+              f"{r['seconds']:>7}s  peticiones={r['http_requests']}")
+
+
+if __name__ == "__main__":
+    main()
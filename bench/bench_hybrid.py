@@ -0,0 +1,81 @@
+from __future__ import annotations
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+from bench.synth_corpus import make_corpus, make_queries, toy_embed
+
+"""
+Búsqueda léxica (BM25), vectorial e híbrida (RRF) sobre un corpus sintético
+con códigos de pieza/referencia: latencia por consulta y recall@k.
+El lado vectorial usa el embedder de juguete de bench.synth_corpus, que
+ignora los números como los modelos densos con los identificadores.
+Uso: python -m bench.bench_hybrid --chunks 5000 --queries 300 --k 6
+"""
+
+def pct(samples: List[float], p: float) -> float:
+    s = sorted(samples)
+    return round(s[min(len(s) - 1, int(len(s) * p))], 3)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chunks", type=int, default=5000)
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--k", type=int, default=6)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # rutas temporales antes de importar la app (settings se lee al importar)
+        os.environ["CHROMA_PATH"] = os.path.join(tmp, "chroma")
+        os.environ["BM25_PATH"] = os.path.join(tmp, "bm25.sqlite3")
+        os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+        from app.lexical import lexical_index
+        from app.rag import _query_context
+        from app.retriever import collection_handle
+
+        ids, texts, codes = make_corpus(args.chunks, args.seed)
+        vecs = [toy_embed(t) for t in texts]
+        col = collection_handle.open()
+        for s in range(0, len(ids), 1000):
+            col.upsert(ids=ids[s:s + 1000], documents=texts[s:s + 1000], embeddings=vecs[s:s + 1000],
+                       metadatas=[{"source": "fixture.pdf", "page": j} for j in range(s, min(s + 1000, len(ids)))])
+
+        t0 = time.perf_counter()
+        lexical_index.add(zip(ids, texts, ["fixture.pdf"] * len(ids)))
+        build_s = time.perf_counter() - t0
+        size = sum(os.path.getsize(p) for p in (str(lexical_index.path), f"{lexical_index.path}-wal")
+                   if os.path.exists(p))
+        print(f"índice BM25: {len(ids)} chunks en {build_s:.2f}s ({size / 1e6:.1f} MB)")
+
+        queries = make_queries(ids, texts, codes, args.queries, args.seed)
+        qvecs = [toy_embed(q) for _, q, _ in queries]
+        for mode in ("vector", "lexical", "hybrid"):
+            lat: List[float] = []
+            hits: Dict[str, List[int]] = {"codigo": [], "tema": []}
+            for (kind, q, rel), qv in zip(queries, qvecs):
+                t0 = time.perf_counter()
+                out = _query_context(None if mode == "lexical" else qv, args.k, None, False,
+                                     question=q, mode=mode)
+                lat.append((time.perf_counter() - t0) * 1000)
+                hits[kind].append(int(rel in out["ids"]))
+            recall = {kind: round(statistics.fmean(v), 3) for kind, v in hits.items() if v}
+            print(f"{mode:8s} p50={pct(lat, 0.5)}ms p95={pct(lat, 0.95)}ms recall@{args.k}={recall}")
+
+        lat = []
+        for _, q, _ in queries:
+            t0 = time.perf_counter()
+            lexical_index.search(q, args.k * 3)
+            lat.append((time.perf_counter() - t0) * 1000)
+        print(f"sólo BM25.search p50={pct(lat, 0.5)}ms p95={pct(lat, 0.95)}ms")
+
+        lexical_index.close()
+        collection_handle.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from __future__ import annotations
+import argparse
+import tempfile
+import time
+import unicodedata
+from pathlib import Path
+
+from pypdf import PdfReader
+
+from app.ingest import chunk_pages
+from app.pdf_extract import iter_pdf_texts, sanitize_text, shutdown_pool
+from bench.synth_pdf import make_pdf
+
+"""
+Páginas/seg por etapa de la ingesta (sin embeddings): extracción en serie
+frente a paralela, limpieza antigua frente a la nueva, y chunking.
+Uso: python -m bench.bench_ingest --pages 300 --workers 4
+"""
+
+def sanitize_old(s: str) -> str:
+    # la versión anterior, con un generador por carácter
+    import re
+    if not s:
+        return ""
+    s = unicodedata.normalize("NFKC", s)
+    s = re.sub(r"[\ud800-\udfff]", "", s)
+    s = s.replace("\x00", "")
+    s = "".join(c for c in s if c.isprintable() or c in "\n\t ")
+    return s.strip()
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, default=300)
+    ap.add_argument("--workers", type=int, default=4)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        pdf = make_pdf(Path(d) / "synth.pdf", args.pages)
+        n = args.pages
+
+        raw, t_raw = timed(lambda: [p.extract_text() or "" for p in PdfReader(str(pdf)).pages])
+        _, t_old = timed(lambda: [sanitize_old(t) for t in raw])
+        _, t_new = timed(lambda: [sanitize_text(t) for t in raw])
+        serial, t_serial = timed(lambda: list(iter_pdf_texts(pdf, workers=1)))
+        # primera pasada arranca el pool (spawn); medimos la segunda
+        list(iter_pdf_texts(pdf, workers=args.workers))
+        parallel, t_par = timed(lambda: list(iter_pdf_texts(pdf, workers=args.workers)))
+        chunks, t_chunk = timed(lambda: chunk_pages(parallel))
+        shutdown_pool()
+
+        assert [p["text"] for p in serial] == [p["text"] for p in parallel]
+
+    rows = [
+        ("pypdf extract_text (crudo)", t_raw),
+        ("limpieza anterior", t_old),
+        ("limpieza nueva", t_new),
+        ("extracción+limpieza en serie", t_serial),
+        (f"extracción+limpieza paralela ({args.workers} proc)", t_par),
+        (f"chunking ({len(chunks)} chunks)", t_chunk),
+    ]
+    for name, t in rows:
+        print(f"{name:<45} {n / t:>10.1f} págs/s  {t * 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from bench.stub_ollama import StubOllama
+from bench.synth_pdf import make_pdf
+
+"""
+Ingesta completa en streaming contra el stub de Ollama: para PDFs de
+distinto tamaño muestra el pico de memoria Python (tracemalloc), que debe
+mantenerse acotado, y las estadísticas por etapa del pipeline
+(items/s, utilización, profundidad máxima de cola).
+Uso: python -m bench.bench_ingest_pipeline --pages 100,300,600
+"""
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", default="100,300,600")
+    ap.add_argument("--embed-latency", type=float, default=0.02)
+    ap.add_argument("--per-item", type=float, default=0.0005)
+    args = ap.parse_args()
+
+    stub = StubOllama(latency=args.embed_latency, per_item=args.per_item).start()
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = tempfile.mkdtemp(prefix="bench_chroma_")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    from app.ingest import ingest_pdf
+    from app.pdf_extract import shutdown_pool
+
+    with tempfile.TemporaryDirectory() as d:
+        for n in [int(x) for x in args.pages.split(",")]:
+            pdf = make_pdf(Path(d) / f"synth_{n}.pdf", n, seed=n)
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            res = ingest_pdf(pdf, source_name=pdf.name)
+            dt = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"\n{n} páginas, {res['added_chunks']} chunks en {dt:.2f}s "
+                  f"({n / dt:.0f} págs/s, {res['added_chunks'] / dt:.0f} chunks/s), "
+                  f"pico memoria Python {peak / 1e6:.1f} MB")
+            print(json.dumps(res["pipeline"], indent=2))
+
+    shutdown_pool()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from bench.results import percentiles, write_results
+from bench.stub_ollama import StubOllama
+from bench.synth_corpus import make_corpus, make_queries
+from bench.synth_pdf import make_pdf
+
+"""
+Escenarios de carga de punta a punta contra el stub de Ollama, con la app
+servida por uvicorn en un hilo:
+- ingest:   ingest_pdf sobre PDFs sintéticos (páginas/s y chunks/s)
+- retrieve: retrieve_context en proceso, preguntas distintas (sin caché)
+- chat:     POST /chat con N clientes concurrentes
+- stream:   POST /chat/stream, además con el tiempo hasta el primer token
+Informa p50/p95/p99 y peticiones por segundo y lo guarda en JSON.
+Uso: python -m bench.bench_load --scenarios ingest,retrieve,chat,stream --concurrency 8 --requests 200
+"""
+
+SOURCE = "corpus.pdf"
+
+
+def run_load(fn: Callable[[int], Tuple[float, Optional[float]]], n: int, concurrency: int) -> Dict[str, Any]:
+    """
+    Lanza n llamadas fn(i) con `concurrency` clientes a la vez. fn devuelve
+    (latencia_ms, ttft_ms|None) o lanza excepción (cuenta como error).
+    """
+    def safe(i: int):
+        try:
+            return fn(i)
+        except Exception:
+            return None
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        out = list(pool.map(safe, range(n)))
+    wall = time.perf_counter() - t0
+    ok = [o for o in out if o is not None]
+    res: Dict[str, Any] = {
+        "requests": n,
+        "concurrency": concurrency,
+        "errors": n - len(ok),
+        "wall_s": round(wall, 3),
+        "rps": round(len(ok) / wall, 2) if wall else None,
+        "latency_ms": percentiles(o[0] for o in ok),
+    }
+    ttft = [o[1] for o in ok if o[1] is not None]
+    if ttft:
+        res["ttft_ms"] = percentiles(ttft)
+    return res
+
+
+def scenario_ingest(pages: int, runs: int, tmp: Path) -> Dict[str, Any]:
+    from app.ingest import ingest_pdf
+
+    secs: List[float] = []
+    chunks = 0
+    for r in range(runs):
+        pdf = make_pdf(tmp / f"synth-{r}.pdf", pages, seed=r)
+        t0 = time.perf_counter()
+        res = ingest_pdf(pdf, source_name=pdf.name)
+        secs.append(time.perf_counter() - t0)
+        chunks += res.get("added_chunks", 0)
+    total = sum(secs)
+    return {"runs": runs, "pages": pages, "seconds": percentiles(secs),
+            "pages_per_s": round(pages * runs / total, 1), "chunks_per_s": round(chunks / total, 1)}
+
+
+def scenario_retrieve(queries: List[str]) -> Dict[str, Any]:
+    from app.rag import retrieve_context
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        retrieve_context(queries[i], top_k=6, source=SOURCE)
+        return (time.perf_counter() - t0) * 1000, None
+
+    return run_load(one, len(queries), 1)
+
+
+def scenario_chat(base: str, queries: List[str], concurrency: int, stream: bool) -> Dict[str, Any]:
+    http = requests.Session()
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    url = f"{base}/chat/stream" if stream else f"{base}/chat"
+
+    def one(i: int):
+        # un cliente virtual por hilo de carga: su propia sesión
+        headers = {"X-Session-ID": f"benchclient{i % concurrency:04d}"}
+        body = {"message": queries[i], "source": SOURCE}
+        t0 = time.perf_counter()
+        if not stream:
+            r = http.post(url, json=body, headers=headers)
+            r.raise_for_status()
+            return (time.perf_counter() - t0) * 1000, None
+        ttft = None
+        with http.post(url, json=body, headers=headers, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                ev = json.loads(line)
+                if ev["type"] == "token" and ttft is None:
+                    ttft = (time.perf_counter() - t0) * 1000
+                elif ev["type"] == "error":
+                    raise RuntimeError(ev.get("detail"))
+        return (time.perf_counter() - t0) * 1000, ttft
+
+    return run_load(one, len(queries), concurrency)
+
+
+def _print(name: str, res: Dict[str, Any]) -> None:
+    if "latency_ms" in res:
+        lat = res["latency_ms"]
+        line = (f"{name:9s} n={res['requests']} c={res['concurrency']} errores={res['errors']} "
+                f"{res['rps']} req/s  p50={lat.get('p50')}ms p95={lat.get('p95')}ms p99={lat.get('p99')}ms")
+        if "ttft_ms" in res:
+            line += f"  ttft p50={res['ttft_ms']['p50']}ms"
+        print(line)
+    else:
+        s = res["seconds"]
+        print(f"{name:9s} {res['runs']}x{res['pages']} págs  p50={s['p50']}s  "
+              f"{res['pages_per_s']} págs/s  {res['chunks_per_s']} chunks/s")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenarios", default="ingest,retrieve,chat,stream")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--corpus", type=int, default=2000, help="chunks sintéticos en la colección")
+    ap.add_argument("--pages", type=int, default=100, help="páginas por PDF en el escenario ingest")
+    ap.add_argument("--ingest-runs", type=int, default=3)
+    ap.add_argument("--embed-latency", type=float, default=0.005)
+    ap.add_argument("--prefill", type=float, default=0.1, help="segundos hasta el primer token en el stub")
+    ap.add_argument("--tokens", type=int, default=20)
+    ap.add_argument("--token-delay", type=float, default=0.005)
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--out", default=None, help="ruta del JSON (por defecto bench/results/)")
+    args = ap.parse_args()
+    scenarios = [s for s in args.scenarios.split(",") if s]
+
+    stub = StubOllama(latency=args.embed_latency, chat_prefill=args.prefill,
+                      token_delay=args.token_delay, tokens=args.tokens).start()
+    tmp = Path(tempfile.mkdtemp(prefix="bench_load_"))
+    # settings se lee al importar la app: entorno primero
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = str(tmp / "chroma")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    from app.lexical import lexical_index
+    from app.retriever import collection_handle
+    from bench.app_server import serve_app
+
+    results: Dict[str, Any] = {}
+    with serve_app() as base:
+        ids, texts, codes = make_corpus(args.corpus, args.seed)
+        col = collection_handle.get()
+        for s in range(0, len(ids), 500):
+            col.add(ids=ids[s:s + 500], documents=texts[s:s + 500],
+                    metadatas=[{"source": SOURCE, "page": j} for j in range(s, min(s + 500, len(ids)))])
+        lexical_index.add(zip(ids, texts, [SOURCE] * len(ids)))
+        queries = [q for _, q, _ in make_queries(ids, texts, codes, args.requests * 3, args.seed)]
+
+        # cada escenario con preguntas distintas: ninguna caché ayuda
+        plan = {
+            "ingest": lambda: scenario_ingest(args.pages, args.ingest_runs, tmp),
+            "retrieve": lambda: scenario_retrieve(queries[:args.requests]),
+            "chat": lambda: scenario_chat(base, queries[args.requests:2 * args.requests], args.concurrency, False),
+            "stream": lambda: scenario_chat(base, queries[2 * args.requests:], args.concurrency, True),
+        }
+        for name in scenarios:
+            if name not in plan:
+                raise SystemExit(f"escenario desconocido: {name} (hay {', '.join(plan)})")
+            results[name] = plan[name]()
+            _print(name, results[name])
+
+    stub.stop()
+    path = write_results("load", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+import argparse
+import gc
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from bench.results import percentiles, write_results
+from bench.synth_corpus import make_corpus, make_pages, messy_text
+
+"""
+Microbenchmarks de las piezas CPU del camino de ingesta y de /chat:
+limpieza de texto, troceado, tokenización, similitud/MMR, fusión RRF y
+armado del prompt. Mide cada llamada por separado (µs, p50/p95/p99) y
+guarda el resultado en JSON para compararlo con python -m bench.compare.
+Uso: python -m bench.bench_micro [--quick] [--only sanitize,pack_messages]
+"""
+
+
+def measure(fn: Callable[[], Any], iters: int, warmup: int = 3) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples: List[float] = []
+    gc_was = gc.isenabled()
+    gc.disable()  # que una pasada del GC no caiga justo en una muestra
+    try:
+        for _ in range(iters):
+            t0 = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - t0) * 1e6)
+    finally:
+        if gc_was:
+            gc.enable()
+    return {**percentiles(samples), "unit": "us"}
+
+
+def cases(dim: int) -> Dict[str, Callable[[], Any]]:
+    from app.embeddings import cosine_sim
+    from app.ingest import iter_chunks
+    from app.lexical import rrf_fuse, tokenize
+    from app.mmr import mmr_select
+    from app.pdf_extract import sanitize_text
+    from app.rag import pack_messages
+    from app.tokens import estimate_tokens
+
+    page = messy_text(700, seed=1)            # ~una página de manual
+    pages = make_pages(20, seed=2)
+    _, texts, _ = make_corpus(60, seed=3)
+    chunk = texts[0]
+    contexts = [" ".join(texts[i:i + 3]) for i in range(0, 18, 3)]   # 6 fragmentos de ~1200 caracteres
+    metas = [{"source": "manual.pdf", "page": i} for i in range(len(contexts))]
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": texts[20 + i]} for i in range(10)]
+    rng = np.random.default_rng(0)
+    qvec = rng.standard_normal(dim).tolist()
+    cands = rng.standard_normal((18, dim)).tolist()
+    ranking_a = [f"c{i}" for i in range(18)]
+    ranking_b = [f"c{i}" for i in range(9, 27)]
+
+    return {
+        "sanitize": lambda: sanitize_text(page),
+        "chunk_20_pages": lambda: list(iter_chunks(pages)),
+        "tokenize": lambda: tokenize(chunk),
+        "estimate_tokens": lambda: estimate_tokens(contexts[0]),
+        "cosine_sim": lambda: cosine_sim(qvec, cands[0]),
+        "mmr_select_18": lambda: mmr_select(qvec, cands, 6, 0.5),
+        "rrf_fuse": lambda: rrf_fuse([ranking_a, ranking_b], k=60),
+        "pack_messages": lambda: pack_messages("¿Qué cubre la garantía?", contexts, metas, history),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--iters", type=int, default=2000)
+    ap.add_argument("--quick", action="store_true", help="200 iteraciones por caso")
+    ap.add_argument("--only", default="", help="casos separados por comas")
+    ap.add_argument("--dim", type=int, default=768)
+    ap.add_argument("--out", default=None, help="ruta del JSON (por defecto bench/results/)")
+    args = ap.parse_args()
+    iters = 200 if args.quick else args.iters
+
+    selected = {c for c in args.only.split(",") if c}
+    results: Dict[str, Dict[str, float]] = {}
+    for name, fn in cases(args.dim).items():
+        if selected and name not in selected:
+            continue
+        # los casos lentos (troceado) con menos iteraciones
+        t0 = time.perf_counter()
+        fn()
+        n = max(20, min(iters, int(2.0 / max(time.perf_counter() - t0, 1e-6))))
+        results[name] = measure(fn, n)
+        r = results[name]
+        print(f"{name:16s} n={r['n']:5d} p50={r['p50']:10.1f}µs p95={r['p95']:10.1f}µs p99={r['p99']:10.1f}µs")
+
+    path = write_results("micro", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+from __future__ import annotations
+import argparse
+import time
+
+import numpy as np
+
+from app.embeddings import cosine_sim
+from app.mmr import mmr_select
+
+"""
+Microbenchmark de MMR: versión vectorizada (NumPy) frente a un bucle en
+Python puro con cosine_sim, para pools de 20 a 2000 candidatos.
+Uso: python -m bench.bench_mmr --dim 768 --k 6
+"""
+
+def mmr_python(q, cands, k, lam):
+    # referencia ingenua con cosine_sim
+    rel = [cosine_sim(q, c) for c in cands]
+    selected = [max(range(len(cands)), key=lambda i: rel[i])]
+    while len(selected) < min(k, len(cands)):
+        best, best_score = None, float("-inf")
+        for i in range(len(cands)):
+            if i in selected:
+                continue
+            div = max(cosine_sim(cands[i], cands[j]) for j in selected)
+            score = lam * rel[i] - (1 - lam) * div
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+    return selected
+
+
+def bench(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dim", type=int, default=768)
+    ap.add_argument("--k", type=int, default=6)
+    ap.add_argument("--lambda-mult", type=float, default=0.5)
+    ap.add_argument("--pools", default="20,50,100,200,500,1000,2000")
+    ap.add_argument("--python-max", type=int, default=500, help="pool máximo para la versión Python")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    q = rng.standard_normal(args.dim).astype(np.float32)
+    print(f"{'pool':>6} {'numpy_ms':>10} {'python_ms':>10} {'speedup':>8}")
+    for n in [int(x) for x in args.pools.split(",")]:
+        cands = rng.standard_normal((n, args.dim)).astype(np.float32)
+        np_ms = bench(lambda: mmr_select(q, cands, args.k, args.lambda_mult), repeat=20)
+        if n <= args.python_max:
+            q_l, c_l = q.tolist(), cands.tolist()
+            py_ms = bench(lambda: mmr_python(q_l, c_l, args.k, args.lambda_mult), repeat=3)
+            print(f"{n:>6} {np_ms:>10.3f} {py_ms:>10.2f} {py_ms / np_ms:>7.0f}x")
+        else:
+            print(f"{n:>6} {np_ms:>10.3f} {'-':>10} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
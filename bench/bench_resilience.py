@@ -0,0 +1,137 @@
+from __future__ import annotations
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+
+from bench.results import percentiles, write_results
+from bench.stub_ollama import StubOllama
+
+"""
+Comportamiento de /chat cuando Ollama falla, contra el stub:
+- flaky: un --fail-rate de las peticiones da 503; errores con y sin reintentos.
+- outage: Ollama caído del todo; latencia de cada /chat con y sin circuit breaker
+  y peticiones que llegan al stub.
+- deadline: el LLM tarda más que REQUEST_DEADLINE; la petición corta a tiempo (504).
+- coalesce: --concurrent preguntas idénticas a la vez; llamadas al LLM con y
+  sin COALESCE_REQUESTS.
+Uso: python -m bench.bench_resilience --calls 40 --fail-rate 0.3
+"""
+
+SOURCE = "bench.pdf"
+
+
+def _chat(base: str, message: str) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    r = requests.post(f"{base}/chat", json={"message": message, "source": SOURCE}, timeout=120)
+    return {"status": r.status_code, "ms": (time.perf_counter() - t0) * 1000}
+
+
+def _summary(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    statuses: Dict[str, int] = {}
+    for row in rows:
+        statuses[str(row["status"])] = statuses.get(str(row["status"]), 0) + 1
+    return {"statuses": statuses, "latency_ms": percentiles([row["ms"] for row in rows])}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=40)
+    ap.add_argument("--fail-rate", type=float, default=0.3)
+    ap.add_argument("--concurrent", type=int, default=16)
+    ap.add_argument("--prefill", type=float, default=0.2)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    stub = StubOllama(latency=0.005, chat_prefill=args.prefill, token_delay=0.002, tokens=10).start()
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = tempfile.mkdtemp(prefix="bench_chroma_")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    from app.lexical import lexical_index
+    from app.resilience import get_upstream
+    from app.retriever import collection_handle
+    from app.settings import settings
+    from bench.app_server import serve_app
+
+    upstreams = [get_upstream("llm"), get_upstream("embeddings")]
+    defaults = {u.name: (u.attempts, u.breaker.failure_threshold) for u in upstreams}
+
+    def configure(retries: bool = True, breaker: bool = True) -> None:
+        for u in upstreams:
+            attempts, threshold = defaults[u.name]
+            u.attempts = attempts if retries else 1
+            u.breaker.failure_threshold = threshold if breaker else 10 ** 9
+            u.breaker.success()   # vuelve a closed
+
+    results: Dict[str, Any] = {}
+    with serve_app() as base:
+        ids = [f"bench:1:{i}" for i in range(200)]
+        docs = [f"Artículo {i}: la garantía cubre {i} meses." for i in range(200)]
+        collection_handle.get().add(
+            ids=ids, documents=docs,
+            metadatas=[{"source": SOURCE, "page": 1, "chunk": i, "file_hash": "bench"} for i in range(200)],
+        )
+        lexical_index.add(zip(ids, docs, [SOURCE] * len(ids)))
+        # preguntas distintas en cada tanda para que ninguna caché ayude
+        seq = iter(range(10 ** 9))
+
+        def batch(label: str) -> List[Dict[str, Any]]:
+            # mismas palabras que el corpus: con el embedder caído, BM25 sigue encontrando contexto
+            return [_chat(base, f"¿Cuántos meses cubre la garantía del artículo {next(seq)}? ({label})")
+                    for _ in range(args.calls)]
+
+        # flaky
+        stub.fail_rate = args.fail_rate
+        results["flaky"] = {}
+        for name, retries in (("no_retries", False), ("retries", True)):
+            configure(retries=retries)
+            calls0 = stub.requests
+            results["flaky"][name] = {**_summary(batch(name)), "upstream_calls": stub.requests - calls0}
+        stub.fail_rate = 0.0
+
+        # outage
+        stub.down = True
+        results["outage"] = {}
+        for name, breaker in (("no_breaker", False), ("breaker", True)):
+            configure(breaker=breaker)
+            calls0 = stub.requests
+            results["outage"][name] = {**_summary(batch(name)), "upstream_calls": stub.requests - calls0}
+        stub.down = False
+        configure()
+
+        # deadline: el LLM tarda 4x el plazo
+        deadline, settings.request_deadline = settings.request_deadline, args.prefill / 4
+        results["deadline"] = _summary([_chat(base, f"¿Qué garantía tiene el artículo {next(seq)}?")
+                                         for _ in range(5)])
+        settings.request_deadline = deadline
+
+        # coalesce
+        results["coalesce"] = {}
+        for name, on in (("off", False), ("on", True)):
+            settings.coalesce_requests = on
+            message = f"¿Cuántos meses cubre la garantía? ({name})"
+            calls0 = stub.requests
+            with ThreadPoolExecutor(max_workers=args.concurrent) as pool:
+                rows = list(pool.map(lambda _: _chat(base, message), range(args.concurrent)))
+            results["coalesce"][name] = {**_summary(rows), "upstream_calls": stub.requests - calls0}
+        settings.coalesce_requests = True
+    stub.stop()
+
+    for scenario, data in results.items():
+        rows = data.items() if "statuses" not in data else [("", data)]
+        for name, r in rows:
+            lat = r["latency_ms"]
+            calls = f" llamadas al stub={r['upstream_calls']}" if "upstream_calls" in r else ""
+            print(f"{scenario:9s} {name:11s} estados={r['statuses']} p50={lat['p50']:.1f}ms "
+                  f"p95={lat['p95']:.1f}ms{calls}")
+    path = write_results("resilience", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
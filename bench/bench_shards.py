@@ -0,0 +1,103 @@
+from __future__ import annotations
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from bench.bench_compact import make_vectors
+from bench.results import percentiles, write_results
+
+"""
+Latencia de la consulta vectorial según el tamaño del corpus con una sola
+colección (where por fuente), con una colección por fuente (SHARD_MODE=source)
+y con cubos de hash (SHARD_MODE=hash): consulta de una fuente, consulta a
+todas (fan-out) y borrado de una fuente. Vectores sintéticos, sin Ollama.
+Uso: python -m bench.bench_shards --sizes 2000,10000,40000 --sources 40
+"""
+
+MODES = {"single": "", "source": "source", "hash": "hash"}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="2000,10000,40000", help="chunks en total")
+    ap.add_argument("--sources", type=int, default=40)
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--k", type=int, default=18)
+    ap.add_argument("--buckets", type=int, default=8)
+    ap.add_argument("--modes", default=",".join(MODES))
+    ap.add_argument("--seed", type=int, default=5)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix="bench_shards_"))
+    os.environ["CHROMA_PATH"] = str(tmp / "unused")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    import app.rag as rag
+    from app.retriever import CollectionHandle
+    from app.settings import settings
+    from app.shards import shutdown_pool
+
+    settings.shard_buckets = args.buckets
+    sources = [f"doc-{i:03d}.pdf" for i in range(args.sources)]
+    results: Dict[str, Any] = {}
+    for size in [int(x) for x in args.sizes.split(",") if x]:
+        vecs = make_vectors(size, args.dim, args.sources * 2, args.seed)
+        owner = [sources[i % args.sources] for i in range(size)]
+        ids = [f"c{i}" for i in range(size)]
+        rng = random.Random(args.seed)
+        picks = [rng.randrange(size) for _ in range(args.queries)]
+        qvecs = [(vecs[i] + np.random.default_rng(i).normal(scale=0.03, size=args.dim)).tolist() for i in picks]
+        results[str(size)] = {}
+        for label in args.modes.split(","):
+            handle = CollectionHandle(str(tmp / f"{label}_{size}"), shard_mode=MODES[label])
+            rag.collection_handle = handle
+            handle.open()
+            t0 = time.perf_counter()
+            for src in sources:
+                rows = [i for i in range(size) if owner[i] == src]
+                col = handle.writable(src)
+                for s in range(0, len(rows), 1000):
+                    part = rows[s:s + 1000]
+                    col.add(ids=[ids[i] for i in part], embeddings=vecs[part].tolist(),
+                            documents=[f"chunk {i}" for i in part],
+                            metadatas=[{"source": src, "page": i} for i in part])
+                handle.publish(src, col, None, len(rows))
+            build_s = time.perf_counter() - t0
+
+            def run(scoped: bool) -> Dict[str, Any]:
+                lat: List[float] = []
+                for q, i in zip(qvecs, picks):
+                    src = owner[i] if scoped else None
+                    t0 = time.perf_counter()
+                    got = rag._vector_candidates(handle.view(src), [q], args.k, src, False)[0]
+                    lat.append((time.perf_counter() - t0) * 1000)
+                    assert ids[i] in got or not scoped or len(got) < args.k
+                return {"latency_ms": percentiles(lat)}
+
+            run(True)   # calienta los índices HNSW
+            row = {"build_s": round(build_s, 2), "scoped": run(True), "all": run(False)}
+            victim = sources[0]
+            victim_ids = [ids[i] for i in range(size) if owner[i] == victim]
+            t0 = time.perf_counter()
+            handle.delete_source(victim, victim_ids)
+            row["delete_source_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            handle.close()
+            results[str(size)][label] = row
+            print(f"{size:6d} {label:7s} fuente p50={row['scoped']['latency_ms']['p50']:.2f}ms "
+                  f"p95={row['scoped']['latency_ms']['p95']:.2f}ms  todas p50={row['all']['latency_ms']['p50']:.2f}ms "
+                  f"p95={row['all']['latency_ms']['p95']:.2f}ms  borrar fuente={row['delete_source_ms']:.1f}ms")
+    shutdown_pool()
+
+    path = write_results("shards", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
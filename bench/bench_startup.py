@@ -0,0 +1,145 @@
+from __future__ import annotations
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import requests
+
+from bench.results import write_results
+from bench.stub_ollama import StubOllama, fake_vector
+from bench.synth_corpus import make_corpus
+
+"""
+Arranque en frío: levanta uvicorn en un proceso nuevo contra un stub de
+Ollama que tarda --load-delay en cargar cada modelo la primera vez, y mide
+cuándo responde /health/live, cuándo /health/ready y cuánto tarda la
+primera pregunta, esperando a ready (como un balanceador) o lanzada en
+cuanto el proceso responde. Compara arranque normal sin warm-up (como
+antes), normal con warm-up y LAZY_STARTUP.
+Uso: python -m bench.bench_startup --corpus 5000 --load-delay 2
+"""
+
+MODES = {
+    "eager": {"LAZY_STARTUP": "0", "WARMUP_MODELS": "0"},
+    "eager_warmup": {"LAZY_STARTUP": "0", "WARMUP_MODELS": "1"},
+    "lazy_warmup": {"LAZY_STARTUP": "1", "WARMUP_MODELS": "1"},
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _poll(url: str, t0: float, timeout: float, want_ok: bool = True) -> Optional[float]:
+    # ms desde t0 hasta la primera respuesta (con want_ok: la primera 200)
+    while time.perf_counter() - t0 < timeout:
+        try:
+            r = requests.get(url, timeout=1)
+            if not want_ok or r.ok:
+                return (time.perf_counter() - t0) * 1000
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def run_mode(name: str, env_extra: Dict[str, str], chroma: Path, args, gate: bool) -> Dict[str, Any]:
+    """
+    gate=True: el cliente espera a /health/ready antes de preguntar (como un
+    balanceador); gate=False: pregunta en cuanto el proceso responde.
+    """
+    stub = StubOllama(latency=0.005, chat_prefill=args.prefill, token_delay=0.005, tokens=10,
+                      load_delay=args.load_delay).start()
+    port = _free_port()
+    env = {**os.environ, **env_extra, "OLLAMA_HOST": stub.url, "CHROMA_PATH": str(chroma),
+           "ANONYMIZED_TELEMETRY": "False"}
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    ready: Dict[str, Optional[float]] = {}
+    poller = threading.Thread(target=lambda: ready.update(ms=_poll(f"{base}/health/ready", t0, args.timeout)))
+    try:
+        live_ms = _poll(f"{base}/health/live", t0, args.timeout)
+        poller.start()
+        if gate:
+            poller.join()
+        t_chat = time.perf_counter()
+        r = requests.post(f"{base}/chat", json={"message": "¿Qué cubre la garantía?"}, timeout=args.timeout)
+        first_chat_ms = (time.perf_counter() - t_chat) * 1000
+        answered_ms = (time.perf_counter() - t0) * 1000
+        first_ok = r.ok
+        poller.join()
+        status = requests.get(f"{base}/health/ready", timeout=5).json()
+        t_chat = time.perf_counter()
+        requests.post(f"{base}/chat", json={"message": "¿Y el plazo de devolución?"}, timeout=args.timeout)
+        second_chat_ms = (time.perf_counter() - t_chat) * 1000
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        stub.stop()
+    res = {
+        "live_ms": round(live_ms, 1) if live_ms else None,
+        "ready_ms": round(ready["ms"], 1) if ready.get("ms") else None,
+        "first_chat_ms": round(first_chat_ms, 1),
+        "first_chat_ok": first_ok,
+        "first_answer_at_ms": round(answered_ms, 1),
+        "second_chat_ms": round(second_chat_ms, 1),
+        "app": {k: v for k, v in status.items() if k.endswith("_ms")},
+        "steps_ms": {k: v.get("ms") for k, v in (status.get("steps") or {}).items()},
+    }
+    print(f"{name:13s} {'esperando ready' if gate else 'sin esperar':15s} live={res['live_ms']}ms "
+          f"ready={res['ready_ms']}ms primera /chat={res['first_chat_ms']}ms "
+          f"(respondida a los {res['first_answer_at_ms']}ms) segunda={res['second_chat_ms']}ms")
+    return res
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--corpus", type=int, default=5000, help="chunks ya ingestados en Chroma")
+    ap.add_argument("--load-delay", type=float, default=2.0, help="carga en frío de cada modelo en el stub (s)")
+    ap.add_argument("--prefill", type=float, default=0.1)
+    ap.add_argument("--modes", default=",".join(MODES))
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix="bench_startup_"))
+    chroma = tmp / "chroma"
+    # corpus ya ingestado (con embeddings propios: sin stub) y su índice BM25
+    os.environ["CHROMA_PATH"] = str(chroma)
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    from app.lexical import lexical_index
+    from app.retriever import collection_handle
+
+    ids, texts, _ = make_corpus(args.corpus, seed=1)
+    col = collection_handle.open()
+    for s in range(0, len(ids), 1000):
+        col.add(ids=ids[s:s + 1000], documents=texts[s:s + 1000],
+                embeddings=[fake_vector(t) for t in texts[s:s + 1000]],
+                metadatas=[{"source": "corpus.pdf", "page": j} for j in range(s, min(s + 1000, len(ids)))])
+    lexical_index.add(zip(ids, texts, ["corpus.pdf"] * len(ids)))
+    lexical_index.close()
+    collection_handle.close()
+
+    results: Dict[str, Any] = {}
+    for name in [m for m in args.modes.split(",") if m]:
+        results[name] = {"gated": run_mode(name, MODES[name], chroma, args, gate=True),
+                         "ungated": run_mode(name, MODES[name], chroma, args, gate=False)}
+    path = write_results("startup", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from bench.stub_ollama import StubOllama
+
+"""
+Tiempo hasta el primer token (TTFT) de /chat/stream frente al tiempo total
+de /chat, usando el stub de Ollama y una colección temporal.
+Uso: python -m bench.bench_stream --tokens 200 --token-delay 0.02
+"""
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tokens", type=int, default=100)
+    ap.add_argument("--token-delay", type=float, default=0.02)
+    ap.add_argument("--prefill", type=float, default=0.3)
+    ap.add_argument("--runs", type=int, default=3)
+    args = ap.parse_args()
+
+    stub = StubOllama(latency=0.0, chat_prefill=args.prefill,
+                      token_delay=args.token_delay, tokens=args.tokens).start()
+    # la app lee la configuración al importarse
+    os.environ["OLLAMA_HOST"] = stub.url
+    os.environ["CHROMA_PATH"] = tempfile.mkdtemp(prefix="bench_chroma_")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    import requests
+    from app.retriever import collection_handle
+    from bench.app_server import serve_app
+
+    with serve_app() as base:
+        client = requests.Session()
+        collection_handle.get().add(
+            ids=["bench:1:0"], documents=["La garantía cubre 24 meses."],
+            metadatas=[{"source": "bench.pdf", "page": 1, "chunk": 0, "file_hash": "bench"}],
+        )
+        body = {"message": "¿Cuánto dura la garantía?", "source": "bench.pdf"}
+
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            client.post(f"{base}/chat", json=body).raise_for_status()
+            full_ms = (time.perf_counter() - t0) * 1000
+
+            t0 = time.perf_counter()
+            first_ms = None
+            server_ttft = None
+            with client.post(f"{base}/chat/stream", json=body, stream=True) as r:
+                for line in r.iter_lines():
+                    if not line:
+                        continue
+                    ev = json.loads(line)
+                    if ev["type"] == "token" and first_ms is None:
+                        first_ms = (time.perf_counter() - t0) * 1000
+                    if ev["type"] == "done":
+                        server_ttft = ev["extra"].get("ttft_ms")
+            stream_ms = (time.perf_counter() - t0) * 1000
+            print(f"/chat total={full_ms:8.1f}ms | /chat/stream primer token={first_ms:8.1f}ms "
+                  f"(servidor {server_ttft}ms) total={stream_ms:8.1f}ms")
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
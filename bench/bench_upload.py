@@ -0,0 +1,80 @@
+from __future__ import annotations
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+from bench.results import write_results
+
+"""
+Subida de un archivo grande hasta tener su file_hash: la versión anterior
+(read() entero, write_bytes y la ingesta vuelve a leerlo para el hash)
+frente a stage() (copia por trozos hashando a la vez). Mide tiempo y pico
+de memoria Python (tracemalloc) para el mismo archivo ya en el spool de
+Starlette.
+Uso: python -m bench.bench_upload --mb 200
+"""
+
+
+def _old(src: Path, dest: Path) -> str:
+    with open(src, "rb") as fh:
+        data = fh.read()
+    dest.write_bytes(data)
+    del data
+    raw = dest.read_bytes()
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+def _measure(fn: Callable[[], str]) -> Dict[str, Any]:
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    digest = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"s": round(elapsed, 3), "peak_mb": round(peak / 2 ** 20, 1), "file_hash": digest}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=int, default=200)
+    ap.add_argument("--chunk-size", type=int, default=None, help="UPLOAD_CHUNK_SIZE en bytes")
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+    if args.chunk_size:
+        os.environ["UPLOAD_CHUNK_SIZE"] = str(args.chunk_size)
+    from app.settings import settings
+    from app.uploads import stage
+
+    tmp = Path(tempfile.mkdtemp(prefix="bench_upload_"))
+    src = tmp / "spool.bin"
+    with open(src, "wb") as fh:
+        for _ in range(args.mb):
+            fh.write(os.urandom(2 ** 20))
+
+    def new() -> str:
+        with open(src, "rb") as fh:
+            staged = stage(fh, args.mb * 2 ** 20, tmp / "staged")
+        return staged.file_hash
+
+    results = {
+        "read_all": _measure(lambda: _old(src, tmp / "old.pdf")),
+        "streamed": _measure(new),
+        "chunk_size": settings.upload_chunk_size,
+    }
+    assert results["read_all"]["file_hash"] == results["streamed"]["file_hash"]
+    shutil.rmtree(tmp, ignore_errors=True)
+    for name in ("read_all", "streamed"):
+        r = results[name]
+        print(f"{name:9s} {r['s']:.2f}s pico={r['peak_mb']:.1f}MB")
+    path = write_results("upload", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
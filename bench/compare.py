@@ -0,0 +1,65 @@
+from __future__ import annotations
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, Iterator, Tuple
+
+"""
+Compara dos resultados JSON de bench_micro/bench_load (u otro que use
+bench.results): muestra las métricas comunes y marca como regresión las
+latencias que suben o los throughputs que bajan más de --threshold.
+Sale con código 1 si hay regresiones (útil en CI).
+Uso: python -m bench.compare bench/results/load-A.json bench/results/load-B.json --threshold 0.1
+"""
+
+# métricas donde más es mejor; el resto de las numéricas que comparamos son tiempos
+_HIGHER_IS_BETTER = ("rps", "pages_per_s", "chunks_per_s")
+_COMPARED = ("p50", "p95", "p99", "mean") + _HIGHER_IS_BETTER
+
+
+def _flatten(d: Any, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    if isinstance(d, dict):
+        for k, v in d.items():
+            yield from _flatten(v, f"{prefix}.{k}" if prefix else k)
+    elif isinstance(d, (int, float)) and not isinstance(d, bool) and prefix.rsplit(".", 1)[-1] in _COMPARED:
+        yield prefix, float(d)
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], threshold: float) -> int:
+    a = dict(_flatten(old.get("results", old)))
+    b = dict(_flatten(new.get("results", new)))
+    regressions = 0
+    print(f"{'métrica':40s} {'antes':>12s} {'después':>12s} {'cambio':>9s}")
+    for key in sorted(a.keys() & b.keys()):
+        before, after = a[key], b[key]
+        change = (after - before) / before if before else 0.0
+        worse = -change if key.rsplit(".", 1)[-1] in _HIGHER_IS_BETTER else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESIÓN"
+            regressions += 1
+        elif worse < -threshold:
+            flag = "  mejora"
+        print(f"{key:40s} {before:12.3f} {after:12.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("old", type=Path)
+    ap.add_argument("new", type=Path)
+    ap.add_argument("--threshold", type=float, default=0.10, help="cambio relativo tolerado (0.10 = 10%%)")
+    args = ap.parse_args()
+    old = json.loads(args.old.read_text(encoding="utf-8"))
+    new = json.loads(args.new.read_text(encoding="utf-8"))
+    for label, doc in (("antes", old), ("después", new)):
+        env = doc.get("env") or {}
+        print(f"{label}: {doc.get('bench')} {doc.get('time')} commit={env.get('commit')} python={env.get('python')}")
+    regressions = compare(old, new, args.threshold)
+    print(f"{regressions} regresiones (umbral {args.threshold:.0%})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from bench.results import percentiles, write_results
+from bench.synth_corpus import _FILLER, make_corpus, toy_embed
+
+"""
+Evaluación offline del re-ranking (RERANK=features): precision@k, recall@k
+y MRR con y sin re-ranking, y los ms que añade (rerank_ms y total de la
+recuperación).
+- Sin --labels: corpus sintético con el embedder de juguete, tres chunks
+  relevantes por pregunta y distractores como los de los PDFs reales
+  (índices con números de página, títulos sueltos).
+- Con --labels preguntas.jsonl: la base de CHROMA_PATH y el embedder
+  configurado; cada línea {"question", "relevant": [id o "fuente:página"],
+  "source"?}.
+Uso: python -m bench.eval_rerank --chunks 4000 --queries 200 --k 4
+"""
+
+
+def _paraphrase(rnd: random.Random, text: str) -> str:
+    # mismas palabras del tema, en otro orden y con otras palabras vacías
+    words = [w for w in text.split() if w not in _FILLER]
+    rnd.shuffle(words)
+    return " ".join(w if rnd.random() < 0.75 else rnd.choice(_FILLER) for w in words)
+
+
+def synthetic(n: int, n_queries: int, seed: int) -> Tuple[List[Tuple[str, str, Dict[str, Any]]], List[dict]]:
+    """
+    (id, texto, metadatos) del corpus y preguntas {"question", "relevant"}.
+    """
+    from app.rerank import chunk_features
+
+    rnd = random.Random(seed)
+    ids, texts, _ = make_corpus(n, seed, code_ratio=0.0)
+    chunks = [(cid, t, {"page": rnd.randint(1, 300)}) for cid, t in zip(ids, texts)]
+    queries: List[dict] = []
+    for i in rnd.sample(range(n), n_queries):
+        rel = [ids[i]]
+        for j in range(2):
+            pid = f"p{i}_{j}"
+            chunks.append((pid, _paraphrase(rnd, texts[i]), {"page": rnd.randint(1, 300)}))
+            rel.append(pid)
+        words = [w for w in texts[i].split() if w not in _FILLER]
+        queries.append({"question": " ".join(rnd.sample(words, min(6, len(words)))), "relevant": rel})
+    # distractores: índices alfabéticos (palabra ..... página) y títulos de 3-5 palabras
+    for d in range(n // 10):
+        base = texts[rnd.randrange(n)].split()
+        entries = rnd.sample(base, min(14, len(base)))
+        index = "\n".join(f"{w} ..... {rnd.randint(1, 300)}" for w in entries)
+        chunks.append((f"idx{d}", index, {"page": rnd.randint(280, 300)}))
+        chunks.append((f"hdr{d}", " ".join(rnd.sample(base, min(4, len(base)))).title(), {"page": rnd.randint(1, 300)}))
+    out = []
+    for cid, text, meta in chunks:
+        out.append((cid, text, {"source": "eval.pdf", "chunk": 0, **meta, **chunk_features(text)}))
+    return out, queries
+
+
+def _relevant(hit_id: str, meta: Optional[dict], relevant: Set[str]) -> bool:
+    meta = meta or {}
+    return hit_id in relevant or f"{meta.get('source')}:{meta.get('page')}" in relevant
+
+
+def evaluate(queries: List[dict], qvecs: List[List[float]], k: int, mode: str) -> Dict[str, Any]:
+    from app.rag import _query_context
+
+    precision: List[float] = []
+    recall: List[float] = []
+    rr: List[float] = []
+    total_ms: List[float] = []
+    rerank_ms: List[float] = []
+    for q, qv in zip(queries, qvecs):
+        rel = set(q["relevant"])
+        timings: Dict[str, float] = {}
+        t0 = time.perf_counter()
+        out = _query_context(qv, k, q.get("source"), False, timings, question=q["question"], mode=mode)
+        total_ms.append((time.perf_counter() - t0) * 1000)
+        rerank_ms.append(timings.get("rerank_ms", 0.0))
+        hits = [_relevant(cid, m, rel) for cid, m in zip(out["ids"], out["metas"])]
+        precision.append(sum(hits) / k)
+        recall.append(min(1.0, sum(hits) / max(1, len(rel))))
+        rr.append(next((1.0 / (r + 1) for r, h in enumerate(hits) if h), 0.0))
+    return {
+        f"precision_at_{k}": round(statistics.fmean(precision), 4),
+        f"recall_at_{k}": round(statistics.fmean(recall), 4),
+        "mrr": round(statistics.fmean(rr), 4),
+        "retrieve_ms": percentiles(total_ms),
+        "rerank_ms": percentiles(rerank_ms),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--labels", default=None, help="JSONL con preguntas etiquetadas (usa CHROMA_PATH)")
+    ap.add_argument("--chunks", type=int, default=4000)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--modes", default="vector,hybrid")
+    ap.add_argument("--weights", default=None, help="RERANK_WEIGHTS a evaluar")
+    ap.add_argument("--budget-ms", type=float, default=None)
+    ap.add_argument("--seed", type=int, default=11)
+    ap.add_argument("--out", default=None)
+    args = ap.parse_args()
+
+    if not args.labels:
+        tmp = tempfile.mkdtemp(prefix="eval_rerank_")
+        os.environ["CHROMA_PATH"] = os.path.join(tmp, "chroma")
+        os.environ["BM25_PATH"] = os.path.join(tmp, "bm25.sqlite3")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    from app.lexical import lexical_index
+    from app.retriever import collection_handle
+    from app.settings import settings
+
+    if args.weights:
+        settings.rerank_weights = args.weights
+    if args.budget_ms is not None:
+        settings.rerank_budget_ms = args.budget_ms
+    settings.retrieval_cache_size = 0
+
+    if args.labels:
+        queries = [json.loads(line) for line in Path(args.labels).read_text(encoding="utf-8").splitlines() if line]
+        qvecs = [collection_handle.embed_query(q["question"]) for q in queries]
+    else:
+        chunks, queries = synthetic(args.chunks, args.queries, args.seed)
+        col = collection_handle.open()
+        for s in range(0, len(chunks), 1000):
+            part = chunks[s:s + 1000]
+            col.upsert(ids=[c[0] for c in part], documents=[c[1] for c in part],
+                       embeddings=[toy_embed(c[1]) for c in part], metadatas=[c[2] for c in part])
+        lexical_index.add((cid, text, meta["source"]) for cid, text, meta in chunks)
+        qvecs = [toy_embed(q["question"]) for q in queries]
+        print(f"corpus: {len(chunks)} chunks ({args.chunks} + paráfrasis + distractores), {len(queries)} preguntas")
+
+    results: Dict[str, Any] = {"weights": settings.rerank_weights, "budget_ms": settings.rerank_budget_ms}
+    for mode in args.modes.split(","):
+        results[mode] = {}
+        for label, rr in (("base", ""), ("rerank", "features")):
+            settings.rerank = rr
+            res = evaluate(queries, qvecs, args.k, mode)
+            results[mode][label] = res
+            print(f"{mode:7s} {label:7s} P@{args.k}={res[f'precision_at_{args.k}']:.3f} "
+                  f"R@{args.k}={res[f'recall_at_{args.k}']:.3f} MRR={res['mrr']:.3f} "
+                  f"recuperación p50={res['retrieve_ms']['p50']:.2f}ms rerank p50={res['rerank_ms']['p50']:.3f}ms "
+                  f"p95={res['rerank_ms']['p95']:.3f}ms")
+    lexical_index.close()
+    collection_handle.close()
+
+    path = write_results("rerank", results, vars(args), args.out)
+    print(f"resultados: {path}")
+
+
+if __name__ == "__main__":
+    main()
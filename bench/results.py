@@ -0,0 +1,59 @@
+from __future__ import annotations
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+"""
+Resultados de los benchmarks en JSON para poder comparar ejecuciones
+(python -m bench.compare viejo.json nuevo.json): percentiles de latencia y
+datos del entorno (commit, Python, CPU).
+"""
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def percentiles(samples: Iterable[float], digits: int = 3) -> Dict[str, float]:
+    # n, media y p50/p95/p99/max de una lista de latencias (en la unidad que venga)
+    s = sorted(samples)
+    if not s:
+        return {"n": 0}
+
+    def p(q: float) -> float:
+        return round(s[min(len(s) - 1, int(len(s) * q))], digits)
+
+    return {"n": len(s), "mean": round(statistics.fmean(s), digits),
+            "p50": p(0.50), "p95": p(0.95), "p99": p(0.99), "max": round(s[-1], digits)}
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent, timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(name: str, data: Dict[str, Any], args: Optional[Dict[str, Any]] = None,
+                  out: Optional[Path] = None) -> Path:
+    """
+    Guarda {"bench", "time", "env", "args", "results"} en out o, si no se
+    indica, en bench/results/<name>-<fecha>.json. Devuelve la ruta.
+    """
+    if out is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        out = RESULTS_DIR / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    doc = {"bench": name, "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "env": environment(),
+           "args": args or {}, "results": data}
+    Path(out).write_text(json.dumps(doc, indent=2, ensure_ascii=False), encoding="utf-8")
+    return Path(out)
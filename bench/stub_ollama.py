@@ -0,0 +1,203 @@
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+"""
+Servidor falso de Ollama para benchmarks: devuelve embeddings deterministas
+y respuestas de chat (con o sin stream) con una latencia configurable, sin
+necesitar modelos reales. También se puede levantar suelto para apuntar la
+app a él: python -m bench.stub_ollama --port 11434 --prefill 0.2
+"""
+
+def fake_vector(text: str, dim: int = 64) -> List[float]:
+    # vector determinista a partir del hash del texto
+    h = hashlib.sha256(text.encode("utf-8")).digest()
+    return [((h[i % len(h)] + i) % 255) / 255.0 - 0.5 for i in range(dim)]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clientes que cierran la conexión keep-alive no son un error del benchmark
+        import sys
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubOllama:
+    def __init__(
+        self,
+        latency: float = 0.01,
+        per_item: float = 0.0005,
+        dim: int = 64,
+        batch: bool = True,
+        chat_prefill: float = 0.2,
+        token_delay: float = 0.01,
+        tokens: int = 40,
+        load_delay: float = 0.0,
+        fail_rate: float = 0.0,
+    ):
+        # latency: coste fijo por petición; per_item: coste extra por texto en /api/embed
+        self.latency = latency
+        self.per_item = per_item
+        self.dim = dim
+        self.batch = batch
+        # chat: espera antes del primer token y entre tokens
+        self.chat_prefill = chat_prefill
+        self.token_delay = token_delay
+        self.tokens = tokens
+        # carga en frío: la primera petición a cada modelo espera load_delay
+        self.load_delay = load_delay
+        self.loaded: set = set()
+        self._load_lock = threading.Lock()
+        # fallos simulados: fail_rate = proporción de 503 al azar; down = todo 503
+        self.fail_rate = fail_rate
+        self.down = False
+        self._rng = random.Random(0)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server: _Server | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code: int, body: dict):
+                raw = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_POST(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(n) or b"{}")
+                with stub._lock:
+                    stub.requests += 1
+                if stub.down or (stub.fail_rate and stub._rng.random() < stub.fail_rate):
+                    self._send(503, {"error": "stub: fallo simulado"})
+                    return
+                stub._load(payload.get("model"))
+
+                if self.path == "/api/embed" and stub.batch:
+                    inputs = payload.get("input")
+                    inputs = inputs if isinstance(inputs, list) else [inputs]
+                    time.sleep(stub.latency + stub.per_item * len(inputs))
+                    self._send(200, {"model": payload.get("model"),
+                                     "embeddings": [fake_vector(t, stub.dim) for t in inputs]})
+                    return
+                if self.path == "/api/embeddings":
+                    time.sleep(stub.latency)
+                    # imita Ollama moderno: sólo entiende 'prompt'
+                    text = payload.get("prompt")
+                    self._send(200, {"embedding": fake_vector(text, stub.dim) if text else []})
+                    return
+                if self.path == "/api/chat":
+                    self._chat(payload)
+                    return
+                self._send(404, {"error": "not found"})
+
+            def _chat(self, payload: dict):
+                prompt = " ".join(m.get("content", "") for m in payload.get("messages") or [])
+                words = [f"palabra{i} " for i in range(stub.tokens)]
+                usage = {"prompt_eval_count": max(1, len(prompt) // 4), "eval_count": len(words)}
+                time.sleep(stub.chat_prefill)
+                if not payload.get("stream", True):
+                    time.sleep(stub.token_delay * len(words))
+                    self._send(200, {"model": payload.get("model"), "done": True,
+                                     "message": {"role": "assistant", "content": "".join(words)}, **usage})
+                    return
+
+                # NDJSON con transfer-encoding chunked, como Ollama
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def chunk(obj: dict):
+                    raw = (json.dumps(obj) + "\n").encode("utf-8")
+                    self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+                    self.wfile.flush()
+
+                for w in words:
+                    chunk({"model": payload.get("model"), "done": False,
+                           "message": {"role": "assistant", "content": w}})
+                    time.sleep(stub.token_delay)
+                chunk({"model": payload.get("model"), "done": True,
+                       "message": {"role": "assistant", "content": ""}, **usage})
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    def _load(self, model) -> None:
+        if not self.load_delay:
+            return
+        with self._load_lock:
+            if model not in self.loaded:
+                time.sleep(self.load_delay)
+                self.loaded.add(model)
+
+    def start(self, port: int = 0) -> "StubOllama":
+        self._server = _Server(("127.0.0.1", port), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=11434)
+    ap.add_argument("--latency", type=float, default=0.01, help="segundos por petición de embeddings")
+    ap.add_argument("--per-item", type=float, default=0.0005)
+    ap.add_argument("--dim", type=int, default=64)
+    ap.add_argument("--prefill", type=float, default=0.2, help="segundos hasta el primer token")
+    ap.add_argument("--token-delay", type=float, default=0.01)
+    ap.add_argument("--tokens", type=int, default=40)
+    ap.add_argument("--load-delay", type=float, default=0.0, help="carga en frío de cada modelo (s)")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="proporción de peticiones que fallan con 503")
+    args = ap.parse_args()
+    stub = StubOllama(latency=args.latency, per_item=args.per_item, dim=args.dim, chat_prefill=args.prefill,
+                      token_delay=args.token_delay, tokens=args.tokens, load_delay=args.load_delay,
+                      fail_rate=args.fail_rate).start(args.port)
+    print(f"stub de Ollama en {stub.url} (Ctrl+C para parar)")
+    try:
+        stub._thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+from __future__ import annotations
+import hashlib
+import random
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from bench.synth_pdf import synth_paragraphs
+
+"""
+Generadores deterministas (por semilla) de texto para los benchmarks:
+corpus con códigos de referencia y consultas con su chunk relevante,
+páginas como las que salen de la extracción de PDFs y texto "sucio"
+(ligaduras, controles, NULs) para la limpieza.
+"""
+
+_FILLER = ("el la de que en los las del se por con para una un su al es como más pero sus "
+           "este esta según cuando también sobre entre hasta todo").split()
+_SYLLABLES = "ba be bi bo ca ce ci co da de di do fa fe ga go la le li lo ma me mi mo na ne ni no pa pe " \
+             "pi po ra re ri ro sa se si so ta te ti to va ve vi za zo cla cre tri pro bla gra".split()
+# lo que suele traer pypdf: ligaduras, anchos completos, guiones blandos, controles
+_NOISE = ["ﬁ", "ﬂ", "Ａ", "­", "\x00", "\x07", "\x1b", "​", "\ud800", "\t", "\r"]
+
+
+def _vocab(rnd: random.Random, n: int) -> List[str]:
+    # palabras inventadas de 2-4 sílabas, únicas
+    words: set = set()
+    while len(words) < n:
+        words.add("".join(rnd.choice(_SYLLABLES) for _ in range(rnd.randint(2, 4))))
+    return sorted(words)
+
+
+def make_corpus(n: int, seed: int, code_ratio: float = 0.3, topics: int = 8) -> Tuple[List[str], List[str], Dict[str, int]]:
+    """
+    chunks de 40-80 palabras: vocabulario del tema con frecuencias Zipf
+    (pocas palabras muy comunes, muchas raras) más palabras vacías; una
+    parte lleva un código único (AB-1234, REF-48213...).
+    """
+    rnd = random.Random(seed)
+    vocabs = [_vocab(rnd, 400) for _ in range(topics)]
+    weights = [1.0 / (r + 1) for r in range(400)]
+    texts: List[str] = []
+    codes: Dict[str, int] = {}
+    for i in range(n):
+        vocab = vocabs[i % topics]
+        size = rnd.randint(40, 80)
+        topical = rnd.choices(vocab, weights=weights, k=size)
+        words = [w if rnd.random() < 0.6 else rnd.choice(_FILLER) for w in topical]
+        if rnd.random() < code_ratio:
+            code = f"{rnd.choice(['AB', 'REF', 'PZ', 'LT'])}-{rnd.randint(1000, 99999)}"
+            if code not in codes:
+                codes[code] = i
+                words.insert(rnd.randrange(len(words)), code)
+        texts.append(" ".join(words))
+    return [f"c{i}" for i in range(n)], texts, codes
+
+
+def make_queries(ids: List[str], texts: List[str], codes: Dict[str, int], n: int, seed: int) -> List[Tuple[str, str, str]]:
+    # (tipo, consulta, id relevante): mitad códigos, mitad temáticas
+    rnd = random.Random(seed + 1)
+    out: List[Tuple[str, str, str]] = []
+    code_items = list(codes.items())
+    for q in range(n):
+        if q % 2 == 0 and code_items:
+            code, i = rnd.choice(code_items)
+            tmpl = rnd.choice(["pieza {c}", "{c}", "¿Qué dice el documento sobre la referencia {c}?"])
+            out.append(("codigo", tmpl.format(c=code), ids[i]))
+        else:
+            i = rnd.randrange(len(texts))
+            words = [w for w in texts[i].split() if w not in _FILLER and not any(c.isdigit() for c in w)]
+            out.append(("tema", " ".join(rnd.sample(words, min(8, len(words)))), ids[i]))
+    return out
+
+
+def toy_embed(text: str, dim: int = 256) -> List[float]:
+    """
+    Embedder de juguete: bolsa de palabras con un vector aleatorio por
+    término. Ignora los números, como hacen en la práctica los modelos
+    densos con los identificadores.
+    """
+    from app.lexical import tokenize
+    v = np.zeros(dim, dtype=np.float32)
+    for tok in tokenize(text):
+        if any(c.isdigit() for c in tok):
+            continue
+        seed = int.from_bytes(hashlib.md5(tok.encode()).digest()[:4], "little")
+        v += np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    n = np.linalg.norm(v)
+    return (v / n if n else v).tolist()
+
+
+def make_pages(n: int, seed: int = 0) -> List[dict]:
+    # páginas {"page", "text"} ya limpias, como las devuelve iter_pdf_texts
+    rng = random.Random(seed)
+    return [{"page": p, "text": "\n\n".join(synth_paragraphs(rng, rng.randint(4, 8)))} for p in range(1, n + 1)]
+
+
+def messy_text(n_words: int, seed: int = 0, noise: float = 0.05) -> str:
+    # texto con una fracción `noise` de caracteres raros entre las palabras
+    rng = random.Random(seed)
+    words = synth_paragraphs(rng, max(1, n_words // 40))
+    out: List[str] = []
+    for w in " ".join(words).split(" ")[:n_words]:
+        out.append(w)
+        out.append(rng.choice(_NOISE) if rng.random() < noise else " ")
+    return "".join(out)
@@ -0,0 +1,120 @@
+from __future__ import annotations
+import argparse
+import random
+from pathlib import Path
+from typing import List
+
+"""
+Genera PDFs sintéticos con texto en español (sin dependencias externas),
+para medir la ingesta con documentos de cientos de páginas.
+Uso: python -m bench.synth_pdf /tmp/manual.pdf --pages 300
+"""
+
+WORDS = (
+    "garantía producto manual instalación usuario equipo servicio técnico "
+    "mantenimiento seguridad advertencia conexión eléctrica tensión potencia "
+    "referencia artículo modelo pieza repuesto configuración pantalla botón "
+    "encendido apagado limpieza filtro temperatura presión válvula sensor "
+    "cliente factura devolución plazo días meses año información contacto"
+).split()
+
+
+def synth_paragraphs(rng: random.Random, n: int) -> List[str]:
+    out = []
+    for _ in range(n):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(25, 60))]
+        words[0] = words[0].capitalize()
+        if rng.random() < 0.3:
+            words.insert(rng.randint(1, len(words) - 1), f"REF-{rng.randint(1000, 9999)}")
+        out.append(" ".join(words) + ".")
+    return out
+
+
+def _wrap(text: str, width: int = 90) -> List[str]:
+    lines, line = [], ""
+    for w in text.split():
+        if len(line) + len(w) + 1 > width:
+            lines.append(line)
+            line = w
+        else:
+            line = f"{line} {w}".strip()
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _pdf_str(s: str) -> bytes:
+    # cadena literal PDF en WinAnsi (latin-1 cubre los acentos del español)
+    raw = s.encode("cp1252", errors="replace")
+    return b"(" + raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def write_pdf(path: Path, pages: List[List[str]]) -> None:
+    """
+    Escribe un PDF mínimo: una página por lista de líneas, fuente Helvetica.
+    """
+    objects: List[bytes] = []
+
+    def add(obj: bytes) -> int:
+        objects.append(obj)
+        return len(objects)
+
+    catalog = add(b"")  # se rellena al final
+    pages_id = add(b"")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    kids = []
+    for lines in pages:
+        ops = [b"BT /F1 10 Tf 12 TL 50 800 Td"]
+        for ln in lines[:60]:
+            ops.append(_pdf_str(ln) + b" Tj T*")
+        ops.append(b"ET")
+        stream = b"\n".join(ops)
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_id, font, content)
+        ))
+
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    path.write_bytes(bytes(out))
+
+
+def make_pdf(path: Path, n_pages: int, seed: int = 0) -> Path:
+    rng = random.Random(seed)
+    pages = []
+    for p in range(1, n_pages + 1):
+        lines = [f"Capítulo {p // 10 + 1} - Página {p}"]
+        for para in synth_paragraphs(rng, rng.randint(4, 8)):
+            lines.extend(_wrap(para))
+            lines.append("")
+        pages.append(lines)
+    write_pdf(path, pages)
+    return path
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("out", type=Path)
+    ap.add_argument("--pages", type=int, default=300)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    make_pdf(args.out, args.pages, args.seed)
+    print(f"{args.out} ({args.pages} páginas)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from __future__ import annotations
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from bench.stub_ollama import StubOllama
+
+"""
+La configuración (app.settings) y los singletons (Chroma, BM25, sesiones)
+se crean al importar app, así que el stub de Ollama y el directorio de
+datos temporal se preparan aquí, antes de que ningún test importe nada.
+"""
+
+_stub = StubOllama(latency=0.0, per_item=0.0).start()
+_data = Path(tempfile.mkdtemp(prefix="rag_tests_"))
+os.environ.update({
+    "OLLAMA_HOST": _stub.url,
+    "CHROMA_PATH": str(_data / "chroma"),
+    "ANONYMIZED_TELEMETRY": "False",
+})
+# las subidas van a data/uploads relativo al directorio actual
+os.chdir(_data)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _teardown():
+    yield
+    from app.retriever import collection_handle
+
+    collection_handle.close()
+    _stub.stop()
+    shutil.rmtree(_data, ignore_errors=True)
+
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    from bench.synth_pdf import make_pdf as synth
+
+    def make(name: str = "doc.pdf", pages: int = 3, seed: int = 0) -> Path:
+        return synth(tmp_path / name, pages, seed=seed)
+
+    return make
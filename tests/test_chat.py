@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.ingest import ingest_pdf
+from app.main import app
+from app.settings import settings
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture
+def source(make_pdf):
+    pdf = make_pdf("manual.pdf", pages=3, seed=11)
+    ingest_pdf(pdf, "chat-manual.pdf")
+    return "chat-manual.pdf"
+
+
+@pytest.mark.parametrize("server_history", [False, True])
+def test_repeated_question_in_session_hits_answer_cache(client, source, monkeypatch, server_history):
+    # con SESSION_HISTORY el historial del servidor crece entre turnos: no debe cambiar la clave
+    monkeypatch.setattr(settings, "session_history", server_history)
+    client.cookies.clear()
+    question = {"message": f"¿Cuál es la garantía del producto? ({server_history})", "source": source}
+
+    first = client.post("/chat", json=question)
+    second = client.post("/chat", json=question)
+
+    assert first.status_code == second.status_code == 200
+    assert first.json()["extra"]["answer_cache"] == "miss"
+    assert second.json()["extra"]["answer_cache"] == "hit"
+    assert second.json()["answer"] == first.json()["answer"]
+    if server_history:
+        assert client.get("/session").json()["messages"] == 4
+
+
+def test_retrieval_cache_hit_reports_no_stage_timings(client, source):
+    question = {"message": "presión de la válvula del filtro", "source": source, "mmr": True, "timings": True}
+
+    first = client.post("/chat", json=question).json()["extra"]
+    second = client.post("/chat", json=question).json()["extra"]
+
+    assert first["retrieval_cache"] == "miss" and first["mmr_ms"] is not None
+    assert "mmr_ms" in first["timings"]
+    assert second["retrieval_cache"] == "hit"
+    assert second["mmr_ms"] is None
+    assert "mmr_ms" not in second["timings"] and "chroma_query_ms" not in second["timings"]
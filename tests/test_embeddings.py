@@ -0,0 +1,26 @@
+from __future__ import annotations
+import asyncio
+
+import httpx
+import pytest
+
+from app.embeddings import OllamaEmbeddings
+
+
+@pytest.mark.parametrize("batch_body", [[[0.1, 0.2]], {"error": "model not found"}])
+def test_aembed_falls_back_when_batch_body_is_not_embeddings(monkeypatch, batch_body):
+    # /api/embed con una lista o un error en el cuerpo: se pasa a /api/embeddings, como en embed()
+    emb = OllamaEmbeddings("http://ollama.invalid", "m", batch_size=8, concurrency=2)
+    calls = []
+
+    async def fake_post(path, payload):
+        calls.append(path)
+        body = batch_body if path == "/api/embed" else {"embedding": [float(len(payload.get("prompt") or ""))]}
+        return httpx.Response(200, json=body, request=httpx.Request("POST", f"http://ollama.invalid{path}"))
+
+    monkeypatch.setattr(emb, "_apost", fake_post)
+    vecs = asyncio.run(emb.aembed(["uno", "dos tres"], use_cache=False))
+
+    assert vecs == [[3.0], [8.0]]
+    assert calls[0] == "/api/embed" and calls[1:] == ["/api/embeddings"] * 2
+    assert emb._batch_supported is False
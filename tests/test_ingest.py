@@ -0,0 +1,34 @@
+from __future__ import annotations
+from collections import Counter
+
+from app.ingest import ingest_pdf
+from app.lexical import lexical_index
+from app.retriever import collection_handle
+
+
+def _chunks_by_source():
+    got = collection_handle.view().get(include=["metadatas"])
+    return Counter(m["source"] for m in got["metadatas"])
+
+
+def test_same_pdf_under_two_names_keeps_both(make_pdf):
+    # ?force=true / app.cli ingest --force: el mismo contenido con otro nombre
+    pdf = make_pdf("twice.pdf", pages=4, seed=7)
+    first = ingest_pdf(pdf, "twice-a.pdf")
+    second = ingest_pdf(pdf, "twice-b.pdf")
+
+    n = first["added_chunks"]
+    assert n > 0 and second["added_chunks"] == n
+    counts = _chunks_by_source()
+    assert counts["twice-a.pdf"] == n
+    assert counts["twice-b.pdf"] == n
+    assert lexical_index.search("garantía producto", 5, "twice-a.pdf")
+    assert lexical_index.search("garantía producto", 5, "twice-b.pdf")
+
+
+def test_reingest_same_source_is_skipped(make_pdf):
+    pdf = make_pdf("again.pdf", pages=2, seed=3)
+    ingest_pdf(pdf, "again.pdf")
+    res = ingest_pdf(pdf, "again.pdf")
+    assert res["skipped"] is True
+    assert _chunks_by_source()["again.pdf"] == res["kept_chunks"]
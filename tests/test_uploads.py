@@ -0,0 +1,98 @@
+from __future__ import annotations
+import asyncio
+from contextlib import aclosing
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from app.main import app
+from app.settings import settings
+from app.uploads import UPLOADS_DIR, UploadTooLarge, iter_form_files
+
+BOUNDARY = "testboundary"
+
+
+def _multipart(field: str, name: str, data: bytes) -> bytes:
+    return (
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{name}\"\r\n"
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def _leftovers():
+    return list(Path(UPLOADS_DIR).glob(".upload-*.part"))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # el multipart se lee a mano: nada de Request.form() (UploadFile lo copiaría entero a otro temporal)
+    async def no_form(self, *a, **k):
+        raise AssertionError("Request.form() no debería usarse en las subidas")
+
+    monkeypatch.setattr(Request, "form", no_form)
+    with TestClient(app) as c:
+        yield c
+
+
+def test_ingest_writes_content_addressed_file(client, make_pdf):
+    pdf = make_pdf("up.pdf", pages=2, seed=21).read_bytes()
+    r = client.post("/ingest?wait=true", files={"file": ("up.pdf", pdf, "application/pdf")})
+
+    assert r.status_code == 200, r.text
+    body = r.json()
+    assert body["source"] == "up.pdf" and body["added_chunks"] > 0
+    assert (Path(UPLOADS_DIR) / f"{body['file_hash']}.pdf").read_bytes() == pdf
+    assert not _leftovers()
+
+
+def test_chunked_upload_over_limit_is_rejected(client, monkeypatch):
+    # sin Content-Length el middleware no puede rechazarla: lo hace el lector
+    monkeypatch.setattr(settings, "upload_max_bytes", 64 * 1024)
+    payload = _multipart("file", "big.pdf", b"%PDF" + b"x" * (1024 * 1024))
+
+    def body():
+        for i in range(0, len(payload), 16 * 1024):
+            yield payload[i:i + 16 * 1024]
+
+    r = client.post("/ingest", content=body(), headers={"content-type": f"multipart/form-data; boundary={BOUNDARY}"})
+
+    assert r.status_code == 413
+    assert not _leftovers()
+
+
+def test_form_reader_stops_reading_past_the_total_limit(tmp_path):
+    # el cuerpo se corta según llega, sin leerlo (ni guardarlo) entero antes
+    payload = _multipart("file", "big.pdf", b"x" * (4 * 1024 * 1024))
+    chunks = [payload[i:i + 64 * 1024] for i in range(0, len(payload), 64 * 1024)]
+    read = []
+
+    async def receive():
+        read.append(1)
+        i = len(read) - 1
+        return {"type": "http.request", "body": chunks[i], "more_body": i + 1 < len(chunks)}
+
+    scope = {"type": "http", "method": "POST", "path": "/ingest", "query_string": b"",
+             "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]}
+
+    async def run():
+        async with aclosing(iter_form_files(Request(scope, receive), lambda f, n: 10**9, 256 * 1024, tmp_path)) as parts:
+            return [p async for p in parts]
+
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(run())
+    assert len(read) < len(chunks) // 4
+    assert not list(tmp_path.iterdir())
+
+
+def test_bulk_rejects_per_file(client, make_pdf):
+    pdf = make_pdf("bulk.pdf", pages=1, seed=22).read_bytes()
+    files = [("files", ("bulk.pdf", pdf, "application/pdf")), ("files", ("notes.txt", b"hola", "text/plain"))]
+    r = client.post("/ingest/bulk", files=files)
+
+    assert r.status_code == 200, r.text
+    statuses = {f["file"]: f["status"] for f in r.json()["files"]}
+    assert statuses["bulk.pdf"] in ("queued", "unchanged", "duplicate")
+    assert statuses["notes.txt"] == "rejected"
+    assert not _leftovers()